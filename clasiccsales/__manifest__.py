@@ -10,19 +10,37 @@
         with totals separated by each section.
     """,
     'author': 'yhonier Arias',
-    'depends': ['sale', 'sale_margin'],
+    'depends': ['sale', 'sale_margin', 'bus'],
     'data': [
         'security/ir.model.access.csv',
+        'security/margin_security.xml',
+        'data/mail_activity_data.xml',
+        'data/ir_cron_data.xml',
         'views/sale_order_views.xml',
+        'report/section_margin_report_views.xml',
+        'views/margin_kpi_views.xml',
     ],
     'assets': {
         'web.assets_backend': [
+            'clasiccsales/static/src/js/section_margin_engine.js',
             'clasiccsales/static/src/js/section_margin_widget.js',
-            'clasiccsales/static/src/js/margin_adjuster.js',
+            'clasiccsales/static/src/js/section_margin_virtual_table.js',
+            'clasiccsales/static/src/js/section_margins_html_field.js',
+            'clasiccsales/static/src/js/margin_rpc.js',
+            'clasiccsales/static/src/js/margin_bus.js',
+            'clasiccsales/static/src/js/margin_kpi_dashboard.js',
             'clasiccsales/static/src/xml/section_margin_widget.xml',
+            'clasiccsales/static/src/xml/margin_kpi_dashboard.xml',
             'clasiccsales/static/src/css/section_margin_widget.css',
             'clasiccsales/static/src/css/margin_history.css',
         ],
+        'web.assets_unit_tests': [
+            'clasiccsales/static/tests/**/*',
+        ],
+        # Loaded on demand by the margins tab (SectionMarginsHtmlField)
+        'clasiccsales.assets_margin_adjuster': [
+            'clasiccsales/static/src/js/margin_adjuster.js',
+        ],
     },
     'installable': True,
     'application': False,
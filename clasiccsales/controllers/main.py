@@ -1,20 +1,49 @@
 # -*- coding: utf-8 -*-
 
-from odoo import http
-from odoo.http import request
+from odoo import api, http
+from odoo.exceptions import AccessError
+from odoo.http import request, content_disposition
+from odoo.modules.registry import Registry
+import csv
+import io
 import json
+import os
+import tempfile
+
+import xlsxwriter
+
+from ..report.section_margin_report import EXPORT_HEADER
+
+# Orders read per query while exporting, and bytes per streamed chunk
+EXPORT_ORDER_CHUNK = 200
+EXPORT_STREAM_BLOCK = 64 * 1024
 
 
 class SectionMarginController(http.Controller):
 
+    def _enqueue_margin_job(self, order, job_type, params):
+        """Queue an adjustment in the background and return its job id"""
+        job = request.env['sale.order.margin.job'].enqueue(order, job_type, params)
+        return {
+            'success': True,
+            'async': True,
+            'job_id': job.id,
+            'message': 'The adjustment has been queued and will be processed in the background.'
+        }
+
     @http.route('/sale_order/adjust_section_margin', type='jsonrpc', auth='user', methods=['POST'])
-    def adjust_section_margin(self, order_id, section_name, target_margin_percent):
+    def adjust_section_margin(self, order_id, section_name, target_margin_percent, margin_version=None, async_mode=None, strategy=None, weights=None, constrained=False):
         """
         Adjust the prices in a section to achieve the target margin percentage.
 
         :param order_id: ID of the sale order
         :param section_name: Name of the section to adjust
         :param target_margin_percent: Desired target margin percentage for the section
+        :param margin_version: Version token of the margins shown to the user
+        :param async_mode: True/False to force a background job or not, None to decide by order size
+        :param strategy: Distribution strategy of the price change (default 'uniform')
+        :param weights: {product category ID: weight} for the 'category_weight' strategy
+        :param constrained: Keep every line between its price floor and ceiling
         :return: dict with result status and message
         """
         try:
@@ -42,8 +71,22 @@ class SectionMarginController(http.Controller):
                     'message': 'Sales order not found.'
                 }
 
+            # Reject stale requests before touching any line
+            stale = order._check_margin_version(margin_version)
+            if stale:
+                return stale
+
+            if order._use_async_margin_job(async_mode):
+                return self._enqueue_margin_job(order, 'section', {
+                    'section_name': section_name,
+                    'target_margin_percent': float(target_margin_percent),
+                    'strategy': strategy or 'uniform',
+                    'weights': weights or {},
+                    'constrained': bool(constrained),
+                })
+
             # Perform section margin adjustment
-            result = order.adjust_section_margin(section_name, float(target_margin_percent))
+            result = order.adjust_section_margin(section_name, float(target_margin_percent), strategy or 'uniform', weights, bool(constrained))
             return result
 
         except Exception as e:
@@ -55,7 +98,7 @@ class SectionMarginController(http.Controller):
             }
 
     @http.route('/sale_order/adjust_subsection_margin', type='jsonrpc', auth='user', methods=['POST'])
-    def adjust_subsection_margin(self, order_id, section_name, subsection_name, target_margin_percent):
+    def adjust_subsection_margin(self, order_id, section_name, subsection_name, target_margin_percent, margin_version=None, async_mode=None, strategy=None, weights=None, constrained=False):
         """
         Adjust the prices in a subsection to achieve the target margin percentage.
 
@@ -63,6 +106,11 @@ class SectionMarginController(http.Controller):
         :param section_name: Name of the parent section
         :param subsection_name: Name of the subsection to adjust
         :param target_margin_percent: Desired target margin percentage for the subsection
+        :param margin_version: Version token of the margins shown to the user
+        :param async_mode: True/False to force a background job or not, None to decide by order size
+        :param strategy: Distribution strategy of the price change (default 'uniform')
+        :param weights: {product category ID: weight} for the 'category_weight' strategy
+        :param constrained: Keep every line between its price floor and ceiling
         :return: dict with result status and message
         """
         try:
@@ -90,8 +138,23 @@ class SectionMarginController(http.Controller):
                     'message': 'Sales order not found.'
                 }
 
+            # Reject stale requests before touching any line
+            stale = order._check_margin_version(margin_version)
+            if stale:
+                return stale
+
+            if order._use_async_margin_job(async_mode):
+                return self._enqueue_margin_job(order, 'subsection', {
+                    'section_name': section_name,
+                    'subsection_name': subsection_name,
+                    'target_margin_percent': float(target_margin_percent),
+                    'strategy': strategy or 'uniform',
+                    'weights': weights or {},
+                    'constrained': bool(constrained),
+                })
+
             # Perform subsection margin adjustment
-            result = order.adjust_subsection_margin(section_name, subsection_name, float(target_margin_percent))
+            result = order.adjust_subsection_margin(section_name, subsection_name, float(target_margin_percent), strategy or 'uniform', weights, bool(constrained))
             return result
 
         except Exception as e:
@@ -102,14 +165,214 @@ class SectionMarginController(http.Controller):
                 'traceback': traceback.format_exc()
             }
 
+    @http.route('/sale_order/adjust_section_margin_by_id', type='jsonrpc', auth='user', methods=['POST'])
+    def adjust_section_margin_by_id(self, order_id, section_line_id, target_margin_percent, margin_version=None, async_mode=None, strategy=None, weights=None, constrained=False):
+        """
+        Adjust the prices in a section to achieve the target margin percentage.
+        Same as /sale_order/adjust_section_margin, with the section identified by its line ID.
+
+        :param order_id: ID of the sale order
+        :param section_line_id: ID of the section line (sale order line)
+        :param target_margin_percent: Desired target margin percentage for the section
+        :param margin_version: Version token of the margins shown to the user
+        :param async_mode: True/False to force a background job or not, None to decide by order size
+        :param strategy: Distribution strategy of the price change (default 'uniform')
+        :param weights: {product category ID: weight} for the 'category_weight' strategy
+        :param constrained: Keep every line between its price floor and ceiling
+        :return: dict with result status and message
+        """
+        try:
+            # Validate order ID
+            if not order_id or str(order_id).startswith('NewId_'):
+                return {
+                    'success': False,
+                    'message': 'Please save the sales order before adjusting the margins.'
+                }
+
+            # Ensure IDs are integers
+            try:
+                order_id_int = int(order_id)
+                section_line_id_int = int(section_line_id)
+            except (ValueError, TypeError):
+                return {
+                    'success': False,
+                    'message': 'Invalid order ID or section ID. Please save the order first.'
+                }
+
+            order = request.env['sale.order'].browse(order_id_int)
+
+            if not order.exists():
+                return {
+                    'success': False,
+                    'message': 'Sales order not found.'
+                }
+
+            # Reject stale requests before touching any line
+            stale = order._check_margin_version(margin_version)
+            if stale:
+                return stale
+
+            if order._use_async_margin_job(async_mode):
+                return self._enqueue_margin_job(order, 'section', {
+                    'section_line_id': section_line_id_int,
+                    'target_margin_percent': float(target_margin_percent),
+                    'strategy': strategy or 'uniform',
+                    'weights': weights or {},
+                    'constrained': bool(constrained),
+                })
+
+            return order.adjust_section_margin_by_id(section_line_id_int, float(target_margin_percent), strategy or 'uniform', weights, bool(constrained))
+
+        except Exception as e:
+            import traceback
+            return {
+                'success': False,
+                'message': f'Error: {str(e)}',
+                'traceback': traceback.format_exc()
+            }
+
+    @http.route('/sale_order/adjust_subsection_margin_by_id', type='jsonrpc', auth='user', methods=['POST'])
+    def adjust_subsection_margin_by_id(self, order_id, subsection_line_id, target_margin_percent, margin_version=None, async_mode=None, strategy=None, weights=None, constrained=False):
+        """
+        Adjust the prices in a subsection to achieve the target margin percentage.
+        Same as /sale_order/adjust_subsection_margin, with the subsection identified by its line ID.
+
+        :param order_id: ID of the sale order
+        :param subsection_line_id: ID of the subsection line (sale order line)
+        :param target_margin_percent: Desired target margin percentage for the subsection
+        :param margin_version: Version token of the margins shown to the user
+        :param async_mode: True/False to force a background job or not, None to decide by order size
+        :param strategy: Distribution strategy of the price change (default 'uniform')
+        :param weights: {product category ID: weight} for the 'category_weight' strategy
+        :param constrained: Keep every line between its price floor and ceiling
+        :return: dict with result status and message
+        """
+        try:
+            # Validate order ID
+            if not order_id or str(order_id).startswith('NewId_'):
+                return {
+                    'success': False,
+                    'message': 'Please save the sales order before adjusting the margins.'
+                }
+
+            # Ensure IDs are integers
+            try:
+                order_id_int = int(order_id)
+                subsection_line_id_int = int(subsection_line_id)
+            except (ValueError, TypeError):
+                return {
+                    'success': False,
+                    'message': 'Invalid order ID or subsection ID. Please save the order first.'
+                }
+
+            order = request.env['sale.order'].browse(order_id_int)
+
+            if not order.exists():
+                return {
+                    'success': False,
+                    'message': 'Sales order not found.'
+                }
+
+            # Reject stale requests before touching any line
+            stale = order._check_margin_version(margin_version)
+            if stale:
+                return stale
+
+            if order._use_async_margin_job(async_mode):
+                return self._enqueue_margin_job(order, 'subsection', {
+                    'subsection_line_id': subsection_line_id_int,
+                    'target_margin_percent': float(target_margin_percent),
+                    'strategy': strategy or 'uniform',
+                    'weights': weights or {},
+                    'constrained': bool(constrained),
+                })
+
+            return order.adjust_subsection_margin_by_id(subsection_line_id_int, float(target_margin_percent), strategy or 'uniform', weights, bool(constrained))
+
+        except Exception as e:
+            import traceback
+            return {
+                'success': False,
+                'message': f'Error: {str(e)}',
+                'traceback': traceback.format_exc()
+            }
+
+    @http.route('/sale_order/adjust_order_margin', type='jsonrpc', auth='user', methods=['POST'])
+    def adjust_order_margin(self, order_id, target_margin_percent, section_weights=None, locked_section_ids=None,
+                            constrained=False, margin_version=None, async_mode=None):
+        """
+        Adjust the prices of all sections to bring the order to the target margin percentage.
+
+        :param order_id: ID of the sale order
+        :param target_margin_percent: Desired target margin percentage for the whole order
+        :param section_weights: {section line ID: weight} share of the price change of each section
+        :param locked_section_ids: IDs of the section lines whose prices must not change
+        :param constrained: Keep every line between its price floor and ceiling
+        :param margin_version: Version token of the margins shown to the user
+        :param async_mode: True/False to force a background job or not, None to decide by order size
+        :return: dict with result status and message
+        """
+        try:
+            # Validate order ID
+            if not order_id or str(order_id).startswith('NewId_'):
+                return {
+                    'success': False,
+                    'message': 'Please save the sales order before adjusting the margins.'
+                }
+
+            # Ensure IDs are integers
+            try:
+                order_id_int = int(order_id)
+                locked_section_ids = [int(section_id) for section_id in locked_section_ids or []]
+                section_weights = {int(section_id): float(weight) for section_id, weight in (section_weights or {}).items()}
+            except (ValueError, TypeError):
+                return {
+                    'success': False,
+                    'message': 'Invalid order ID, section ID or weight.'
+                }
+
+            order = request.env['sale.order'].browse(order_id_int)
+
+            if not order.exists():
+                return {
+                    'success': False,
+                    'message': 'Sales order not found.'
+                }
+
+            # Reject stale requests before touching any line
+            stale = order._check_margin_version(margin_version)
+            if stale:
+                return stale
+
+            if order._use_async_margin_job(async_mode):
+                return self._enqueue_margin_job(order, 'order', {
+                    'target_margin_percent': float(target_margin_percent),
+                    'section_weights': section_weights,
+                    'locked_section_ids': locked_section_ids,
+                    'constrained': bool(constrained),
+                })
+
+            return order.adjust_order_margin(
+                float(target_margin_percent), section_weights, locked_section_ids, bool(constrained))
+
+        except Exception as e:
+            import traceback
+            return {
+                'success': False,
+                'message': f'Error: {str(e)}',
+                'traceback': traceback.format_exc()
+            }
+
     @http.route('/sale_order/adjust_product_margin', type='jsonrpc', auth='user', methods=['POST'])
-    def adjust_product_margin(self, order_id, line_id, target_margin_percent):
+    def adjust_product_margin(self, order_id, line_id, target_margin_percent, margin_version=None, async_mode=None):
         """
         Adjust the price of a single product to achieve the target margin percentage.
 
         :param order_id: ID of the sale order
         :param line_id: ID of the sale order line (product)
         :param target_margin_percent: Desired target margin percentage for the product
+        :param margin_version: Version token of the margins shown to the user
+        :param async_mode: True/False to force a background job or not, None to decide by order size
         :return: dict with result status and message
         """
         try:
@@ -138,6 +401,17 @@ class SectionMarginController(http.Controller):
                     'message': 'Sales order not found.'
                 }
 
+            # Reject stale requests before touching any line
+            stale = order._check_margin_version(margin_version)
+            if stale:
+                return stale
+
+            if order._use_async_margin_job(async_mode):
+                return self._enqueue_margin_job(order, 'product', {
+                    'line_id': line_id_int,
+                    'target_margin_percent': float(target_margin_percent),
+                })
+
             # Perform product margin adjustment
             result = order.adjust_product_margin(line_id_int, float(target_margin_percent))
             return result
@@ -151,12 +425,14 @@ class SectionMarginController(http.Controller):
             }
 
     @http.route('/sale_order/rollback_margin', type='jsonrpc', auth='user', methods=['POST'])
-    def rollback_margin(self, order_id, history_id):
+    def rollback_margin(self, order_id, history_id, margin_version=None, async_mode=None):
         """
         Restore a margin value from the margin adjustment history.
 
         :param order_id: ID of the sale order
         :param history_id: ID of the margin history record to restore
+        :param margin_version: Version token of the margins shown to the user
+        :param async_mode: True/False to force a background job or not, None to decide by order size
         :return: dict with result status and message
         """
         try:
@@ -185,6 +461,16 @@ class SectionMarginController(http.Controller):
                     'message': 'Sales order not found.'
                 }
 
+            # Reject stale requests before touching any line
+            stale = order._check_margin_version(margin_version)
+            if stale:
+                return stale
+
+            if order._use_async_margin_job(async_mode):
+                return self._enqueue_margin_job(order, 'rollback', {
+                    'history_id': history_id_int,
+                })
+
             # Perform rollback from history
             result = order.rollback_margin(history_id_int)
             return result
@@ -196,3 +482,308 @@ class SectionMarginController(http.Controller):
                 'message': f'Error: {str(e)}',
                 'traceback': traceback.format_exc()
             }
+
+    @http.route('/sale_order/restore_margins_to', type='jsonrpc', auth='user', methods=['POST'])
+    def restore_margins_to(self, order_id, timestamp=None, history_id=None, margin_version=None, async_mode=None):
+        """
+        Restore the prices the order had at a point in time, in one write.
+
+        :param order_id: ID of the sale order
+        :param timestamp: UTC datetime ('YYYY-MM-DD HH:MM:SS') to restore the prices to
+        :param history_id: or ID of the history record to restore the prices before
+        :param margin_version: Version token of the margins shown to the user
+        :param async_mode: True/False to force a background job or not, None to decide by order size
+        :return: dict with result status and message
+        """
+        try:
+            # Validate order ID
+            if not order_id or str(order_id).startswith('NewId_'):
+                return {
+                    'success': False,
+                    'message': 'Please save the sales order first.'
+                }
+
+            # Ensure IDs are integers
+            try:
+                order_id_int = int(order_id)
+                history_id_int = int(history_id) if history_id else None
+            except (ValueError, TypeError):
+                return {
+                    'success': False,
+                    'message': 'Invalid order ID or history ID. Please save the order first.'
+                }
+
+            if not timestamp and not history_id_int:
+                return {
+                    'success': False,
+                    'message': 'Please choose the date to restore the prices to.'
+                }
+
+            order = request.env['sale.order'].browse(order_id_int)
+
+            if not order.exists():
+                return {
+                    'success': False,
+                    'message': 'Sales order not found.'
+                }
+
+            # Reject stale requests before touching any line
+            stale = order._check_margin_version(margin_version)
+            if stale:
+                return stale
+
+            if order._use_async_margin_job(async_mode):
+                return self._enqueue_margin_job(order, 'restore', {
+                    'timestamp': timestamp,
+                    'history_id': history_id_int,
+                })
+
+            return order.restore_margins_to(timestamp, history_id_int)
+
+        except Exception as e:
+            import traceback
+            return {
+                'success': False,
+                'message': f'Error: {str(e)}',
+                'traceback': traceback.format_exc()
+            }
+
+    @http.route('/sale_order/margin_job_status', type='jsonrpc', auth='user', methods=['POST'])
+    def margin_job_status(self, job_id):
+        """
+        Return the status of a background margin adjustment.
+
+        :param job_id: ID of the margin job returned by an adjust or rollback call
+        :return: dict with state, message and the adjustment result
+        """
+        try:
+            try:
+                job_id_int = int(job_id)
+            except (ValueError, TypeError):
+                return {
+                    'success': False,
+                    'message': 'Invalid job ID.'
+                }
+
+            job = request.env['sale.order.margin.job'].browse(job_id_int)
+
+            if not job.exists():
+                return {
+                    'success': False,
+                    'message': 'Margin job not found.'
+                }
+
+            # The result reveals the prices of the order
+            try:
+                job.check_access('read')
+                job.order_id.check_access('read')
+            except AccessError:
+                return {
+                    'success': False,
+                    'message': 'Margin job not found.'
+                }
+
+            return job.get_status()
+
+        except Exception as e:
+            import traceback
+            return {
+                'success': False,
+                'message': f'Error: {str(e)}',
+                'traceback': traceback.format_exc()
+            }
+
+    @http.route('/sale_order/section_margin_summary', type='jsonrpc', auth='user', methods=['POST'])
+    def section_margin_summary(self, order_id, etag=None):
+        """
+        Return section and subsection totals of an order, without product rows.
+
+        :param order_id: ID of the sale order
+        :param etag: ETag of the summary cached by the client, if any
+        :return: dict with the summary tree and its ETag, or unchanged=True
+            when the client copy is still current
+        """
+        try:
+            try:
+                order_id_int = int(order_id)
+            except (ValueError, TypeError):
+                return {
+                    'success': False,
+                    'message': 'Invalid order ID. Please save the order first.'
+                }
+
+            order = request.env['sale.order'].browse(order_id_int)
+
+            if not order.exists():
+                return {
+                    'success': False,
+                    'message': 'Sales order not found.'
+                }
+
+            # Cheap version check before building anything (no ETag, so
+            # never unchanged, when costs do not come from the lines)
+            current_etag = order._get_margin_etag()
+            if etag and etag == current_etag:
+                return {
+                    'success': True,
+                    'unchanged': True,
+                    'etag': current_etag,
+                }
+
+            return {
+                'success': True,
+                'etag': current_etag,
+                'summary': order._get_section_margins_summary(),
+            }
+
+        except Exception as e:
+            import traceback
+            return {
+                'success': False,
+                'message': f'Error: {str(e)}',
+                'traceback': traceback.format_exc()
+            }
+
+    @http.route('/sale_order/section_margin_products', type='jsonrpc', auth='user', methods=['POST'])
+    def section_margin_products(self, order_id, section_line_id, subsection_line_id=None):
+        """
+        Return the product rows of one section or subsection, loaded when it is expanded.
+
+        :param order_id: ID of the sale order
+        :param section_line_id: ID of the section line
+        :param subsection_line_id: ID of the subsection line (None for products directly under the section)
+        :return: dict with the product rows
+        """
+        try:
+            try:
+                order_id_int = int(order_id)
+                section_line_id_int = int(section_line_id)
+                subsection_line_id_int = int(subsection_line_id) if subsection_line_id else None
+            except (ValueError, TypeError):
+                return {
+                    'success': False,
+                    'message': 'Invalid order ID or line ID.'
+                }
+
+            order = request.env['sale.order'].browse(order_id_int)
+
+            if not order.exists():
+                return {
+                    'success': False,
+                    'message': 'Sales order not found.'
+                }
+
+            return {
+                'success': True,
+                'products': order._get_section_margin_products(section_line_id_int, subsection_line_id_int),
+            }
+
+        except Exception as e:
+            import traceback
+            return {
+                'success': False,
+                'message': f'Error: {str(e)}',
+                'traceback': traceback.format_exc()
+            }
+
+    @http.route('/sale_order/margin_kpis', type='jsonrpc', auth='user', methods=['POST'])
+    def margin_kpis(self, group_by='user', period='month', date_from=None, date_to=None):
+        """
+        Return the margin KPIs by salesperson or team and period.
+
+        :param group_by: 'user' or 'team'
+        :param period: 'day', 'week', 'month', 'quarter' or 'year'
+        :param date_from: first date included ('YYYY-MM-DD', default twelve months ago)
+        :param date_to: last date included ('YYYY-MM-DD', default today)
+        :return: dict with the KPI rows
+        """
+        try:
+            return request.env['sale.order.margin.kpi'].get_kpis(group_by, period, date_from, date_to)
+
+        except Exception as e:
+            import traceback
+            return {
+                'success': False,
+                'message': f'Error: {str(e)}',
+                'traceback': traceback.format_exc()
+            }
+
+    @http.route('/sale_order/section_margins/export', type='http', auth='user', methods=['GET'])
+    def export_section_margins(self, order_ids=None, file_format='csv', **kwargs):
+        """
+        Stream the section margin breakdown of many orders as CSV or XLSX.
+
+        Rows are produced while the orders are read in chunks, from a cursor
+        owned by the response generator, so the export never holds more than
+        one chunk of orders in memory.
+
+        :param order_ids: comma-separated IDs of the sale orders (all readable orders when empty)
+        :param file_format: 'csv' or 'xlsx'
+        :return: streamed file response
+        """
+        if file_format not in ('csv', 'xlsx'):
+            return request.make_response('Unsupported export format.', status=400)
+        try:
+            ids = [int(order_id) for order_id in order_ids.split(',') if order_id] if order_ids else None
+        except ValueError:
+            return request.make_response('Invalid order ID.', status=400)
+        if ids is None:
+            ids = request.env['sale.order'].search([], order='id').ids
+
+        stream_args = (request.db, request.env.uid, dict(request.env.context), ids)
+        if file_format == 'xlsx':
+            body = self._stream_margin_xlsx(*stream_args)
+            mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        else:
+            body = self._stream_margin_csv(*stream_args)
+            mimetype = 'text/csv;charset=utf-8'
+
+        return request.make_response(body, headers=[
+            ('Content-Type', mimetype),
+            ('Content-Disposition', content_disposition(f'section_margins.{file_format}')),
+        ])
+
+    def _iter_margin_export_rows(self, dbname, uid, context, order_ids):
+        """Yield export rows from a dedicated cursor, the request cursor is closed while streaming"""
+        with Registry(dbname).cursor() as cr:
+            env = api.Environment(cr, uid, context)
+            yield from env['sale.order.section.margin.report']._iter_export_rows(
+                order_ids, chunk_size=EXPORT_ORDER_CHUNK)
+
+    def _stream_margin_csv(self, dbname, uid, context, order_ids):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_HEADER)
+        for row in self._iter_margin_export_rows(dbname, uid, context, order_ids):
+            writer.writerow(row)
+            if buffer.tell() >= EXPORT_STREAM_BLOCK:
+                yield buffer.getvalue().encode()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue().encode()
+
+    def _stream_margin_xlsx(self, dbname, uid, context, order_ids):
+        # XLSX is a zip archive and cannot be written progressively to the
+        # socket: rows are flushed to a temporary file in constant-memory
+        # mode and the file is streamed once complete
+        fd, path = tempfile.mkstemp(suffix='.xlsx')
+        os.close(fd)
+        try:
+            workbook = xlsxwriter.Workbook(path, {'constant_memory': True})
+            sheet = workbook.add_worksheet('Section Margins')
+            bold = workbook.add_format({'bold': True})
+            amount = workbook.add_format({'num_format': '#,##0.00'})
+            sheet.write_row(0, 0, EXPORT_HEADER, bold)
+            row_index = 1
+            for row in self._iter_margin_export_rows(dbname, uid, context, order_ids):
+                style = bold if row[4] != 'Product' else None
+                sheet.write_row(row_index, 0, row[:6], style)
+                sheet.write_row(row_index, 6, row[6:], amount)
+                row_index += 1
+            workbook.close()
+
+            with open(path, 'rb') as export_file:
+                while block := export_file.read(EXPORT_STREAM_BLOCK):
+                    yield block
+        finally:
+            os.unlink(path)
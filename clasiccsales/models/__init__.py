@@ -1,5 +1,9 @@
 # -*- coding: utf-8 -*-
 
+from . import margin_cost
 from . import sale_order
+from . import sale_order_line
 from . import margin_history
-
+from . import margin_job
+from . import margin_alert
+from . import ir_websocket
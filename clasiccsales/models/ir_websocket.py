@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models
+
+MARGIN_CHANNEL_PREFIX = 'clasiccsales_margins_'
+
+
+class IrWebsocket(models.AbstractModel):
+    _inherit = 'ir.websocket'
+
+    def _build_bus_channel_list(self, channels):
+        """Subscribe margin tabs to the updates of orders the user can read"""
+        channels = list(channels)
+        for channel in list(channels):
+            if not isinstance(channel, str) or not channel.startswith(MARGIN_CHANNEL_PREFIX):
+                continue
+            channels.remove(channel)
+            order_id = channel[len(MARGIN_CHANNEL_PREFIX):]
+            if not order_id.isdigit():
+                continue
+            order = self.env['sale.order'].browse(int(order_id)).exists()
+            if order and order.has_access('read'):
+                channels.append((order, 'margins'))
+        return super()._build_bus_channel_list(channels)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api
+from odoo.tools import SQL, html2plaintext
+from markupsafe import Markup
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+class MarginAlert(models.AbstractModel):
+    _name = 'sale.order.margin.alert'
+    _description = 'Section Margin Alerts'
+
+    # Open quotations with a section below the margin threshold get one
+    # "Margin Alert" activity, kept up to date by a cron sweep.
+    #
+    # The threshold is the `clasiccsales.margin_alert_threshold` system
+    # parameter (a percentage); no sweep is done while it is not set. Section
+    # margins come from one grouped query per chunk of orders over
+    # sale.order.section.margin.report, never from the per-order margin tree.
+
+    @api.model
+    def _get_threshold(self):
+        value = self.env['ir.config_parameter'].sudo().get_param('clasiccsales.margin_alert_threshold')
+        if not value:
+            return None
+        try:
+            return float(value)
+        except ValueError:
+            _logger.warning('Invalid margin alert threshold: %s', value)
+            return None
+
+    @api.model
+    def _get_low_margin_sections(self, order_ids, threshold):
+        """
+        Return the sections of these orders whose margin is below threshold.
+
+        :param order_ids: IDs of the orders to check
+        :param threshold: margin percentage
+        :return: dict {order_id: (salesperson ID, [(section name, margin %)])}
+        """
+        self.env.cr.execute(SQL("""
+            SELECT r.order_id, max(r.user_id), max(r.section_name),
+                   sum(r.margin) / sum(r.price_subtotal) * 100
+              FROM (%s) r
+             WHERE r.section_line_id IS NOT NULL
+          GROUP BY r.order_id, r.section_line_id
+            HAVING sum(r.margin) < sum(r.price_subtotal) * %s / 100
+          ORDER BY r.order_id, min(r.line_sequence), r.section_line_id
+        """, self.env['sale.order.section.margin.report']._query(order_ids), threshold))
+        sections = {}
+        for order_id, user_id, section_name, percent in self.env.cr.fetchall():
+            sections.setdefault(order_id, (user_id, []))[1].append((section_name, percent))
+        return sections
+
+    @api.model
+    def _format_alert_note(self, low_sections, threshold):
+        items = Markup('').join(
+            Markup('<li>%s: %s%%</li>') % (section_name, f'{percent:.2f}')
+            for section_name, percent in low_sections
+        )
+        return Markup('<p>Sections below %s%% margin:</p><ul>%s</ul>') % (f'{threshold:.2f}', items)
+
+    @api.model
+    def _sync_alert_activities(self, order_ids, low_margin_sections, activity_type, threshold):
+        """
+        Create or update one alert activity per order with low sections and
+        remove the alerts of the other orders.
+
+        :return: number of orders with an alert
+        """
+        # No assignment e-mail per activity
+        Activity = self.env['mail.activity'].with_context(mail_activity_quick_update=True)
+        existing = {}
+        obsolete = Activity
+        for activity in Activity.search([
+            ('res_model', '=', 'sale.order'),
+            ('res_id', 'in', order_ids),
+            ('activity_type_id', '=', activity_type.id),
+        ]):
+            if activity.res_id in low_margin_sections and activity.res_id not in existing:
+                existing[activity.res_id] = activity
+            else:
+                obsolete |= activity
+        obsolete.unlink()
+
+        res_model_id = self.env['ir.model']._get_id('sale.order')
+        today = fields.Date.context_today(self)
+        vals_list = []
+        for order_id, (user_id, low_sections) in low_margin_sections.items():
+            note = self._format_alert_note(low_sections, threshold)
+            summary = f'{len(low_sections)} section(s) below {threshold:.2f}% margin'
+            activity = existing.get(order_id)
+            if activity:
+                # The stored note is sanitized HTML: compare its text only
+                if activity.summary != summary or html2plaintext(activity.note or '') != html2plaintext(note):
+                    activity.write({'summary': summary, 'note': note})
+                continue
+            vals_list.append({
+                'res_model_id': res_model_id,
+                'res_id': order_id,
+                'activity_type_id': activity_type.id,
+                'summary': summary,
+                'note': note,
+                'user_id': user_id or self.env.uid,
+                'date_deadline': today,
+            })
+        if vals_list:
+            Activity.create(vals_list)
+        return len(low_margin_sections)
+
+    @api.model
+    def sweep(self, chunk_size=1000, commit=False):
+        """
+        Check the sections of all draft and sent quotations.
+
+        :param chunk_size: number of orders aggregated per query
+        :param commit: commit after each chunk (cron), so an interrupted run
+            keeps its progress
+        :return: number of orders with an alert, None when no threshold is set
+        """
+        threshold = self._get_threshold()
+        activity_type = self.env.ref('clasiccsales.mail_activity_type_margin_alert', raise_if_not_found=False)
+        if threshold is None or not activity_type:
+            return None
+
+        self.env.flush_all()
+        # Orders confirmed or cancelled since the last sweep lose their alert
+        self.env.cr.execute("""
+            SELECT a.id
+              FROM mail_activity a
+              JOIN sale_order so ON so.id = a.res_id
+             WHERE a.res_model = 'sale.order'
+               AND a.activity_type_id = %s
+               AND so.state NOT IN ('draft', 'sent')
+        """, [activity_type.id])
+        self.env['mail.activity'].browse([row[0] for row in self.env.cr.fetchall()]).unlink()
+
+        self.env.cr.execute("SELECT id FROM sale_order WHERE state IN ('draft', 'sent') ORDER BY id")
+        order_ids = [row[0] for row in self.env.cr.fetchall()]
+
+        alerts = 0
+        for start in range(0, len(order_ids), chunk_size):
+            chunk = order_ids[start:start + chunk_size]
+            alerts += self._sync_alert_activities(
+                chunk, self._get_low_margin_sections(chunk, threshold), activity_type, threshold)
+            if commit:
+                self.env.cr.commit()
+            self.env.invalidate_all()
+
+        _logger.info('Margin alert sweep: %s of %s open quotations below %s%%', alerts, len(order_ids), threshold)
+        return alerts
+
+    @api.model
+    def _cron_sweep(self):
+        self.sweep(commit=True)
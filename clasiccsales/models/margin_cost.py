@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+import functools
+
+from odoo import models, fields, api
+
+# Key of the unit cost cache in cr.cache: {(source, line_id): cost}. It only
+# exists while a cost scope is open, see `_unit_cost_scope`.
+COST_CACHE_KEY = 'clasiccsales.margin_unit_costs'
+
+
+def with_unit_cost_scope(method):
+    """Share the unit costs resolved during one call of a sale.order method"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.env['sale.order.margin.cost']._unit_cost_scope():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class MarginCostProvider(models.AbstractModel):
+    _name = 'sale.order.margin.cost'
+    _description = 'Margin Cost Provider'
+
+    # Unit costs used to compute and adjust section margins.
+    #
+    # The source is chosen with the `clasiccsales.margin_cost_source` system
+    # parameter. Each source is a `_get_unit_costs_<source>(lines)` method
+    # returning {line_id: unit cost} for a whole batch of lines, so other
+    # modules can add sources by inheriting this model.
+
+    @api.model
+    def _get_cost_source(self):
+        source = self.env['ir.config_parameter'].sudo().get_param('clasiccsales.margin_cost_source', 'line')
+        return source if hasattr(self, f'_get_unit_costs_{source}') else 'line'
+
+    @api.model
+    def _uses_line_margin(self):
+        """True when costs are the ones behind the stored `margin` of the lines"""
+        return self._get_cost_source() == 'line'
+
+    @api.model
+    @contextmanager
+    def _unit_cost_scope(self):
+        """
+        Cache the unit costs resolved inside the block.
+
+        A scope covers one adjustment: costs are never reused by a later call
+        on the same cursor (cron jobs, alert sweeps), so product cost or
+        vendor price changes made in between are always seen. Nested scopes
+        share the cache of the outermost one.
+        """
+        cache = self.env.cr.cache
+        if COST_CACHE_KEY in cache:
+            yield
+            return
+        cache[COST_CACHE_KEY] = {}
+        try:
+            yield
+        finally:
+            cache.pop(COST_CACHE_KEY, None)
+
+    @api.model
+    def get_unit_costs(self, lines):
+        """
+        Return the unit cost of product lines.
+
+        Costs are resolved for the whole batch at once. Inside a cost scope
+        they are kept until the scope ends, so repeated lookups on the same
+        lines are free.
+
+        :param lines: sale.order.line records
+        :return: dict {line_id: unit cost in the order currency}
+        """
+        source = self._get_cost_source()
+        cache = self.env.cr.cache.get(COST_CACHE_KEY)
+        if cache is None:
+            return getattr(self, f'_get_unit_costs_{source}')(lines)
+        missing = lines.filtered(lambda line: (source, line.id) not in cache)
+        if missing:
+            for line_id, cost in getattr(self, f'_get_unit_costs_{source}')(missing).items():
+                cache[(source, line_id)] = cost
+        return {line.id: cache.get((source, line.id), 0.0) for line in lines}
+
+    @api.model
+    def _invalidate_unit_costs(self, lines=None):
+        """Drop cached costs of these lines (all lines when None)"""
+        cache = self.env.cr.cache.get(COST_CACHE_KEY)
+        if not cache:
+            return
+        if lines is None:
+            cache.clear()
+            return
+        line_ids = set(lines.ids)
+        for key in [key for key in cache if key[1] in line_ids]:
+            del cache[key]
+
+    # ------------------------------------------------------------------
+    # Sources
+    # ------------------------------------------------------------------
+
+    @api.model
+    def _get_unit_costs_line(self, lines):
+        """Cost of the line, or the product cost when the line has none"""
+        # Iterating the recordset prefetches purchase_price and the products
+        # of all lines in one query each
+        return {
+            line.id: float(line.purchase_price or line.product_id.standard_price or 0.0)
+            for line in lines
+        }
+
+    @api.model
+    def _get_unit_costs_vendor(self, lines):
+        """Price of the most recent vendor pricelist entry, in the order currency"""
+        costs = self._get_unit_costs_line(lines)
+        products = lines.product_id
+        if not products:
+            return costs
+
+        # Variant-specific entries win over template entries; the most recent first
+        supplier_infos = self.env['product.supplierinfo'].search_fetch(
+            [('product_tmpl_id', 'in', products.product_tmpl_id.ids),
+             ('company_id', 'in', [False] + lines.company_id.ids)],
+            ['product_id', 'product_tmpl_id', 'price', 'currency_id', 'company_id'],
+            order='create_date desc, id desc',
+        )
+        by_variant = {}
+        by_template = {}
+        for info in supplier_infos:
+            if info.product_id:
+                by_variant.setdefault(info.product_id.id, info)
+            else:
+                by_template.setdefault(info.product_tmpl_id.id, info)
+
+        today = fields.Date.context_today(self)
+        for line in lines:
+            info = by_variant.get(line.product_id.id) or by_template.get(line.product_id.product_tmpl_id.id)
+            if not info:
+                continue
+            costs[line.id] = info.currency_id._convert(
+                info.price, line.currency_id, line.company_id, line.order_id.date_order or today)
+        return costs
+
+    @api.model
+    def _get_unit_costs_frozen(self, lines):
+        """Cost frozen on the line when the quotation was confirmed or locked"""
+        costs = self._get_unit_costs_line(lines)
+        for line in lines:
+            if line.frozen_unit_cost:
+                costs[line.id] = float(line.frozen_unit_cost)
+        return costs
@@ -20,12 +20,16 @@ class MarginHistory(models.Model):
         ('section', 'Section'),
         ('subsection', 'Subsection'),
         ('product', 'Product'),
+        ('order', 'Order'),
+        ('restore', 'Restore'),
+        ('target', 'Target'),
     ], string='Adjustment Type', required=True)
     
     section_name = fields.Char(string='Section Name')
     subsection_name = fields.Char(string='Subsection Name')
     line_id = fields.Many2one('sale.order.line', string='Product Line')
     product_name = fields.Char(string='Product Name')
+    restore_date = fields.Datetime(string='Restored To')
     
     old_margin_percent = fields.Float(string='Previous Margin (%)', digits=(16, 2))
     new_margin_percent = fields.Float(string='New Margin (%)', digits=(16, 2))
@@ -36,8 +40,12 @@ class MarginHistory(models.Model):
     # For sections: store all affected lines with their prices in JSON
     affected_lines = fields.Text(string='Affected Lines (JSON)')
     
-    create_date = fields.Datetime(string='Date', readonly=True)
+    create_date = fields.Datetime(string='Date', readonly=True, index=True)
     create_uid = fields.Many2one('res.users', string='Modified By', readonly=True)
+
+    # Stored for the margin KPIs, grouped without joining the orders
+    user_id = fields.Many2one(related='order_id.user_id', string='Salesperson', store=True, index=True)
+    team_id = fields.Many2one(related='order_id.team_id', string='Sales Team', store=True, index=True)
     
     @api.model
     def create_history(self, order_id, adjustment_type, old_data, new_data):
@@ -54,6 +62,15 @@ class MarginHistory(models.Model):
             vals['affected_lines'] = json.dumps(new_data.get('updated_lines', []))
             vals['old_price_unit'] = 0
             vals['new_price_unit'] = 0
+        elif adjustment_type in ('order', 'target'):
+            vals['affected_lines'] = json.dumps(new_data.get('updated_lines', []))
+            vals['old_price_unit'] = 0
+            vals['new_price_unit'] = 0
+        elif adjustment_type == 'restore':
+            vals['restore_date'] = old_data.get('restore_date')
+            vals['affected_lines'] = json.dumps(new_data.get('updated_lines', []))
+            vals['old_price_unit'] = 0
+            vals['new_price_unit'] = 0
         elif adjustment_type == 'subsection':
             vals['section_name'] = old_data.get('section_name', '')
             vals['subsection_name'] = old_data.get('subsection_name', '')
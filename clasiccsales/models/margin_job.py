@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api
+from odoo.tools import config
+from datetime import timedelta
+import json
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+class MarginJob(models.Model):
+    _name = 'sale.order.margin.job'
+    _description = 'Margin Adjustment Job'
+    _order = 'id desc'
+
+    order_id = fields.Many2one(
+        'sale.order',
+        string='Sale Order',
+        required=True,
+        ondelete='cascade'
+    )
+
+    job_type = fields.Selection([
+        ('section', 'Section'),
+        ('subsection', 'Subsection'),
+        ('product', 'Product'),
+        ('order', 'Order'),
+        ('rollback', 'Rollback'),
+        ('restore', 'Restore'),
+    ], string='Job Type', required=True)
+
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], string='Status', default='pending', required=True, index=True)
+
+    # Arguments passed to the sale.order method, stored as JSON
+    params = fields.Text(string='Parameters (JSON)')
+    # Dict returned by the sale.order method, stored as JSON
+    result = fields.Text(string='Result (JSON)')
+    message = fields.Char(string='Message')
+
+    create_date = fields.Datetime(string='Date', readonly=True)
+    create_uid = fields.Many2one('res.users', string='Requested By', readonly=True)
+
+    @api.model
+    def enqueue(self, order, job_type, params):
+        """Create a pending job and wake up the processing cron"""
+        job = self.create({
+            'order_id': order.id,
+            'job_type': job_type,
+            'params': json.dumps(params),
+        })
+        self.env.ref('clasiccsales.ir_cron_process_margin_jobs')._trigger()
+        return job
+
+    def get_status(self):
+        """Return the job status in the format polled by the client"""
+        self.ensure_one()
+        return {
+            'success': True,
+            'job_id': self.id,
+            'state': self.state,
+            'message': self.message or '',
+            'result': json.loads(self.result) if self.result else {},
+        }
+
+    def _run(self):
+        """Execute the adjustment as the user who requested it"""
+        self.ensure_one()
+        params = json.loads(self.params or '{}')
+        order = self.order_id.with_user(self.create_uid)
+        distribution = (params.get('strategy') or 'uniform', params.get('weights'), bool(params.get('constrained')))
+
+        if self.job_type == 'section' and params.get('section_line_id'):
+            return order.adjust_section_margin_by_id(
+                int(params['section_line_id']), float(params['target_margin_percent']), *distribution)
+        if self.job_type == 'section':
+            return order.adjust_section_margin(
+                params['section_name'], float(params['target_margin_percent']), *distribution)
+        if self.job_type == 'subsection' and params.get('subsection_line_id'):
+            return order.adjust_subsection_margin_by_id(
+                int(params['subsection_line_id']), float(params['target_margin_percent']), *distribution)
+        if self.job_type == 'subsection':
+            return order.adjust_subsection_margin(
+                params['section_name'], params['subsection_name'],
+                float(params['target_margin_percent']), *distribution)
+        if self.job_type == 'order':
+            return order.adjust_order_margin(
+                float(params['target_margin_percent']), params.get('section_weights'),
+                params.get('locked_section_ids'), bool(params.get('constrained')))
+        if self.job_type == 'product':
+            return order.adjust_product_margin(
+                int(params['line_id']), float(params['target_margin_percent']))
+        if self.job_type == 'rollback':
+            return order.rollback_margin(int(params['history_id']))
+        if self.job_type == 'restore':
+            return order.restore_margins_to(params.get('timestamp'), params.get('history_id'))
+        return {
+            'success': False,
+            'message': 'Unknown job type'
+        }
+
+    @api.model
+    def _get_stale_job_delay(self):
+        """Seconds after which a running job is considered abandoned: the cron time limit"""
+        limit = config['limit_time_real_cron']
+        if not limit or limit < 0:
+            limit = config['limit_time_real']
+        return max(int(limit or 0), 60)
+
+    @api.model
+    def _fail_stale_jobs(self):
+        """
+        Fail the jobs left running by a worker that was killed or timed out.
+
+        A job runs in a single transaction: a job still marked running after
+        the cron time limit will never finish. It is not requeued, the same
+        adjustment would most likely hit the limit again.
+        """
+        stale_jobs = self.search([
+            ('state', '=', 'running'),
+            ('write_date', '<', fields.Datetime.now() - timedelta(seconds=self._get_stale_job_delay())),
+        ])
+        if stale_jobs:
+            _logger.warning('Margin jobs %s were interrupted, marking them as failed', stale_jobs.ids)
+            stale_jobs.write({
+                'state': 'failed',
+                'message': 'Interrupted: the adjustment did not finish within the time limit.',
+            })
+        return stale_jobs
+
+    @api.model
+    def _cron_process_jobs(self, limit=20):
+        """Process pending jobs, committing after each one so their state is visible"""
+        self._fail_stale_jobs()
+        self.env.cr.commit()
+
+        jobs = self.search([('state', '=', 'pending')], order='id', limit=limit)
+
+        for job in jobs:
+            job.write({'state': 'running'})
+            self.env.cr.commit()
+
+            try:
+                with self.env.cr.savepoint():
+                    result = job._run()
+                job.write({
+                    'state': 'done' if result.get('success') else 'failed',
+                    'message': result.get('message', ''),
+                    'result': json.dumps(result, default=str),
+                })
+            except Exception as e:
+                _logger.exception('Error processing margin job %s', job.id)
+                job.write({
+                    'state': 'failed',
+                    'message': f'Error: {str(e)}',
+                })
+            self.env.cr.commit()
+
+        # More jobs than the batch size: schedule another run right away
+        if len(jobs) == limit:
+            self.env.ref('clasiccsales.ir_cron_process_margin_jobs')._trigger()
+
+        # Drop finished jobs older than a week
+        self.search([
+            ('state', 'in', ('done', 'failed')),
+            ('create_date', '<', fields.Datetime.now() - timedelta(days=7)),
+        ]).unlink()
@@ -1,8 +1,46 @@
 # -*- coding: utf-8 -*-
 
-from odoo import models, fields, api
+from odoo import models, fields, api, Command
+from markupsafe import escape
+from urllib.parse import urlencode
+from collections import OrderedDict
 import json
 import math
+import threading
+
+from .margin_cost import with_unit_cost_scope
+from ..tools.margin_solver import distribute_within_bounds
+from ..tools.margin_tree import MarginTree, build_margin_tree, margin_percent
+from .sale_order_line import MARGIN_GROUP_DEPTHS
+
+# Process-wide cache of margin trees: {order_id: {'version', 'tree', 'index'}}
+# Entries are only reused while their version token matches the database.
+_MARGIN_TREE_CACHE = OrderedDict()
+_MARGIN_TREE_CACHE_SIZE = 128
+_MARGIN_TREE_LOCK = threading.RLock()
+
+# Rendered margins tab per order: {order_id: (etag, html)}
+_MARGIN_HTML_CACHE = OrderedDict()
+
+# Trees patched by single-line edits of the current transaction, kept in
+# cr.postcommit.data and only moved to the process cache once it commits
+_MARGIN_TREE_PATCHES = 'clasiccsales.margin_tree_patches'
+
+# Line columns hashed into the margin version token
+_MARGIN_VERSION_ROW = """concat_ws(':', id, write_date, sequence, display_type,
+                                 price_unit, product_uom_qty, discount, purchase_price)"""
+
+# 60-bit hash of a line row. The version token is the sum of the hashes of
+# all lines of the order, modulo _MARGIN_VERSION_MODULO: editing one line
+# moves it by the difference of that line's hashes, without rehashing the
+# rest of the order.
+_MARGIN_ROW_HASH = f"('x' || substr(md5({_MARGIN_VERSION_ROW}), 1, 15))::bit(60)::bigint"
+_MARGIN_VERSION_MODULO = 2 ** 64
+
+
+def _format_margin_version(total):
+    """Return the version token of a sum of line hashes"""
+    return format(int(total) % _MARGIN_VERSION_MODULO, '016x')
 
 
 class SaleOrder(models.Model):
@@ -21,6 +59,39 @@ class SaleOrder(models.Model):
         sanitize=False,
     )
     
+    # Large orders render the margins tab with a virtualized table that
+    # loads product rows on demand instead of the full HTML table
+    section_margins_large = fields.Boolean(
+        string='Large Margin Tree',
+        compute='_compute_section_margins_large',
+        store=False,
+    )
+
+    # Compact JSON margin tree stored when the order is confirmed or locked;
+    # the margins tab is served from it until the order is unlocked or one
+    # of its lines is edited
+    section_margins_frozen = fields.Text(
+        string='Frozen Margins by Section',
+        copy=False,
+        readonly=True,
+    )
+
+    @api.depends('order_line')
+    def _compute_section_margins_large(self):
+        threshold = int(self.env['ir.config_parameter'].sudo().get_param(
+            'clasiccsales.margin_virtual_table_threshold', 500))
+        saved_orders = self.filtered('id')
+        counts = {}
+        if saved_orders:
+            counts = {
+                order.id: count
+                for order, count in self.env['sale.order.line']._read_group(
+                    [('order_id', 'in', saved_orders.ids), ('display_type', '=', False)],
+                    ['order_id'], ['__count'],
+                )
+            }
+        for order in self:
+            order.section_margins_large = counts.get(order.id, 0) > threshold
 
     @api.depends('order_line', 'order_line.margin', 'order_line.margin_percent',
                  'order_line.display_type', 'order_line.price_subtotal',
@@ -29,7 +100,7 @@ class SaleOrder(models.Model):
     def _compute_section_margins_json(self):
         """Calculate margins grouped by section and subsection"""
         for order in self:
-            order.section_margins_json = json.dumps(order._get_section_margins())
+            order.section_margins_json = order._get_margin_tree().to_json()
     
     @api.depends('order_line', 'order_line.margin', 'order_line.margin_percent',
                  'order_line.display_type', 'order_line.price_subtotal',
@@ -40,14 +111,30 @@ class SaleOrder(models.Model):
         """Generate HTML to display margins"""
         for order in self:
             try:
-                margins_html = order._generate_margins_html()
+                # Nothing changed since the last rendering: reuse it
+                etag = order._get_margin_etag() if order.id else None
+                with _MARGIN_TREE_LOCK:
+                    cached = _MARGIN_HTML_CACHE.get(order.id) if etag else None
+                if cached and cached[0] == etag:
+                    order.section_margins_html = cached[1]
+                    continue
+
+                # Large orders: the margin table is rendered client-side
+                margins_html = '' if order.section_margins_large else order._generate_margins_html()
                 # Append history HTML if order is saved
                 if order.id:
                     # Compute history HTML (without depends, calculated on demand)
-                    history_html = order._generate_margin_history_html()
+                    history_html = order._generate_margin_history_html(order._get_margin_version())
                     # Always append history section (even if empty message)
                     margins_html += history_html
                 order.section_margins_html = margins_html
+
+                if etag:
+                    with _MARGIN_TREE_LOCK:
+                        _MARGIN_HTML_CACHE[order.id] = (etag, margins_html)
+                        _MARGIN_HTML_CACHE.move_to_end(order.id)
+                        while len(_MARGIN_HTML_CACHE) > _MARGIN_TREE_CACHE_SIZE:
+                            _MARGIN_HTML_CACHE.popitem(last=False)
             except Exception as e:
                 # In case of error, show error message
                 import logging
@@ -60,173 +147,608 @@ class SaleOrder(models.Model):
                     </div>
                 """
 
-    def _get_section_margins(self):
+    @with_unit_cost_scope
+    def _refresh_section_margins(self):
+        """Recompute margin fields after prices were changed programmatically"""
+        self._compute_section_margins_json()
+        self._compute_section_margins_html()
+
+    # ------------------------------------------------------------------
+    # Persistent target margins
+    # ------------------------------------------------------------------
+    # Section lines can carry a target margin. With the system parameter
+    # `clasiccsales.margin_target_mode` set to 'save', line edits only collect
+    # the changed lines; once per save (or at commit at the latest) the
+    # sections they belong to are repriced back to their targets, all in a
+    # single write per order.
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        orders = super().create(vals_list)
+        self._flush_margin_targets()
+        return orders
+
+    def write(self, vals):
+        result = super().write(vals)
+        self._flush_margin_targets()
+        return result
+
+    @api.model
+    def _margin_targets_enforced(self):
+        """Return True if section targets are re-applied on save"""
+        return self.env['ir.config_parameter'].sudo().get_param('clasiccsales.margin_target_mode', 'off') == 'save'
+
+    def _mark_margin_targets(self, lines=None):
+        """
+        Register changed lines for the next target enforcement.
+
+        :param lines: sale.order.line records that changed, None when the
+            section structure changed and every target must be checked
+        """
+        if self.env.context.get('skip_margin_targets') or not self._margin_targets_enforced():
+            return
+        precommit = self.env.cr.precommit
+        pending = precommit.data.get('clasiccsales.margin_target_lines')
+        if pending is None:
+            pending = precommit.data['clasiccsales.margin_target_lines'] = {}
+            env = self.env
+
+            @precommit.add
+            def flush_margin_targets():
+                env['sale.order']._flush_margin_targets()
+
+        if lines is None:
+            for order_id in self.ids:
+                pending.setdefault(order_id, set()).add(None)
+            return
+        for line in lines:
+            if line.order_id.id:
+                pending.setdefault(line.order_id.id, set()).add(line.id)
+
+    @api.model
+    def _flush_margin_targets(self):
+        """Re-apply the targets of every section collected since the last flush"""
+        pending = self.env.cr.precommit.data.get('clasiccsales.margin_target_lines')
+        if not pending:
+            return
+        changes = list(pending.items())
+        pending.clear()
+        for order_id, line_ids in changes:
+            order = self.browse(order_id).exists()
+            if order and order.state in ('draft', 'sent'):
+                order.with_context(skip_margin_targets=True)._enforce_margin_targets(line_ids)
+
+    @with_unit_cost_scope
+    def _enforce_margin_targets(self, changed_line_ids):
+        """
+        Reprice the sections with a target that contain changed lines.
+
+        Each product line follows the target of the innermost section above
+        it that has one, found in one pass over the order lines. Sections
+        already at their target are left alone; the others are solved
+        separately and written together.
+
+        :param changed_line_ids: set of changed line IDs, containing None to
+            check every section of the order
+        :return: list of dicts describing the lines whose price changed
+        """
         self.ensure_one()
-        
-        sections_data = []
-        current_section = None
-        current_subsection = None
-        total_margin = 0.0
-        total_price_subtotal = 0.0
-        
+        import logging
+        _logger = logging.getLogger(__name__)
+
+        # Open sections: [(level, innermost section line with a target)]
+        stack = []
+        target_lines = {}
+        product_target = {}
         for line in self.order_line:
-            # Identify section
-            if line.display_type == 'line_section':
-                # Save previous section if exists
-                if current_section:
-                    # First, save any active subsection belonging to the previous section
-                    if current_subsection:
-                        subsection_price = current_subsection.get('price_subtotal', 0.0)
-                        subsection_margin = current_subsection.get('margin', 0.0)
-                        if subsection_price > 0 and subsection_margin != 0:
-                            current_subsection['margin_percent'] = (
-                                subsection_margin / subsection_price
-                            ) * 100
-                        else:
-                            current_subsection['margin_percent'] = 0.0
-                        current_section['subsections'].append(current_subsection)
-                        current_subsection = None
-
-                    # Then, calculate final percentage of the section
-                    section_price = current_section.get('price_subtotal', 0.0)
-                    section_margin = current_section.get('margin', 0.0)
-                    if section_price > 0 and section_margin != 0:
-                        current_section['margin_percent'] = (
-                            section_margin / section_price
-                        ) * 100
-                    else:
-                        current_section['margin_percent'] = 0.0
-                    sections_data.append(current_section)
-                
-                # Create new section
-                current_section = {
-                    'name': line.name or 'Unnamed',
-                    'margin': 0.0,
-                    'margin_percent': 0.0,
-                    'price_subtotal': 0.0,
-                    'subsections': [],
-                    'products': [],  # Products directly under section
-                }
-                current_subsection = None
-            
-            # Identify subsection
-            elif line.display_type == 'line_subsection':
-                # Save previous subsection if exists
-                if current_subsection and current_section:
-                    # Calculate final percentage of the subsection
-                    subsection_price = current_subsection.get('price_subtotal', 0.0)
-                    if subsection_price > 0:
-                        current_subsection['margin_percent'] = (
-                            current_subsection['margin'] / subsection_price
-                        ) * 100
-                    current_section['subsections'].append(current_subsection)
-                
-                # Create new subsection
-                current_subsection = {
-                    'name': line.name or 'Unnamed',
-                    'margin': 0.0,
-                    'margin_percent': 0.0,
-                    'price_subtotal': 0.0,
-                    'products': [],  # Products in this subsection
-                }
-            
-            # Normal product line
-            elif line.display_type == False and line.product_id:
-                # Get line price
-                line_price_subtotal = line.price_subtotal if line.price_subtotal else 0.0
-                
-                # Get line margin (use margin field if available)
-                line_margin = 0.0
-                line_margin_percent = 0.0
-                try:
-                    # Try to get margin from margin field (if sale_margin is installed)
-                    if hasattr(line, 'margin') and line.margin is not None:
-                        line_margin = float(line.margin)
-                    elif line_price_subtotal > 0:
-                        # If no margin calculated, calculate it manually
-                        cost = 0.0
-                        # Try to get purchase_price from line
-                        if hasattr(line, 'purchase_price') and line.purchase_price:
-                            cost = float(line.purchase_price) * float(line.product_uom_qty)
-                        # Otherwise, use product standard cost
-                        elif hasattr(line.product_id, 'standard_price') and line.product_id.standard_price:
-                            cost = float(line.product_id.standard_price) * float(line.product_uom_qty)
-                        
-                        line_margin = float(line_price_subtotal) - cost
-                    
-                    # Calculate margin percent for this line
-                    if line_price_subtotal > 0:
-                        line_margin_percent = (line_margin / line_price_subtotal) * 100
-                        
-                except (ValueError, TypeError, AttributeError):
-                    # If error, margin will be 0
-                    line_margin = 0.0
-                    line_margin_percent = 0.0
-                
-                # Only process if there is a price
-                if line_price_subtotal > 0:
-                    # Create product data
-                    product_data = {
-                        'line_id': line.id,
-                        'name': line.name or (line.product_id.name if line.product_id else 'Unnamed'),
-                        'margin': line_margin,
-                        'margin_percent': line_margin_percent,
-                    }
-                    
-                    # Add to subsection if exists
-                    if current_subsection and current_section:
-                        current_subsection['margin'] += line_margin
-                        current_subsection['price_subtotal'] += line_price_subtotal
-                        current_subsection['products'].append(product_data)
-                    # Add to section's direct products if no subsection
-                    elif current_section:
-                        current_section['products'].append(product_data)
-                    
-                    # Add to section if exists
-                    if current_section:
-                        current_section['margin'] += line_margin
-                        current_section['price_subtotal'] += line_price_subtotal
-                    
-                    # Add to general totals
-                    total_margin += line_margin
-                    total_price_subtotal += line_price_subtotal
-        
-        # Save last subsection if exists
-        if current_subsection and current_section:
-            # Calculate final percentage of the subsection
-            subsection_price = current_subsection.get('price_subtotal', 0.0)
-            subsection_margin = current_subsection.get('margin', 0.0)
-            if subsection_price > 0 and subsection_margin != 0:
-                current_subsection['margin_percent'] = (
-                    subsection_margin / subsection_price
-                ) * 100
-            else:
-                current_subsection['margin_percent'] = 0.0
-            current_section['subsections'].append(current_subsection)
-        
-        # Save last section if exists
-        if current_section:
-            # Calculate final percentage of the section
-            section_price = current_section.get('price_subtotal', 0.0)
-            section_margin = current_section.get('margin', 0.0)
-            if section_price > 0 and section_margin != 0:
-                current_section['margin_percent'] = (
-                    section_margin / section_price
-                ) * 100
-            else:
-                current_section['margin_percent'] = 0.0
-            sections_data.append(current_section)
-        
-        # Calculate total margin percentage
-        total_margin_percent = 0.0
-        if total_price_subtotal > 0 and total_margin != 0:
-            total_margin_percent = (total_margin / total_price_subtotal) * 100
-        
+            if line.display_type in MARGIN_GROUP_DEPTHS:
+                while stack and stack[-1][0] >= line.margin_depth:
+                    stack.pop()
+                parent_target = stack[-1][1] if stack else None
+                stack.append((line.margin_depth, line if line.margin_target_percent else parent_target))
+            elif not line.display_type and line.product_id and stack and stack[-1][1]:
+                target = stack[-1][1]
+                target_lines.setdefault(target, []).append(line)
+                product_target[line.id] = target
+
+        if None in changed_line_ids:
+            targets = set(target_lines)
+        else:
+            targets = {product_target[line_id] for line_id in changed_line_ids if line_id in product_target}
+            targets.update(target for target in target_lines if target.id in changed_line_ids)
+        if not targets:
+            return []
+
+        cost_provider = self.env['sale.order.margin.cost']
+        lines_to_update = self.env['sale.order.line']
+        new_prices = []
+        for target in sorted(targets, key=lambda l: (l.sequence, l.id)):
+            lines = self.env['sale.order.line'].concat(*target_lines[target])
+            unit_costs = cost_provider.get_unit_costs(lines)
+            subtotal = sum(float(line.price_subtotal or 0.0) for line in lines)
+            cost = sum(unit_costs[line.id] * float(line.product_uom_qty or 0.0) for line in lines)
+            if subtotal > 0 and abs((subtotal - cost) / subtotal * 100 - target.margin_target_percent) < 0.01:
+                continue
+            solution = self._solve_line_prices(lines, target.margin_target_percent)
+            if not solution['success']:
+                _logger.warning('Target margin of section "%s" not applied: %s', target.name, solution['message'])
+                continue
+            lines_to_update += lines
+            new_prices += solution['new_prices']
+
+        if not lines_to_update:
+            return []
+        old_margin_percent = self._get_margin_tree().total_margin_percent
+        updated_lines = self._apply_line_prices(lines_to_update, new_prices)
+        if updated_lines:
+            self._save_margin_history('target', {
+                'margin_percent': old_margin_percent,
+            }, {
+                'margin_percent': self._get_margin_tree().total_margin_percent,
+                'updated_lines': updated_lines,
+            })
+            self._notify_margin_change([line['line_id'] for line in updated_lines])
+        return updated_lines
+
+    def _get_section_margins(self):
+        """
+        Return the margin tree of the order as a dict.
+
+        :return: dict with sections, subsections, products and totals, built
+            from _get_margin_tree() on each call
+        """
+        self.ensure_one()
+        return self._get_margin_tree().to_dict()
+
+    def _get_margin_tree(self):
+        """
+        Return the margin tree of the order as MarginTree nodes.
+
+        Saved orders are served from a process cache keyed by the margin
+        version token; single-line price edits patch a copy of the cached
+        tree (see _apply_margin_delta) instead of rebuilding it.
+        The returned tree is shared and must be treated as read-only.
+        """
+        self.ensure_one()
+        if not self.id:
+            return self._build_margin_tree()
+
+        version = self._get_margin_version()
+        if self.section_margins_frozen:
+            # Confirmed/locked order: no line scan at all. The token is taken
+            # live since writes that do not affect margins still change it.
+            tree = MarginTree.from_dict(json.loads(self.section_margins_frozen))
+            tree.version = version
+            return tree
+
+        if not self.env['sale.order.margin.cost']._uses_line_margin():
+            # Costs from other sources can change without touching the
+            # lines, the version token cannot validate a cached tree
+            return self._build_margin_tree(version)
+
+        patches = self.env.cr.postcommit.data.get(_MARGIN_TREE_PATCHES)
+        patched = patches.get(self.id) if patches else None
+        if patched:
+            if patched['version'] == version:
+                return patched['tree']
+            # Lines changed since without a delta: never publish this tree
+            del patches[self.id]
+
+        with _MARGIN_TREE_LOCK:
+            cached = _MARGIN_TREE_CACHE.get(self.id)
+            if cached and cached['version'] == version:
+                _MARGIN_TREE_CACHE.move_to_end(self.id)
+                return cached['tree']
+
+        tree = self._build_margin_tree(version)
+        self._store_margin_tree(tree)
+        return tree
+
+    def _freeze_section_margins(self):
+        """Store the current margin tree and unit costs of confirmed or locked orders"""
+        orders = self.filtered(lambda o: o.state == 'sale' or o.locked)
+        lines = orders.order_line.filtered(
+            lambda l: not l.display_type and l.product_id and not l.frozen_unit_cost)
+
+        # One write per distinct cost instead of one per line
+        line_ids_by_cost = {}
+        for line_id, cost in self.env['sale.order.margin.cost']._get_unit_costs_line(lines).items():
+            line_ids_by_cost.setdefault(cost, []).append(line_id)
+        SaleOrderLine = self.env['sale.order.line'].with_context(skip_margin_deltas=True, skip_margin_targets=True)
+        for cost, line_ids in line_ids_by_cost.items():
+            SaleOrderLine.browse(line_ids).write({'frozen_unit_cost': cost})
+
+        for order in orders:
+            order.section_margins_frozen = order._build_margin_tree().to_json()
+
+    def _unfreeze_section_margins(self):
+        """Drop the frozen margin tree, margins are computed live again"""
+        frozen_orders = self.filtered('section_margins_frozen')
+        if frozen_orders:
+            frozen_orders.section_margins_frozen = False
+
+    def action_confirm(self):
+        result = super().action_confirm()
+        self._freeze_section_margins()
+        return result
+
+    def action_lock(self):
+        result = super().action_lock()
+        self._freeze_section_margins()
+        return result
+
+    def action_unlock(self):
+        result = super().action_unlock()
+        self._unfreeze_section_margins()
+        return result
+
+    def action_export_section_margins(self, file_format='xlsx'):
+        """Download the section margin breakdown of the selected orders"""
+        return {
+            'type': 'ir.actions.act_url',
+            'url': '/sale_order/section_margins/export?%s' % urlencode({
+                'order_ids': ','.join(str(order_id) for order_id in self.ids),
+                'file_format': file_format,
+            }),
+            'target': 'download',
+        }
+
+    def _get_section_margins_summary(self):
+        """
+        Return the margin tree without product rows.
+
+        Groups at every level keep their totals and get a product count,
+        so large orders can be displayed collapsed without loading any
+        product detail.
+        """
+        self.ensure_one()
+        tree = self._get_margin_tree()
+
+        def summarize(node):
+            return {
+                'line_id': node.line_id,
+                'name': node.name,
+                'margin': node.margin,
+                'margin_percent': node.margin_percent,
+                'price_subtotal': node.price_subtotal,
+                'product_count': len(node.products),
+                'subsections': [summarize(sub) for sub in node.subsections],
+            }
+
+        return {
+            'sections': [summarize(section) for section in tree.sections],
+            'total_margin': tree.total_margin,
+            'total_margin_percent': tree.total_margin_percent,
+            'total_price_subtotal': tree.total_price_subtotal,
+            'version': tree.version,
+        }
+
+    def _get_margin_bus_delta(self, line_ids=None):
+        """
+        Compact margin update pushed to other sessions after an adjustment.
+
+        :param line_ids: IDs of the product lines whose price changed, sent
+            along with the groups so their rows can be patched too
+        """
+        self.ensure_one()
+        summary = self._get_section_margins_summary()
+        products = []
+        if line_ids:
+            index = self._get_margin_tree().index()
+            for line_id in dict.fromkeys(line_ids):
+                if line_id in index:
+                    product = index[line_id][0]
+                    products.append({
+                        'line_id': line_id,
+                        'margin': product.margin,
+                        'margin_percent': product.margin_percent,
+                    })
+
+        def compact(node):
+            return {
+                'line_id': node['line_id'],
+                'margin': node['margin'],
+                'margin_percent': node['margin_percent'],
+                'subsections': [compact(sub) for sub in node['subsections']],
+            }
+
         return {
-            'sections': sections_data,
-            'total_margin': total_margin,
-            'total_margin_percent': total_margin_percent,
+            'order_id': self.id,
+            'version': summary['version'],
+            'total_margin': summary['total_margin'],
+            'total_margin_percent': summary['total_margin_percent'],
+            'sections': [compact(section) for section in summary['sections']],
+            'products': products,
         }
+
+    def _notify_margin_change(self, line_ids=None):
+        """
+        Publish the new section margins on the bus.
+
+        Bus notifications are only dispatched once the transaction commits,
+        so open margin tabs never receive values that were rolled back.
+
+        :param line_ids: IDs of the product lines whose price changed
+        """
+        for order in self:
+            try:
+                self.env['bus.bus']._sendone(
+                    (order, 'margins'), 'clasiccsales/margin_delta', order._get_margin_bus_delta(line_ids))
+            except Exception as e:
+                # Live updates are a convenience: never fail the adjustment
+                import logging
+                _logger = logging.getLogger(__name__)
+                _logger.warning(f'Error publishing margin update: {str(e)}')
+
+    def _get_section_margin_products(self, section_line_id, subsection_line_id=None):
+        """
+        Return the product rows of one section or of a group nested in it.
+
+        :param section_line_id: ID of the section line
+        :param subsection_line_id: ID of the nested group line (any level),
+            None for the products placed directly under the section
+        :return: list of product dicts
+        """
+        self.ensure_one()
+        group = self._get_margin_tree().find_group(section_line_id, subsection_line_id)
+        if not group:
+            return []
+        return [product.to_dict() for product in group.products]
+
+    def _store_margin_tree(self, tree):
+        """Keep a margin tree in the cache along with its line index"""
+        self.ensure_one()
+        index = tree.index()
+        with _MARGIN_TREE_LOCK:
+            _MARGIN_TREE_CACHE[self.id] = {
+                'version': tree.version,
+                'tree': tree,
+                'index': index,
+            }
+            _MARGIN_TREE_CACHE.move_to_end(self.id)
+            while len(_MARGIN_TREE_CACHE) > _MARGIN_TREE_CACHE_SIZE:
+                _MARGIN_TREE_CACHE.popitem(last=False)
+
+    def _invalidate_margin_trees(self):
+        """Drop the cached and patched margin trees of these orders"""
+        patches = self.env.cr.postcommit.data.get(_MARGIN_TREE_PATCHES)
+        with _MARGIN_TREE_LOCK:
+            for order_id in self.ids:
+                _MARGIN_TREE_CACHE.pop(order_id, None)
+                if patches:
+                    patches.pop(order_id, None)
+
+    def _get_patched_margin_trees(self):
+        """
+        Return the trees patched by the current transaction: {order_id: entry}.
+
+        They replace the entries of the process cache only once the
+        transaction commits, so a rollback leaves no patched amounts behind.
+        """
+        postcommit = self.env.cr.postcommit
+        patches = postcommit.data.get(_MARGIN_TREE_PATCHES)
+        if patches is None:
+            patches = postcommit.data[_MARGIN_TREE_PATCHES] = {}
+
+            @postcommit.add
+            def publish_margin_trees():
+                with _MARGIN_TREE_LOCK:
+                    for order_id, entry in patches.items():
+                        _MARGIN_TREE_CACHE[order_id] = entry
+                        _MARGIN_TREE_CACHE.move_to_end(order_id)
+                    while len(_MARGIN_TREE_CACHE) > _MARGIN_TREE_CACHE_SIZE:
+                        _MARGIN_TREE_CACHE.popitem(last=False)
+
+        return patches
+
+    def _get_margin_tree_to_patch(self):
+        """
+        Return the cache entry to patch for a line edit, None if there is none.
+
+        A tree this transaction already patched is patched again; a tree of
+        the process cache is copied first, other transactions keep reading
+        the original. The entry is not checked against the order lines: an
+        outdated one gets a token that never matches, see _apply_margin_delta.
+        """
+        self.ensure_one()
+        patches = self.env.cr.postcommit.data.get(_MARGIN_TREE_PATCHES)
+        if patches and self.id in patches:
+            return patches.pop(self.id)
+        with _MARGIN_TREE_LOCK:
+            cached = _MARGIN_TREE_CACHE.get(self.id)
+        if not cached:
+            return None
+        tree = cached['tree'].copy()
+        return {
+            'version': cached['version'],
+            'tree': tree,
+            'index': tree.index(),
+        }
+
+    def _get_margin_row_hash(self, line):
+        """Return the hash of a line in the version token, as in the database"""
+        line.flush_recordset()
+        self.env.cr.execute(f"""
+            SELECT {_MARGIN_ROW_HASH}
+              FROM sale_order_line
+             WHERE id = %s
+        """, [line.id])
+        return self.env.cr.fetchone()[0]
+
+    def _apply_margin_delta(self, entry, line, old_margin, old_subtotal, old_hash):
+        """
+        Patch a margin tree with the old-to-new delta of one edited line.
+
+        The version token of the entry is moved by the difference between
+        the old and new hash of the edited row, so the write costs one
+        single-row query whatever the size of the order. A tree that was
+        already outdated before the write ends up with a token that matches
+        no state of the order, and is rebuilt on the next read. Only the
+        groups (at every level) containing the line and the grand total are
+        touched. The tree is dropped (full rebuild on next read) when the
+        line enters or leaves it.
+
+        :param entry: cache entry returned by _get_margin_tree_to_patch
+        :param line: sale.order.line record that was written
+        :param old_margin: margin of the line before the write
+        :param old_subtotal: subtotal of the line before the write
+        :param old_hash: _get_margin_row_hash of the line before the write
+        :return: True if the patched tree was kept
+        """
+        self.ensure_one()
+        if not entry['version']:
+            return False
+        new_hash = self._get_margin_row_hash(line)
+        version = _format_margin_version(int(entry['version'], 16) - old_hash + new_hash)
+
+        tree = entry['tree']
+        index = entry['index']
+        new_subtotal = float(line.price_subtotal or 0.0)
+        new_margin = float(line.margin or 0.0)
+        in_tree = line.id in index
+        # Lines that were not in the tree and still are not only matter if
+        # they do not belong to a section (grand total)
+        if in_tree != (new_subtotal > 0) or (not in_tree and old_subtotal > 0):
+            return False
+
+        if in_tree:
+            margin_delta = new_margin - old_margin
+            subtotal_delta = new_subtotal - old_subtotal
+            product, nodes = index[line.id]
+            product.margin = new_margin
+            product.price_subtotal = new_subtotal
+            for node in nodes:
+                node.margin += margin_delta
+                node.price_subtotal += subtotal_delta
+
+            tree.total_margin += margin_delta
+            tree.total_price_subtotal += subtotal_delta
+
+        tree.version = entry['version'] = version
+        self._get_patched_margin_trees()[self.id] = entry
+        return True
+
+    def _build_margin_tree(self, version=None):
+        """
+        Build the margin tree from scratch in a single pass over the order lines.
+
+        The grouping rules live in tools.margin_tree.build_margin_tree, shared
+        with the client engine; this only feeds it the line values, with the
+        margin of each product over the configured cost source.
+        """
+        self.ensure_one()
+
+        cost_provider = self.env['sale.order.margin.cost']
+        unit_costs = None
+        if not cost_provider._uses_line_margin():
+            unit_costs = cost_provider.get_unit_costs(
+                self.order_line.filtered(lambda l: not l.display_type and l.product_id))
+
+        def line_values():
+            for line in self.order_line:
+                values = {
+                    # Unsaved lines have no id that can be serialized
+                    'id': line._origin.id or None,
+                    'display_type': line.display_type,
+                    'margin_depth': line.margin_depth,
+                    'name': line.name,
+                }
+                if not line.display_type and line.product_id:
+                    price_subtotal = line.price_subtotal or 0.0
+                    # Stored line margin, or the margin over the configured cost source
+                    if unit_costs is None:
+                        margin = float(line.margin or 0.0)
+                    else:
+                        margin = float(price_subtotal) - unit_costs.get(line.id, 0.0) * float(line.product_uom_qty or 0.0)
+                    values.update(
+                        name=line.name or line.product_id.name,
+                        product_id=line.product_id.id,
+                        price_subtotal=price_subtotal,
+                        margin=margin,
+                    )
+                yield values
+
+        return build_margin_tree(
+            line_values(), version if version is not None else self._get_margin_version())
+
+    def _get_margin_version(self):
+        """
+        Return a token identifying the current state of the order lines.
+
+        The token changes whenever a line is added, removed or modified, so
+        clients can send it back with an adjustment request to prove the
+        margins they were looking at are still current.
+        """
+        self.ensure_one()
+        if not self.id:
+            return ''
+        # Pending ORM writes must reach the database before hashing
+        self.env['sale.order.line'].flush_model()
+        self.env.cr.execute(f"""
+            SELECT sum({_MARGIN_ROW_HASH}), count(*)
+              FROM sale_order_line
+             WHERE order_id = %s
+        """, [self.id])
+        total, count = self.env.cr.fetchone()
+        return _format_margin_version(total) if count else ''
+
+    def _use_async_margin_job(self, async_mode=None):
+        """
+        Decide whether an adjustment should run as a background job.
+
+        :param async_mode: True/False to force a mode, None to decide by order size
+        :return: True if the adjustment must be queued
+        """
+        self.ensure_one()
+        if async_mode is not None:
+            return bool(async_mode)
+        threshold = int(self.env['ir.config_parameter'].sudo().get_param(
+            'clasiccsales.margin_async_line_threshold', 1000))
+        line_count = self.env['sale.order.line'].search_count([
+            ('order_id', '=', self.id),
+            ('display_type', '=', False),
+        ])
+        return line_count > threshold
+
+    def _get_margin_etag(self):
+        """
+        Return a cheap validator for everything shown in the margins tab.
+
+        Combines the line version token with the head of the margin history,
+        so clients and the HTML cache can skip regeneration when it matches.
+        Empty (never matches) when costs do not come from the lines: vendor
+        prices can change without touching the order, as in _get_margin_tree.
+        """
+        self.ensure_one()
+        if not self.id or not self.env['sale.order.margin.cost']._uses_line_margin():
+            return ''
+        self.env['sale.order.margin.history'].flush_model(['order_id'])
+        self.env.cr.execute("""
+            SELECT count(*), max(id)
+              FROM sale_order_margin_history
+             WHERE order_id = %s
+        """, [self.id])
+        history_count, history_head = self.env.cr.fetchone()
+        return f'{self._get_margin_version()}-{history_count}-{history_head or 0}'
+
+    def _check_margin_version(self, margin_version):
+        """
+        Reject requests built from outdated margin data.
+
+        :param margin_version: Token received from the client (optional)
+        :return: error dict if the token is stale, None otherwise
+        """
+        self.ensure_one()
+        if not margin_version:
+            # Clients that do not send a token are not checked
+            return None
+        if margin_version != self._get_margin_version():
+            return {
+                'success': False,
+                'stale': True,
+                'message': 'The order lines have changed since the margins were loaded. Please reload the page and try again.'
+            }
+        return None
     
     def _generate_margins_html(self):
         """Generate HTML to display margins in a table"""
@@ -235,6 +757,7 @@ class SaleOrder(models.Model):
         sections = margins_data.get('sections', [])
         total_margin = margins_data.get('total_margin', 0.0)
         total_margin_percent = margins_data.get('total_margin_percent', 0.0)
+        margin_version = margins_data.get('version', '')
         
         # Get currency symbol
         currency_symbol = self.currency_id.symbol if self.currency_id else '$'
@@ -249,7 +772,7 @@ class SaleOrder(models.Model):
             """
         
         html = f"""
-        <div class="section_margin_widget_container">
+        <div class="section_margin_widget_container" data-margin-version="{margin_version}">
             <div class="table-responsive">
                 <table class="table table-hover margins-table">
                     <thead>
@@ -264,7 +787,8 @@ class SaleOrder(models.Model):
         """
         
         for idx, section in enumerate(sections):
-            section_name = section.get('name', 'Unnamed')
+            section_name = escape(section.get('name', 'Unnamed'))
+            section_line_id = section.get('line_id') or 0
             section_margin = section.get('margin', 0.0)
             section_margin_percent = section.get('margin_percent', 0.0)
             subsections = section.get('subsections', [])
@@ -272,7 +796,7 @@ class SaleOrder(models.Model):
             
             # Section header row
             html += f"""
-                        <tr class="section-row">
+                        <tr class="section-row" data-margin-node="{section_line_id}">
                             <td class="text-start" colspan="2">
                                 <span class="section-badge">
                                     <i class="fa fa-folder-open"></i>
@@ -287,6 +811,7 @@ class SaleOrder(models.Model):
                                     <input type="number" 
                                            class="section_margin_input" 
                                            data-order-id="{self.id}"
+                                           data-section-id="{section_line_id}"
                                            data-section-name="{section_name}"
                                            data-current-margin="{section_margin_percent:.2f}"
                                            value="{section_margin_percent:.2f}" 
@@ -297,6 +822,7 @@ class SaleOrder(models.Model):
                                     <button type="button"
                                             class="btn btn-sm btn-primary apply_margin_btn" 
                                             data-order-id="{self.id}"
+                                            data-section-id="{section_line_id}"
                                             data-section-name="{section_name}">
                                         <i class="fa fa-check"></i>Apply
                                     </button>
@@ -305,104 +831,19 @@ class SaleOrder(models.Model):
                         </tr>
             """
             
-            # Show subsections (if any) - NOW EDITABLE
+            # Show subsections and the groups nested in them (if any) - NOW EDITABLE
             for subsection in subsections:
-                sub_name = subsection.get('name', 'Unnamed')
-                sub_margin = subsection.get('margin', 0.0)
-                sub_margin_percent = subsection.get('margin_percent', 0.0)
-                sub_products = subsection.get('products', [])
-                
-                html += f"""
-                        <tr class="subsection-row">
-                            <td class="text-start" colspan="2" style="padding-left: 30px;">
-                                <span class="subsection-label">
-                                    <i class="fa fa-folder"></i>
-                                    <strong>{sub_name}</strong>
-                                </span>
-                            </td>
-                            <td class="text-end margin-value">
-                                {abs(sub_margin):,.2f}
-                            </td>
-                            <td class="text-end">
-                                <div class="margin-input-container">
-                                    <input type="number" 
-                                           class="subsection_margin_input" 
-                                           data-order-id="{self.id}"
-                                           data-section-name="{section_name}"
-                                           data-subsection-name="{sub_name}"
-                                           data-current-margin="{sub_margin_percent:.2f}"
-                                           value="{sub_margin_percent:.2f}" 
-                                           step="0.01" 
-                                           min="0" 
-                                           max="99.99" />
-                                    <span>%</span>
-                                    <button type="button"
-                                            class="btn btn-sm btn-primary apply_subsection_margin_btn" 
-                                            data-order-id="{self.id}"
-                                            data-section-name="{section_name}"
-                                            data-subsection-name="{sub_name}">
-                                        <i class="fa fa-check"></i>Apply
-                                    </button>
-                                </div>
-                            </td>
-                        </tr>
-                """
-                
-                # Show products within subsection - DISPLAY ONLY (edit functionality commented)
-                for product in sub_products:
-                    prod_name = product.get('name', 'Unnamed')
-                    prod_margin = product.get('margin', 0.0)
-                    prod_margin_percent = product.get('margin_percent', 0.0)
-                    prod_line_id = product.get('line_id', 0)
-                    
-                    html += f"""
-                        <tr class="product-row">
-                            <td class="text-start" colspan="2" style="padding-left: 60px;">
-                                <span class="product-name">
-                                    <i class="fa fa-cube"></i>
-                                    {prod_name}
-                                </span>
-                            </td>
-                            <td class="text-end margin-value">
-                                {abs(prod_margin):,.2f}
-                            </td>
-                            <td class="text-end">
-                                <span class="margin-badge">
-                                    {prod_margin_percent:.2f}%
-                                </span>
-                                <!--
-                                PRODUCT MARGIN EDITING - COMMENTED FOR FUTURE USE
-                                <div class="margin-input-container">
-                                    <input type="number" 
-                                           class="product_margin_input" 
-                                           data-order-id="{self.id}"
-                                           data-line-id="{prod_line_id}"
-                                           data-current-margin="{prod_margin_percent:.2f}"
-                                           value="{prod_margin_percent:.2f}" 
-                                           step="0.01" 
-                                           min="0" />
-                                    <span>%</span>
-                                    <button type="button"
-                                            class="btn btn-sm btn-primary apply_product_margin_btn" 
-                                            data-order-id="{self.id}"
-                                            data-line-id="{prod_line_id}">
-                                        <i class="fa fa-check"></i>Apply
-                                    </button>
-                                </div>
-                                -->
-                            </td>
-                        </tr>
-                    """
+                html += self._generate_margin_group_html(section_name, subsection)
             
             # Show products directly under section (no subsection) - DISPLAY ONLY (edit functionality commented)
             for product in section_products:
-                prod_name = product.get('name', 'Unnamed')
+                prod_name = escape(product.get('name', 'Unnamed'))
                 prod_margin = product.get('margin', 0.0)
                 prod_margin_percent = product.get('margin_percent', 0.0)
                 prod_line_id = product.get('line_id', 0)
                 
                 html += f"""
-                        <tr class="product-row">
+                        <tr class="product-row" data-margin-product="{prod_line_id}">
                             <td class="text-start" colspan="2" style="padding-left: 40px;">
                                 <span class="product-name">
                                     <i class="fa fa-cube"></i>
@@ -459,13 +900,26 @@ class SaleOrder(models.Model):
                                     GRAND TOTAL
                                 </strong>
                             </td>
-                            <td class="text-end">
+                            <td class="text-end margin-total-value">
                                 <strong class="total-value">{abs(total_margin):,.2f}</strong>
                             </td>
                             <td class="text-end">
-                                <strong class="total-badge">
-                                    {total_margin_percent:.2f}%
-                                </strong>
+                                <div class="margin-input-container">
+                                    <input type="number" 
+                                           class="order_margin_input" 
+                                           data-order-id="{self.id}"
+                                           data-current-margin="{total_margin_percent:.2f}"
+                                           value="{total_margin_percent:.2f}" 
+                                           step="0.01" 
+                                           min="0" 
+                                           max="99.99" />
+                                    <span>%</span>
+                                    <button type="button"
+                                            class="btn btn-sm btn-primary apply_order_margin_btn" 
+                                            data-order-id="{self.id}">
+                                        <i class="fa fa-check"></i>Apply
+                                    </button>
+                                </div>
                             </td>
                         </tr>
                     </tfoot>
@@ -476,257 +930,588 @@ class SaleOrder(models.Model):
         
         return html
 
-    def adjust_section_margin(self, section_name, target_margin_percent):
+    def _generate_margin_group_html(self, section_name, subsection, level=1):
+        """
+        Generate the rows of a group nested in a section: its own row, its
+        products, then the groups nested in it, indented one step per level.
+        """
+        html = ''
+        sub_name = escape(subsection.get('name', 'Unnamed'))
+        sub_line_id = subsection.get('line_id') or 0
+        sub_margin = subsection.get('margin', 0.0)
+        sub_margin_percent = subsection.get('margin_percent', 0.0)
+        sub_products = subsection.get('products', [])
+
+        html += f"""
+                <tr class="subsection-row" data-margin-node="{sub_line_id}">
+                    <td class="text-start" colspan="2" style="padding-left: {30 * level}px;">
+                        <span class="subsection-label">
+                            <i class="fa fa-folder"></i>
+                            <strong>{sub_name}</strong>
+                        </span>
+                    </td>
+                    <td class="text-end margin-value">
+                        {abs(sub_margin):,.2f}
+                    </td>
+                    <td class="text-end">
+                        <div class="margin-input-container">
+                            <input type="number" 
+                                   class="subsection_margin_input" 
+                                   data-order-id="{self.id}"
+                                   data-section-name="{section_name}"
+                                   data-subsection-id="{sub_line_id}"
+                                   data-subsection-name="{sub_name}"
+                                   data-current-margin="{sub_margin_percent:.2f}"
+                                   value="{sub_margin_percent:.2f}" 
+                                   step="0.01" 
+                                   min="0" 
+                                   max="99.99" />
+                            <span>%</span>
+                            <button type="button"
+                                    class="btn btn-sm btn-primary apply_subsection_margin_btn" 
+                                    data-order-id="{self.id}"
+                                    data-section-name="{section_name}"
+                                    data-subsection-id="{sub_line_id}"
+                                    data-subsection-name="{sub_name}">
+                                <i class="fa fa-check"></i>Apply
+                            </button>
+                        </div>
+                    </td>
+                </tr>
+        """
+
+        # Show products within subsection - DISPLAY ONLY (edit functionality commented)
+        for product in sub_products:
+            prod_name = escape(product.get('name', 'Unnamed'))
+            prod_margin = product.get('margin', 0.0)
+            prod_margin_percent = product.get('margin_percent', 0.0)
+            prod_line_id = product.get('line_id', 0)
+
+            html += f"""
+                <tr class="product-row" data-margin-product="{prod_line_id}">
+                    <td class="text-start" colspan="2" style="padding-left: {30 * (level + 1)}px;">
+                        <span class="product-name">
+                            <i class="fa fa-cube"></i>
+                            {prod_name}
+                        </span>
+                    </td>
+                    <td class="text-end margin-value">
+                        {abs(prod_margin):,.2f}
+                    </td>
+                    <td class="text-end">
+                        <span class="margin-badge">
+                            {prod_margin_percent:.2f}%
+                        </span>
+                        <!--
+                        PRODUCT MARGIN EDITING - COMMENTED FOR FUTURE USE
+                        <div class="margin-input-container">
+                            <input type="number" 
+                                   class="product_margin_input" 
+                                   data-order-id="{self.id}"
+                                   data-line-id="{prod_line_id}"
+                                   data-current-margin="{prod_margin_percent:.2f}"
+                                   value="{prod_margin_percent:.2f}" 
+                                   step="0.01" 
+                                   min="0" />
+                            <span>%</span>
+                            <button type="button"
+                                    class="btn btn-sm btn-primary apply_product_margin_btn" 
+                                    data-order-id="{self.id}"
+                                    data-line-id="{prod_line_id}">
+                                <i class="fa fa-check"></i>Apply
+                            </button>
+                        </div>
+                        -->
+                    </td>
+                </tr>
+            """
+
+        for nested in subsection.get('subsections', []):
+            html += self._generate_margin_group_html(section_name, nested, level + 1)
+        
+        return html
+
+    @with_unit_cost_scope
+    def adjust_section_margin(self, section_name, target_margin_percent, strategy='uniform', weights=None, constrained=False):
         """
         Adjust prices of products in a section to achieve target margin percentage.
-        Distribution: Equitably (same percentage increase for all products).
+        Distribution: same percentage increase for all products by default,
+        see _solve_line_prices for the other strategies.
         
-        :param section_name: Name of the section to adjust
+        :param section_name: Name of the section to adjust (every section
+            with this name is adjusted together)
         :param target_margin_percent: Target margin percentage to achieve
+        :param strategy: Distribution strategy of the price change (default 'uniform')
+        :param weights: {product category ID: weight} for the 'category_weight' strategy
+        :param constrained: Keep every line between its price floor and ceiling
         :return: dict with results
         """
         self.ensure_one()
         
-        # Find all lines belonging to this section (including subsections)
-        section_lines = []
-        current_section = None
-        in_target_section = False
+        # Products of the section, including those of the groups nested in it
+        sections = [section for section in self._get_margin_tree().sections if section.name == section_name]
+        section_lines = self._get_margin_groups_product_lines([section.line_id for section in sections])
         
-        for line in self.order_line:
-            # Identify section
-            if line.display_type == 'line_section':
-                # Check if this is our target section
-                if line.name == section_name:
-                    current_section = line.name
-                    in_target_section = True
-                else:
-                    # Found a different section, stop collecting
-                    in_target_section = False
-                    current_section = None
-            # Subsections belong to the current section
-            elif line.display_type == 'line_subsection':
-                # Subsections don't change the in_target_section flag
-                pass
-            # Collect product lines from target section (including those in subsections)
-            elif in_target_section and line.display_type == False and line.product_id:
-                section_lines.append(line)
+        if not section_lines:
+            return {
+                'success': False,
+                'message': f'No products found in section "{section_name}"'
+            }
+        
+        # Get current margin BEFORE adjustment for history
+        old_margin_percent = sections[0].margin_percent
+        
+        result = self._adjust_lines_to_margin(section_lines, target_margin_percent, strategy, weights, constrained)
+        if not result['success']:
+            return result
+        new_margin_percent = result['new_margin_percent']
+        adjustment_factor = result['adjustment_factor']
+        updated_lines = result['updated_lines']
+        
+        # Prepare data for history
+        old_data = {
+            'section_name': section_name,
+            'margin_percent': old_margin_percent,
+        }
+        
+        new_data = {
+            'margin_percent': new_margin_percent,
+            'updated_lines': updated_lines,
+        }
+        
+        # Save to history
+        self._save_margin_history('section', old_data, new_data)
+        
+        self._notify_margin_change([line['line_id'] for line in updated_lines])
+
+        return {
+            'success': True,
+            'message': f'Successfully adjusted {len(section_lines)} products',
+            'section_name': section_name,
+            'old_margin_percent': old_margin_percent,
+            'new_margin_percent': new_margin_percent,
+            'adjustment_factor': adjustment_factor,
+            'strategy': strategy,
+            'updated_lines': updated_lines
+        }
+
+    @with_unit_cost_scope
+    def adjust_subsection_margin(self, section_name, subsection_name, target_margin_percent, strategy='uniform', weights=None, constrained=False):
+        """
+        Adjust prices of products in a subsection to achieve target margin percentage.
+        Distribution: same percentage increase for all products by default,
+        see _solve_line_prices for the other strategies.
+        
+        :param section_name: Name of the parent section
+        :param subsection_name: Name of the subsection to adjust, matched at
+            any level below the section
+        :param target_margin_percent: Target margin percentage to achieve
+        :param strategy: Distribution strategy of the price change (default 'uniform')
+        :param weights: {product category ID: weight} for the 'category_weight' strategy
+        :param constrained: Keep every line between its price floor and ceiling
+        :return: dict with results
+        """
+        self.ensure_one()
+        
+        subsections = [
+            path[-1] for path in self._get_margin_tree().walk()
+            if len(path) > 1 and path[0].name == section_name and path[-1].name == subsection_name
+        ]
+        subsection_lines = self._get_margin_groups_product_lines([subsection.line_id for subsection in subsections])
+        
+        if not subsection_lines:
+            return {
+                'success': False,
+                'message': f'No products found in subsection "{subsection_name}" of section "{section_name}"'
+            }
+        
+        old_margin_percent = subsections[0].margin_percent
+        
+        result = self._adjust_lines_to_margin(subsection_lines, target_margin_percent, strategy, weights, constrained)
+        if not result['success']:
+            return result
+        new_margin_percent = result['new_margin_percent']
+        adjustment_factor = result['adjustment_factor']
+        updated_lines = result['updated_lines']
+        
+        # Prepare history data
+        old_data = {
+            'section_name': section_name,
+            'subsection_name': subsection_name,
+            'margin_percent': old_margin_percent,
+        }
+        
+        new_data = {
+            'section_name': section_name,
+            'subsection_name': subsection_name,
+            'margin_percent': new_margin_percent,
+            'updated_lines': updated_lines,
+        }
+        
+        # Save to history
+        self._save_margin_history('subsection', old_data, new_data)
+        
+        self._notify_margin_change([line['line_id'] for line in updated_lines])
+
+        return {
+            'success': True,
+            'message': f'Successfully adjusted {len(subsection_lines)} products in subsection',
+            'section_name': section_name,
+            'subsection_name': subsection_name,
+            'old_margin_percent': old_margin_percent,
+            'new_margin_percent': new_margin_percent,
+            'adjustment_factor': adjustment_factor,
+            'strategy': strategy,
+            'updated_lines': updated_lines
+        }
+
+    def adjust_section_margin_by_id(self, section_line_id, target_margin_percent, strategy='uniform', weights=None, constrained=False):
+        """
+        Adjust prices of products in a section to achieve target margin percentage.
+        Same as adjust_section_margin, but the section is identified by its line,
+        so duplicate section names are not ambiguous.
+        
+        :param section_line_id: ID of the section line (sale.order.line)
+        :param target_margin_percent: Target margin percentage to achieve
+        :param strategy: Distribution strategy of the price change (default 'uniform')
+        :param weights: {product category ID: weight} for the 'category_weight' strategy
+        :param constrained: Keep every line between its price floor and ceiling
+        :return: dict with results
+        """
+        self.ensure_one()
+        
+        section_line, path = self._get_margin_group_path(section_line_id)
+        if not path or len(path) > 1:
+            return {
+                'success': False,
+                'message': 'Section not found in this order'
+            }
+        return self._adjust_margin_group(section_line, path, target_margin_percent, strategy, weights, constrained)
+
+    def adjust_subsection_margin_by_id(self, subsection_line_id, target_margin_percent, strategy='uniform', weights=None, constrained=False):
+        """
+        Adjust prices of products in a subsection to achieve target margin percentage.
+        Same as adjust_subsection_margin, but the subsection is identified by its
+        line. Works for groups nested at any level below a section.
+        
+        :param subsection_line_id: ID of the subsection line (sale.order.line)
+        :param target_margin_percent: Target margin percentage to achieve
+        :param strategy: Distribution strategy of the price change (default 'uniform')
+        :param weights: {product category ID: weight} for the 'category_weight' strategy
+        :param constrained: Keep every line between its price floor and ceiling
+        :return: dict with results
+        """
+        self.ensure_one()
+        
+        # Subsections placed before the first section are not part of the tree
+        subsection_line, path = self._get_margin_group_path(subsection_line_id)
+        if not path or len(path) < 2:
+            return {
+                'success': False,
+                'message': 'Subsection not found in this order'
+            }
+        return self._adjust_margin_group(subsection_line, path, target_margin_percent, strategy, weights, constrained)
+
+    def adjust_group_margin_by_id(self, group_line_id, target_margin_percent, strategy='uniform', weights=None, constrained=False):
+        """
+        Adjust prices of products in a section or in a group nested at any
+        level below it to achieve target margin percentage.
+        
+        :param group_line_id: ID of the section line (sale.order.line)
+        :param target_margin_percent: Target margin percentage to achieve
+        :param strategy: Distribution strategy of the price change (default 'uniform')
+        :param weights: {product category ID: weight} for the 'category_weight' strategy
+        :param constrained: Keep every line between its price floor and ceiling
+        :return: dict with results
+        """
+        self.ensure_one()
+        
+        group_line, path = self._get_margin_group_path(group_line_id)
+        if not path:
+            return {
+                'success': False,
+                'message': 'Section not found in this order'
+            }
+        return self._adjust_margin_group(group_line, path, target_margin_percent, strategy, weights, constrained)
+
+    @with_unit_cost_scope
+    def _adjust_margin_group(self, group_line, path, target_margin_percent, strategy, weights, constrained):
+        """
+        Reprice the products of one group of the margin tree and record it.
+
+        Sections are recorded as section adjustments; nested groups as
+        subsection adjustments named after their path below the section.
+
+        :param group_line: section line (sale.order.line) of the group
+        :param path: section lines from the section down to the group
+            (see _get_margin_group_path)
+        :return: dict with results
+        """
+        section_name = path[0].name or 'Unnamed'
+        subsection_name = ' / '.join(line.name or 'Unnamed' for line in path[1:])
         
-        if not section_lines:
+        group_lines = self._get_margin_group_product_lines(group_line)
+        if not group_lines:
             return {
                 'success': False,
-                'message': f'No products found in section "{section_name}"'
+                'message': (f'No products found in subsection "{subsection_name}" of section "{section_name}"'
+                            if subsection_name else f'No products found in section "{section_name}"')
             }
         
         # Get current margin BEFORE adjustment for history
-        margins_data = self._get_section_margins()
-        section_data = next((s for s in margins_data.get('sections', []) 
-                            if s.get('name') == section_name), None)
-        old_margin_percent = section_data.get('margin_percent', 0) if section_data else 0
-        
-        # Save old prices for history
-        old_prices = {}
-        for line in section_lines:
-            old_prices[line.id] = {
-                'line_id': line.id,
-                'product_name': line.name or (line.product_id.name if line.product_id else 'Unnamed'),
-                'old_price': float(line.price_unit),
-            }
-        
-        # Calculate current totals
-        total_cost = 0.0
-        total_price = 0.0
-        
-        for line in section_lines:
-            qty = float(line.product_uom_qty) if line.product_uom_qty else 0.0
-            price_subtotal = float(line.price_subtotal) if line.price_subtotal else 0.0
-            
-            # Get cost and round to 2 decimals for precision
-            cost = 0.0
-            if hasattr(line, 'purchase_price') and line.purchase_price:
-                cost = round(float(line.purchase_price) * qty, 2)
-            elif hasattr(line.product_id, 'standard_price') and line.product_id.standard_price:
-                cost = round(float(line.product_id.standard_price) * qty, 2)
-            
-            total_cost += cost
-            total_price += price_subtotal
+        old_margin_percent = self._get_lines_margin_percent(group_lines)
         
-        if total_cost == 0:
-            return {
-                'success': False,
-                'message': 'Cannot adjust: total cost is 0'
-            }
+        result = self._adjust_lines_to_margin(group_lines, target_margin_percent, strategy, weights, constrained)
+        if not result['success']:
+            return result
         
-        # Calculate target price using traditional margin formula
-        # margin_percent = ((price - cost) / price) * 100
-        # Solving for price: price = cost / (1 - margin_percent/100)
+        old_data = {
+            'section_name': section_name,
+            'margin_percent': old_margin_percent,
+        }
+        new_data = {
+            'margin_percent': result['new_margin_percent'],
+            'updated_lines': result['updated_lines'],
+        }
+        if subsection_name:
+            old_data['subsection_name'] = new_data['subsection_name'] = subsection_name
+            new_data['section_name'] = section_name
+        self._save_margin_history('subsection' if subsection_name else 'section', old_data, new_data)
         
-        target_margin_decimal = target_margin_percent / 100.0
+        self._notify_margin_change([line['line_id'] for line in result['updated_lines']])
+
+        response = {
+            'success': True,
+            'message': f'Successfully adjusted {len(group_lines)} products' + (' in subsection' if subsection_name else ''),
+            'section_line_id': path[0].id,
+            'section_name': section_name,
+            'level': len(path),
+            'old_margin_percent': old_margin_percent,
+            'new_margin_percent': result['new_margin_percent'],
+            'adjustment_factor': result['adjustment_factor'],
+            'strategy': strategy,
+            'updated_lines': result['updated_lines']
+        }
+        if subsection_name:
+            response['subsection_line_id'] = group_line.id
+            response['subsection_name'] = subsection_name
+        return response
+
+    @with_unit_cost_scope
+    def adjust_order_margin(self, target_margin_percent, section_weights=None, locked_section_ids=None, constrained=False):
+        """
+        Adjust prices of all products to bring the whole order to a target
+        margin percentage in one operation.
+        
+        The section factors are solved together: the price change is spread
+        over the sections in proportion to their amount times their weight,
+        and applied in a single write with a single history entry.
+        
+        :param target_margin_percent: Target margin percentage of the order
+        :param section_weights: {section line ID: weight}, sections not listed
+            (and products outside sections) weigh 1.0; a lower weight means a
+            smaller share of the price change
+        :param locked_section_ids: IDs of section lines whose prices must not change
+        :param constrained: Keep every line between its price floor and ceiling
+        :return: dict with results
+        """
+        self.ensure_one()
         
-        # Validate margin range (cannot be >= 100% with this formula)
-        if target_margin_decimal >= 1.0:
+        order_lines = self.order_line.filtered(lambda l: not l.display_type and l.product_id)
+        if not order_lines:
             return {
                 'success': False,
-                'message': 'Margin cannot be 100% or greater (maximum is 99.99%)'
+                'message': 'No products found in this order'
             }
         
-        target_total_price = total_cost / (1 - target_margin_decimal)
-        
-        # Calculate adjustment factor (same percentage for all products)
-        adjustment_factor = target_total_price / total_price if total_price > 0 else 1.0
-        
-        # Apply adjustment to all lines with proper rounding
-        updated_lines = []
-        for line in section_lines:
-            old_price = line.price_unit
-            # Calculate new price and round UP to ensure target margin is reached
-            new_price = math.ceil(old_price * adjustment_factor * 100) / 100
-            
-            # Update price_unit - this will trigger recalculation of subtotals and margins
-            line.price_unit = new_price
-            
-            updated_lines.append({
-                'line_id': line.id,
-                'name': line.name or line.product_id.name,
-                'old_price': old_price,
-                'new_price': new_price
-            })
+        # JSON object keys arrive as strings
+        weights = {int(section_line_id): float(weight) for section_line_id, weight in (section_weights or {}).items()}
+        for section_line_id in locked_section_ids or []:
+            weights[int(section_line_id)] = 0.0
         
-        # Force recalculation of order totals
-        self._compute_section_margins_json()
-        self._compute_section_margins_html()
+        old_margin_percent = self._get_margin_tree().total_margin_percent
         
-        # Recalculate to verify
-        new_total_price = sum(float(line.price_subtotal) for line in section_lines)
-        new_margin = new_total_price - total_cost
-        new_margin_percent = (new_margin / new_total_price * 100) if new_total_price > 0 else 0
+        result = self._adjust_lines_to_margin(
+            order_lines, target_margin_percent, 'section_weight', weights, constrained)
+        if not result['success']:
+            return result
         
-        # Prepare data for history
         old_data = {
-            'section_name': section_name,
             'margin_percent': old_margin_percent,
         }
-        
         new_data = {
-            'margin_percent': new_margin_percent,
-            'updated_lines': updated_lines,
+            'margin_percent': result['new_margin_percent'],
+            'updated_lines': result['updated_lines'],
         }
+        self._save_margin_history('order', old_data, new_data)
         
-        # Save to history
-        try:
-            self.env['sale.order.margin.history'].create_history(
-                self.id, 'section', old_data, new_data
-            )
-        except Exception as e:
-            # Don't fail if history fails, just log it
-            import logging
-            _logger = logging.getLogger(__name__)
-            _logger.warning(f'Error saving margin history: {str(e)}')
-        
+        self._notify_margin_change([line['line_id'] for line in result['updated_lines']])
+
         return {
             'success': True,
-            'message': f'Successfully adjusted {len(section_lines)} products',
-            'section_name': section_name,
+            'message': f'Successfully adjusted {len(result["updated_lines"])} products',
             'old_margin_percent': old_margin_percent,
-            'new_margin_percent': new_margin_percent,
-            'adjustment_factor': adjustment_factor,
-            'updated_lines': updated_lines
+            'new_margin_percent': result['new_margin_percent'],
+            'adjustment_factor': result['adjustment_factor'],
+            'updated_lines': result['updated_lines']
         }
 
-    def adjust_subsection_margin(self, section_name, subsection_name, target_margin_percent):
+    def _get_margin_group_path(self, line_id):
         """
-        Adjust prices of products in a subsection to achieve target margin percentage.
-        Distribution: Equitably (same percentage increase for all products).
+        Return the section line with this ID and the section lines above it.
+
+        Only the group line and its ancestors are read, never the whole
+        order: as in the margin tree, the parent of a group is the closest
+        section line before it with a lower margin level.
+
+        :return: (sale.order.line, section lines from the section down to the
+            group), the path is None when the line is not a section line of
+            the order or is not part of the tree (no level 1 section above it)
+        """
+        self.ensure_one()
+        SaleOrderLine = self.env['sale.order.line']
+        try:
+            line = SaleOrderLine.browse(int(line_id)).exists()
+        except (ValueError, TypeError):
+            line = SaleOrderLine
+        if line.order_id != self or line.display_type not in MARGIN_GROUP_DEPTHS:
+            return SaleOrderLine, None
+        path = line
+        while path[0].margin_depth > 1:
+            parent = SaleOrderLine.search(
+                [('order_id', '=', self.id),
+                 ('display_type', 'in', list(MARGIN_GROUP_DEPTHS)),
+                 ('margin_depth', '<', path[0].margin_depth)] + self._margin_position_domain(path[0], '<'),
+                order='sequence desc, id desc', limit=1)
+            if not parent:
+                # Groups placed before the first section are not part of the tree
+                return line, None
+            path = parent + path
+        return line, path
+
+    def _get_lines_margin_percent(self, lines):
+        """Margin percentage of product lines taken together, as in the margin tree"""
+        lines = lines.filtered(lambda l: l.price_subtotal > 0)
+        price_subtotal = sum(float(line.price_subtotal) for line in lines)
+        cost_provider = self.env['sale.order.margin.cost']
+        if cost_provider._uses_line_margin():
+            margin = sum(float(line.margin or 0.0) for line in lines)
+        else:
+            unit_costs = cost_provider.get_unit_costs(lines)
+            margin = price_subtotal - sum(
+                unit_costs[line.id] * float(line.product_uom_qty or 0.0) for line in lines)
+        return margin_percent(margin, price_subtotal)
+
+    def _margin_position_domain(self, line, operator):
+        """Domain of the order lines placed after ('>') or before ('<') line"""
+        return [
+            '|', ('sequence', operator, line.sequence),
+            '&', ('sequence', '=', line.sequence), ('id', operator, line.id),
+        ]
+
+    def _get_margin_group_product_lines(self, group_line):
+        """
+        Return the product lines between group_line and the next section line
+        of the same or an upper level, i.e. the products of the group and of
+        all the groups nested in it.
+
+        Both searches are range scans on the (order_id, sequence, id) index,
+        so the cost depends on the size of the group, not of the order.
+        """
+        self.ensure_one()
+        SaleOrderLine = self.env['sale.order.line']
+        domain = [('order_id', '=', self.id)] + self._margin_position_domain(group_line, '>')
+        boundary = SaleOrderLine.search(
+            domain + [('display_type', 'in', list(MARGIN_GROUP_DEPTHS)),
+                      ('margin_depth', '<=', group_line.margin_depth)],
+            order='sequence, id', limit=1)
+        if boundary:
+            domain += self._margin_position_domain(boundary, '<')
+        return SaleOrderLine.search(
+            domain + [('display_type', '=', False), ('product_id', '!=', False)], order='sequence, id')
+
+    def _get_margin_groups_product_lines(self, group_line_ids):
+        """Return the product lines of several groups, each line once"""
+        lines = self.env['sale.order.line']
+        for group_line in self.env['sale.order.line'].browse([line_id for line_id in group_line_ids if line_id]):
+            lines |= self._get_margin_group_product_lines(group_line)
+        return lines
+
+    def _adjust_lines_to_margin(self, lines, target_margin_percent, strategy='uniform', weights=None, constrained=False):
+        """
+        Reprice product lines so that, together, they reach the target
+        margin percentage.
         
-        :param section_name: Name of the parent section
-        :param subsection_name: Name of the subsection to adjust
+        :param lines: sale.order.line records to reprice
         :param target_margin_percent: Target margin percentage to achieve
-        :return: dict with results
+        :param strategy: how the price change is spread over the lines
+            (see _solve_line_prices)
+        :param weights: {product category ID: weight} for the
+            'category_weight' strategy
+        :param constrained: keep every line within its price limits
+        :return: dict with results (new_margin_percent, adjustment_factor and
+            updated_lines on success)
         """
         self.ensure_one()
         
-        # Find all lines belonging to this specific subsection
-        subsection_lines = []
-        current_section = None
-        current_subsection = None
-        in_target_section = False
-        in_target_subsection = False
+        solution = self._solve_line_prices(lines, target_margin_percent, strategy, weights, constrained)
+        if not solution['success']:
+            return solution
         
-        for line in self.order_line:
-            # Identify section
-            if line.display_type == 'line_section':
-                # Check if this is our target section
-                if line.name == section_name:
-                    current_section = line.name
-                    in_target_section = True
-                    in_target_subsection = False  # Reset subsection flag
-                else:
-                    # Found a different section, stop collecting
-                    in_target_section = False
-                    in_target_subsection = False
-                    current_section = None
-                    current_subsection = None
-            # Identify subsection
-            elif line.display_type == 'line_subsection':
-                if in_target_section:
-                    # Check if this is our target subsection
-                    if line.name == subsection_name:
-                        current_subsection = line.name
-                        in_target_subsection = True
-                    else:
-                        # Different subsection in the same section
-                        current_subsection = line.name
-                        in_target_subsection = False
-                else:
-                    # Not in target section, ignore
-                    current_subsection = None
-                    in_target_subsection = False
-            # Collect product lines from target subsection only
-            elif in_target_section and in_target_subsection and line.display_type == False and line.product_id:
-                subsection_lines.append(line)
+        updated_lines = self._apply_line_prices(lines, solution['new_prices'])
         
-        if not subsection_lines:
-            return {
-                'success': False,
-                'message': f'No products found in subsection "{subsection_name}" of section "{section_name}"'
-            }
+        # Recalculate to verify
+        new_total_price = sum(float(line.price_subtotal) for line in lines)
+        new_margin = new_total_price - solution['total_cost']
+        new_margin_percent = (new_margin / new_total_price * 100) if new_total_price > 0 else 0
         
-        # Get current margin data
-        margins_data = json.loads(self.section_margins_json) if self.section_margins_json else {}
-        sections = margins_data.get('sections', []) if isinstance(margins_data, dict) else []
-        section_data = next((s for s in sections if s.get('name') == section_name), None)
-        subsection_data = None
-        if section_data:
-            subsection_data = next((sub for sub in section_data.get('subsections', []) 
-                                   if sub.get('name') == subsection_name), None)
-        
-        old_margin_percent = subsection_data.get('margin_percent', 0) if subsection_data else 0
-        
-        # Save old prices for history
-        old_prices = {}
-        for line in subsection_lines:
-            old_prices[line.id] = {
-                'line_id': line.id,
-                'product_name': line.name or (line.product_id.name if line.product_id else 'Unnamed'),
-                'old_price': float(line.price_unit),
-            }
+        return {
+            'success': True,
+            'new_margin_percent': new_margin_percent,
+            'adjustment_factor': solution['adjustment_factor'],
+            'strategy': strategy,
+            'updated_lines': updated_lines,
+        }
+
+    def _solve_line_prices(self, lines, target_margin_percent, strategy='uniform', weights=None, constrained=False):
+        """
+        Compute the unit prices bringing product lines to a target margin.
+
+        The gap between the current and the target amount is spread over the
+        lines in proportion to the weights of the strategy:
+
+        - uniform: same factor on every price (proportional to the subtotals)
+        - cost_share: proportional to the line costs
+        - quantity: proportional to the quantities
+        - service_only: only service products, proportional to their subtotals
+        - category_weight: subtotals scaled by the weight of the product category
+
+        Every step is a single pass over the lines, whatever the strategy.
+
+        In constrained mode each line must also stay between a floor and a
+        ceiling (see _get_line_subtotal_bounds): lines reaching a limit are
+        pinned to it and the rest of the change is spread over the others,
+        in a bounded number of passes. Infeasible targets are reported with
+        'infeasible' in the result; nothing is ever written here.
+
+        :param lines: sale.order.line records to reprice
+        :param target_margin_percent: Target margin percentage to achieve
+        :param strategy: name of the distribution strategy
+        :param weights: {product category ID: weight} for 'category_weight'
+        :param constrained: keep every line within its price limits
+        :return: dict with success, total_cost, adjustment_factor and
+            new_prices (one unit price per line, in the order of lines)
+        """
+        self.ensure_one()
         
         # Calculate current totals
-        total_cost = 0.0
-        total_price = 0.0
-        
-        for line in subsection_lines:
-            qty = float(line.product_uom_qty) if line.product_uom_qty else 0.0
-            price_subtotal = float(line.price_subtotal) if line.price_subtotal else 0.0
-            
-            # Get cost and round to 2 decimals for precision
-            cost = 0.0
-            if hasattr(line, 'purchase_price') and line.purchase_price:
-                cost = round(float(line.purchase_price) * qty, 2)
-            elif hasattr(line.product_id, 'standard_price') and line.product_id.standard_price:
-                cost = round(float(line.product_id.standard_price) * qty, 2)
-            
-            total_cost += cost
-            total_price += price_subtotal
+        unit_costs = self.env['sale.order.margin.cost'].get_unit_costs(lines)
+        quantities = [float(line.product_uom_qty) if line.product_uom_qty else 0.0 for line in lines]
+        subtotals = [float(line.price_subtotal) if line.price_subtotal else 0.0 for line in lines]
+        # Costs rounded to 2 decimals for precision
+        costs = [round(unit_costs[line.id] * qty, 2) for line, qty in zip(lines, quantities)]
+        total_cost = sum(costs)
+        total_price = sum(subtotals)
         
         if total_cost == 0:
             return {
@@ -749,18 +1534,179 @@ class SaleOrder(models.Model):
         
         target_total_price = total_cost / (1 - target_margin_decimal)
         
-        # Calculate adjustment factor
+        # Overall adjustment factor (the factor of every price when uniform)
         adjustment_factor = target_total_price / total_price if total_price > 0 else 1.0
         
-        # Apply adjustment to all lines
+        old_prices = [float(line.price_unit) for line in lines]
+        if strategy == 'uniform' and not constrained:
+            # Round UP to ensure target margin is reached
+            new_prices = [math.ceil(price * adjustment_factor * 100) / 100 for price in old_prices]
+            return {
+                'success': True,
+                'total_cost': total_cost,
+                'adjustment_factor': adjustment_factor,
+                'new_prices': new_prices,
+            }
+        
+        if strategy == 'uniform':
+            # Same factor on every price: shares proportional to the subtotals
+            line_weights = subtotals
+        else:
+            get_weights = getattr(self, f'_get_margin_weights_{strategy}', None)
+            if not get_weights:
+                return {
+                    'success': False,
+                    'message': f'Unknown distribution strategy "{strategy}"'
+                }
+            line_weights = get_weights(lines, subtotals, costs, quantities, weights or {})
+        
+        # Amount a unit price change moves the subtotal by; lines without
+        # quantity cannot take any share of the change
+        price_bases = [qty * (1 - (line.discount or 0.0) / 100) for line, qty in zip(lines, quantities)]
+        line_weights = [weight if base > 0 else 0.0 for weight, base in zip(line_weights, price_bases)]
+        total_weight = sum(line_weights)
+        if total_weight <= 0 and not constrained:
+            return {
+                'success': False,
+                'message': f'No product can take the price change with the "{strategy}" strategy'
+            }
+        
+        if constrained:
+            floors, ceilings, ceiling_prices = self._get_line_subtotal_bounds(lines, costs, price_bases)
+            solution = distribute_within_bounds(subtotals, line_weights, floors, ceilings, target_total_price)
+            if not solution['success']:
+                result = {
+                    'success': False,
+                    'infeasible': True,
+                    'message': solution['message'],
+                }
+                if 'lowest' in solution:
+                    # Margin range reachable within the limits
+                    result['min_margin_percent'] = (1 - total_cost / solution['lowest']) * 100 if solution['lowest'] > 0 else 0.0
+                    result['max_margin_percent'] = (1 - total_cost / solution['highest']) * 100 if solution['highest'] > 0 else 0.0
+                    result['message'] += (
+                        f" (reachable margin: {result['min_margin_percent']:.2f}% to "
+                        f"{result['max_margin_percent']:.2f}%)")
+                return result
+            new_subtotals = solution['amounts']
+        else:
+            gap = target_total_price - total_price
+            new_subtotals = [
+                subtotal + gap * weight / total_weight
+                for subtotal, weight in zip(subtotals, line_weights)
+            ]
+            ceiling_prices = [float('inf')] * len(subtotals)
+            if any(subtotal < 0 for subtotal in new_subtotals):
+                return {
+                    'success': False,
+                    'message': f'The target margin would need negative prices with the "{strategy}" strategy'
+                }
+        
+        new_prices = [
+            # Scale the current price when there is one, so discounts and
+            # units of measure are preserved; round UP as above, without
+            # crossing the price ceiling
+            min(math.ceil((price * new_subtotal / subtotal if subtotal > 0 else new_subtotal / base) * 100) / 100,
+                ceiling_price)
+            if new_subtotal != subtotal and base > 0 else price
+            for price, subtotal, new_subtotal, base, ceiling_price
+            in zip(old_prices, subtotals, new_subtotals, price_bases, ceiling_prices)
+        ]
+        return {
+            'success': True,
+            'total_cost': total_cost,
+            'adjustment_factor': adjustment_factor,
+            'new_prices': new_prices,
+        }
+
+    def _get_line_subtotal_bounds(self, lines, costs, price_bases):
+        """
+        Return the subtotal limits of product lines for the constrained solve.
+
+        - floor: the subtotal keeping the minimum line margin set in the
+          `clasiccsales.margin_min_line_percent` parameter (default 0%, never
+          below cost)
+        - ceiling: the product list price, when the product has one
+
+        :return: tuple (floors, ceilings, ceiling unit prices), one value per line
+        """
+        min_margin = float(self.env['ir.config_parameter'].sudo().get_param(
+            'clasiccsales.margin_min_line_percent', 0.0)) / 100.0
+        min_margin = min(max(min_margin, 0.0), 0.9999)
+        floors = [cost / (1 - min_margin) for cost in costs]
+        
+        ceilings = []
+        ceiling_prices = []
+        today = fields.Date.context_today(self)
+        for line, base in zip(lines, price_bases):
+            list_price = line.product_id.lst_price
+            if list_price > 0:
+                list_price = line.company_id.currency_id._convert(
+                    list_price, line.currency_id, line.company_id, line.order_id.date_order or today)
+                ceilings.append(list_price * base)
+                ceiling_prices.append(list_price)
+            else:
+                ceilings.append(float('inf'))
+                ceiling_prices.append(float('inf'))
+        return floors, ceilings, ceiling_prices
+
+    def _get_margin_weights_cost_share(self, lines, subtotals, costs, quantities, weights):
+        return costs
+
+    def _get_margin_weights_quantity(self, lines, subtotals, costs, quantities, weights):
+        return quantities
+
+    def _get_margin_weights_service_only(self, lines, subtotals, costs, quantities, weights):
+        return [
+            subtotal if line.product_id.type == 'service' else 0.0
+            for line, subtotal in zip(lines, subtotals)
+        ]
+
+    def _get_margin_weights_category_weight(self, lines, subtotals, costs, quantities, weights):
+        # JSON object keys arrive as strings
+        category_weights = {int(categ_id): float(weight) for categ_id, weight in weights.items()}
+        return [
+            subtotal * category_weights.get(line.product_id.categ_id.id, 1.0)
+            for line, subtotal in zip(lines, subtotals)
+        ]
+
+    def _get_margin_weights_section_weight(self, lines, subtotals, costs, quantities, weights):
+        # Each line takes the weight of its section, lines outside sections 1.0
+        section_weights = {int(section_id): float(weight) for section_id, weight in weights.items()}
+        section_of_line = self._get_line_section_map()
+        return [
+            subtotal * section_weights.get(section_of_line.get(line.id), 1.0)
+            for line, subtotal in zip(lines, subtotals)
+        ]
+
+    def _get_line_section_map(self):
+        """Return {line ID: section line ID} for the lines placed in a section"""
+        self.ensure_one()
+        section_of_line = {}
+        current_section_id = None
+        for line in self.order_line:
+            if line.display_type in MARGIN_GROUP_DEPTHS and line.margin_depth <= 1:
+                current_section_id = line.id
+            elif current_section_id:
+                section_of_line[line.id] = current_section_id
+        return section_of_line
+
+    def _apply_line_prices(self, lines, new_prices):
+        """
+        Write new unit prices on product lines and refresh the margins.
+
+        :param lines: sale.order.line records
+        :param new_prices: one unit price per line, in the order of lines
+        :return: list of dicts describing the lines whose price changed
+        """
         updated_lines = []
-        for line in subsection_lines:
+        commands = []
+        for line, new_price in zip(lines, new_prices):
             old_price = line.price_unit
-            # Calculate new price and round UP to ensure target margin is reached
-            new_price = math.ceil(old_price * adjustment_factor * 100) / 100
-            
-            line.price_unit = new_price
+            if new_price == old_price:
+                continue
             
+            commands.append(Command.update(line.id, {'price_unit': new_price}))
             updated_lines.append({
                 'line_id': line.id,
                 'name': line.name or line.product_id.name,
@@ -768,50 +1714,31 @@ class SaleOrder(models.Model):
                 'new_price': new_price
             })
         
-        # Force recalculation
-        self._compute_section_margins_json()
-        self._compute_section_margins_html()
-        
-        # Recalculate to verify
-        new_total_price = sum(float(line.price_subtotal) for line in subsection_lines)
-        new_margin = new_total_price - total_cost
-        new_margin_percent = (new_margin / new_total_price * 100) if new_total_price > 0 else 0
-        
-        # Prepare history data
-        old_data = {
-            'section_name': section_name,
-            'subsection_name': subsection_name,
-            'margin_percent': old_margin_percent,
-        }
-        
-        new_data = {
-            'section_name': section_name,
-            'subsection_name': subsection_name,
-            'margin_percent': new_margin_percent,
-            'updated_lines': updated_lines,
-        }
+        # One write for all lines: subtotals and margins are recomputed once.
+        # Prices set by the margin tools are not pulled back to section targets,
+        # and the cached margin tree is dropped once instead of being patched
+        # line by line
+        if commands:
+            self.with_context(skip_margin_targets=True, skip_margin_deltas=True).write({'order_line': commands})
+            self._invalidate_margin_trees()
         
-        # Save to history
+        # Force recalculation of order totals
+        self._refresh_section_margins()
+        return updated_lines
+
+    def _save_margin_history(self, adjustment_type, old_data, new_data):
+        """Record an adjustment in the margin history without failing it"""
         try:
             self.env['sale.order.margin.history'].create_history(
-                self.id, 'subsection', old_data, new_data
+                self.id, adjustment_type, old_data, new_data
             )
         except Exception as e:
+            # Don't fail if history fails, just log it
             import logging
             _logger = logging.getLogger(__name__)
             _logger.warning(f'Error saving margin history: {str(e)}')
-        
-        return {
-            'success': True,
-            'message': f'Successfully adjusted {len(subsection_lines)} products in subsection',
-            'section_name': section_name,
-            'subsection_name': subsection_name,
-            'old_margin_percent': old_margin_percent,
-            'new_margin_percent': new_margin_percent,
-            'adjustment_factor': adjustment_factor,
-            'updated_lines': updated_lines
-        }
 
+    @with_unit_cost_scope
     def adjust_product_margin(self, line_id, target_margin_percent):
         """
         Adjust price of a single product line to achieve target margin percentage.
@@ -844,11 +1771,7 @@ class SaleOrder(models.Model):
         old_price_unit = float(line.price_unit) if line.price_unit else 0.0
         
         # Get cost and round to 2 decimals for precision
-        cost_per_unit = 0.0
-        if hasattr(line, 'purchase_price') and line.purchase_price:
-            cost_per_unit = round(float(line.purchase_price), 2)
-        elif hasattr(line.product_id, 'standard_price') and line.product_id.standard_price:
-            cost_per_unit = round(float(line.product_id.standard_price), 2)
+        cost_per_unit = round(self.env['sale.order.margin.cost'].get_unit_costs(line)[line.id], 2)
         
         if cost_per_unit == 0:
             return {
@@ -875,12 +1798,12 @@ class SaleOrder(models.Model):
         old_margin = old_subtotal - old_cost_total
         old_margin_percent = (old_margin / old_subtotal * 100) if old_subtotal > 0 else 0
         
-        # Update price with rounded value
-        line.price_unit = new_price_unit
+        # Update price with rounded value; an explicit adjustment must not be
+        # repriced back to the target of its section at commit
+        line.with_context(skip_margin_targets=True).price_unit = new_price_unit
         
         # Force recalculation
-        self._compute_section_margins_json()
-        self._compute_section_margins_html()
+        self._refresh_section_margins()
         
         # Calculate new margin
         new_subtotal = new_price_unit * qty
@@ -902,16 +1825,10 @@ class SaleOrder(models.Model):
         }
         
         # Save to history
-        try:
-            self.env['sale.order.margin.history'].create_history(
-                self.id, 'product', old_data, new_data
-            )
-        except Exception as e:
-            # Don't fail if history fails, just log it
-            import logging
-            _logger = logging.getLogger(__name__)
-            _logger.warning(f'Error saving margin history: {str(e)}')
+        self._save_margin_history('product', old_data, new_data)
         
+        self._notify_margin_change(line.ids)
+
         return {
             'success': True,
             'message': f'Successfully adjusted product price',
@@ -922,7 +1839,7 @@ class SaleOrder(models.Model):
             'new_margin_percent': new_margin_percent,
         }
 
-    def _generate_margin_history_html(self):
+    def _generate_margin_history_html(self, margin_version=''):
         """Generate HTML to display margin history - returns HTML string"""
         self.ensure_one()
         
@@ -961,12 +1878,22 @@ class SaleOrder(models.Model):
             """
         
         # Build HTML table (when there are records)
-        html = """
-        <div class="history-container">
+        html = f"""
+        <div class="history-container" data-margin-version="{margin_version}">
             <h4 class="history-header">
                 <i class="fa fa-history"></i>
                 <span>Modification History</span>
                 <span class="subtitle">(last 20)</span>
+                <div class="history-restore-to">
+                    <input type="datetime-local"
+                           class="restore_margins_to_input"
+                           data-order-id="{self.id}" />
+                    <button type="button"
+                            class="btn btn-sm btn-secondary restore_margins_to_btn"
+                            data-order-id="{self.id}">
+                        <i class="fa fa-clock-o"></i>Restore to date
+                    </button>
+                </div>
             </h4>
             <div class="table-responsive">
                 <table class="table history-table">
@@ -991,7 +1918,7 @@ class SaleOrder(models.Model):
                 date_str = record.create_date.strftime('%d/%m/%Y %H:%M')
             
             # Get user name
-            user_name = record.create_uid.name if record.create_uid else ''
+            user_name = escape(record.create_uid.name if record.create_uid else '')
             
             # Type badge class
             if record.adjustment_type == 'product':
@@ -1000,6 +1927,15 @@ class SaleOrder(models.Model):
             elif record.adjustment_type == 'subsection':
                 type_class = 'subsection'
                 type_label = 'Subsection'
+            elif record.adjustment_type == 'order':
+                type_class = 'order'
+                type_label = 'Order'
+            elif record.adjustment_type == 'restore':
+                type_class = 'restore'
+                type_label = 'Restore'
+            elif record.adjustment_type == 'target':
+                type_class = 'target'
+                type_label = 'Target'
             else:
                 type_class = 'section'
                 type_label = 'Section'
@@ -1009,8 +1945,17 @@ class SaleOrder(models.Model):
                 item_name = record.product_name
             elif record.adjustment_type == 'subsection':
                 item_name = f"{record.section_name} / {record.subsection_name}" if record.subsection_name else record.section_name
+            elif record.adjustment_type == 'order':
+                item_name = 'All sections'
+            elif record.adjustment_type == 'restore':
+                restore_date = record.restore_date.strftime('%d/%m/%Y %H:%M') if record.restore_date else ''
+                item_name = f'Prices as of {restore_date}'
+            elif record.adjustment_type == 'target':
+                item_name = 'Section targets'
             else:
                 item_name = record.section_name
+            # Section and product names are user input
+            item_name = escape(item_name or '')
             
             html += f"""
                         <tr>
@@ -1037,7 +1982,7 @@ class SaleOrder(models.Model):
                                         class="btn btn-sm btn-secondary rollback_margin_btn" 
                                         data-order-id="{self.id}"
                                         data-history-id="{record.id}"
-                                        data-item-name="{item_name or ''}"
+                                        data-item-name="{item_name}"
                                         data-old-margin="{record.old_margin_percent:.2f}"
                                         data-new-margin="{record.new_margin_percent:.2f}">
                                     <i class="fa fa-undo"></i>Restore
@@ -1055,6 +2000,7 @@ class SaleOrder(models.Model):
         
         return html
 
+    @with_unit_cost_scope
     def rollback_margin(self, history_id):
         """
         Restore a previous margin value from the history record
@@ -1063,6 +2009,8 @@ class SaleOrder(models.Model):
         :return: dict with the result
         """
         self.ensure_one()
+        # Restored prices are not pulled back to section targets
+        self = self.with_context(skip_margin_targets=True)
         
         history = self.env['sale.order.margin.history'].browse(history_id)
         
@@ -1089,19 +2037,17 @@ class SaleOrder(models.Model):
                     }
                 
                 # Restore previous price
-                line.price_unit = history.old_price_unit
-                
-                # Force recalculation
-                self._compute_section_margins_json()
-                self._compute_section_margins_html()
+                self._apply_line_prices(line, [history.old_price_unit])
                 
+                self._notify_margin_change(line.ids)
+
                 return {
                     'success': True,
                     'message': f'Margin for "{history.product_name}" restored to {history.old_margin_percent:.2f}%'
                 }
                 
-            elif history.adjustment_type == 'section':
-                # Restore all products in the section
+            elif history.adjustment_type in ('section', 'order', 'restore', 'target'):
+                # Restore all products in the section (or the whole order)
                 if not history.affected_lines:
                     return {
                         'success': False,
@@ -1109,7 +2055,8 @@ class SaleOrder(models.Model):
                     }
                 
                 affected_lines_data = json.loads(history.affected_lines)
-                restored_count = 0
+                lines = self.env['sale.order.line']
+                old_prices = []
                 
                 for line_data in affected_lines_data:
                     line_id = line_data.get('line_id')
@@ -1120,8 +2067,9 @@ class SaleOrder(models.Model):
                     if line.exists() and line.order_id == self:
                         old_price = line_data.get('old_price')
                         if old_price:
-                            line.price_unit = old_price
-                            restored_count += 1
+                            lines += line
+                            old_prices.append(old_price)
+                restored_count = len(lines)
                 
                 if restored_count == 0:
                     return {
@@ -1129,13 +2077,16 @@ class SaleOrder(models.Model):
                         'message': 'Could not restore any lines'
                     }
                 
-                # Force recalculation
-                self._compute_section_margins_json()
-                self._compute_section_margins_html()
+                # All lines in one write
+                self._apply_line_prices(lines, old_prices)
                 
+                self._notify_margin_change(lines.ids)
+
+                item_label = {'order': 'Order', 'restore': 'Prices', 'target': 'Section targets'}.get(
+                    history.adjustment_type, f'Section "{history.section_name}"')
                 return {
                     'success': True,
-                    'message': f'Section "{history.section_name}" restored to {history.old_margin_percent:.2f}% ({restored_count} products)'
+                    'message': f'{item_label} restored to {history.old_margin_percent:.2f}% ({restored_count} products)'
                 }
             
             elif history.adjustment_type == 'subsection':
@@ -1147,7 +2098,8 @@ class SaleOrder(models.Model):
                     }
                 
                 affected_lines_data = json.loads(history.affected_lines)
-                restored_count = 0
+                lines = self.env['sale.order.line']
+                old_prices = []
                 
                 for line_data in affected_lines_data:
                     line_id = line_data.get('line_id')
@@ -1158,8 +2110,9 @@ class SaleOrder(models.Model):
                     if line.exists() and line.order_id == self:
                         old_price = line_data.get('old_price')
                         if old_price:
-                            line.price_unit = old_price
-                            restored_count += 1
+                            lines += line
+                            old_prices.append(old_price)
+                restored_count = len(lines)
                 
                 if restored_count == 0:
                     return {
@@ -1167,10 +2120,11 @@ class SaleOrder(models.Model):
                         'message': 'Could not restore any lines'
                     }
                 
-                # Force recalculation
-                self._compute_section_margins_json()
-                self._compute_section_margins_html()
+                # All lines in one write
+                self._apply_line_prices(lines, old_prices)
                 
+                self._notify_margin_change(lines.ids)
+
                 return {
                     'success': True,
                     'message': f'Subsection "{history.subsection_name}" restored to {history.old_margin_percent:.2f}% ({restored_count} products)'
@@ -1191,3 +2145,86 @@ class SaleOrder(models.Model):
                 'success': False,
                 'message': f'Error restoring: {str(e)}'
             }
+
+    @with_unit_cost_scope
+    def restore_margins_to(self, timestamp=None, history_id=None):
+        """
+        Restore the prices the order had at a point in time.
+
+        Every history entry recorded after that point is folded into one net
+        price per line (the price the line had before the oldest of those
+        entries touched it), then all lines are written at once and a single
+        history entry records the restore.
+
+        :param timestamp: restore the prices as of this UTC datetime
+        :param history_id: or restore the prices as they were just before
+            this history entry (exact even when entries share a timestamp)
+        :return: dict with the result
+        """
+        self.ensure_one()
+
+        domain = [('order_id', '=', self.id)]
+        if history_id:
+            history = self.env['sale.order.margin.history'].browse(int(history_id)).exists()
+            if not history or history.order_id != self:
+                return {
+                    'success': False,
+                    'message': 'History record not found'
+                }
+            domain.append(('id', '>=', history.id))
+            timestamp = history.create_date
+        elif timestamp:
+            timestamp = fields.Datetime.to_datetime(timestamp)
+            domain.append(('create_date', '>', timestamp))
+        else:
+            return {
+                'success': False,
+                'message': 'No point in time to restore to'
+            }
+
+        # Newest first, so the oldest entry of each line is the one that stays
+        net_prices = {}
+        for history in self.env['sale.order.margin.history'].search(domain, order='id desc'):
+            if history.adjustment_type == 'product':
+                if history.line_id:
+                    net_prices[history.line_id.id] = history.old_price_unit
+                continue
+            for line_data in json.loads(history.affected_lines or '[]'):
+                if line_data.get('line_id') and line_data.get('old_price') is not None:
+                    net_prices[line_data['line_id']] = line_data['old_price']
+
+        lines = self.order_line.filtered(lambda l: l.id in net_prices and not l.display_type)
+        if not lines:
+            return {
+                'success': False,
+                'message': 'No margin changes to restore after that point'
+            }
+
+        old_margin_percent = self._get_margin_tree().total_margin_percent
+        updated_lines = self._apply_line_prices(lines, [net_prices[line.id] for line in lines])
+        if not updated_lines:
+            return {
+                'success': False,
+                'message': 'Prices already match that point in time'
+            }
+        new_margin_percent = self._get_margin_tree().total_margin_percent
+
+        old_data = {
+            'margin_percent': old_margin_percent,
+            'restore_date': timestamp,
+        }
+        new_data = {
+            'margin_percent': new_margin_percent,
+            'updated_lines': updated_lines,
+        }
+        self._save_margin_history('restore', old_data, new_data)
+
+        self._notify_margin_change([line['line_id'] for line in updated_lines])
+
+        return {
+            'success': True,
+            'message': f'Prices restored on {len(updated_lines)} products, order margin {new_margin_percent:.2f}%',
+            'old_margin_percent': old_margin_percent,
+            'new_margin_percent': new_margin_percent,
+            'updated_lines': updated_lines
+        }
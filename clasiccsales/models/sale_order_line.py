@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api
+from odoo.exceptions import ValidationError
+
+from ..tools.margin_tree import MARGIN_GROUP_DEPTHS
+
+
+# Fields whose edition only changes the amounts of a line, not the section
+# structure: cached margin trees can be patched incrementally
+MARGIN_DELTA_FIELDS = {
+    'price_unit', 'technical_price_unit', 'product_uom_qty', 'discount', 'purchase_price',
+}
+
+# Fields that affect the margin tree: editing them invalidates frozen trees
+MARGIN_TREE_FIELDS = MARGIN_DELTA_FIELDS | {
+    'sequence', 'display_type', 'name', 'product_id', 'order_id', 'margin_depth',
+}
+
+# Fields that pull a line away from the target margin of its section
+MARGIN_TARGET_FIELDS = MARGIN_DELTA_FIELDS | {'product_id', 'margin_target_percent'}
+
+# Fields that move lines between sections: every target of the order is checked
+MARGIN_TARGET_STRUCTURE_FIELDS = {'sequence', 'display_type', 'margin_depth'}
+
+# Fields the unit cost of a line is resolved from
+MARGIN_COST_FIELDS = {'purchase_price', 'product_id'}
+
+# Context keys controlling the margin hooks of line create/write:
+# - defer_section_margins: bulk mode for imports and scripts writing many
+#   lines. Cached trees are not patched and target sections are not tracked
+#   line by line; each affected order is rebuilt on its next read and has
+#   all its targets checked once when the targets flush (end of the order
+#   save, or commit).
+# - skip_margin_deltas: do not patch cached trees, the caller invalidates them
+# - skip_margin_targets: the new prices must not be repriced to section targets
+
+
+class SaleOrderLine(models.Model):
+    _inherit = 'sale.order.line'
+
+    frozen_unit_cost = fields.Float(
+        string='Frozen Unit Cost',
+        digits='Product Price',
+        copy=False,
+        readonly=True,
+        help='Unit cost recorded when the order was confirmed or locked, '
+             'used when margins are computed from frozen quote costs.',
+    )
+
+    margin_depth = fields.Integer(
+        string='Margin Level',
+        compute='_compute_margin_depth',
+        store=True,
+        readonly=False,
+        precompute=True,
+        help='Nesting level of a section line in the margins tab: sections default to 1 '
+             'and subsections to 2. A section line closes every open group of the same '
+             'or a deeper level, so higher levels nest further.',
+    )
+
+    margin_target_percent = fields.Float(
+        string='Target Margin (%)',
+        digits=(16, 2),
+        help='Margin the products of this section are kept at when target enforcement '
+             'is enabled. Products of a nested section with its own target follow that '
+             'target instead. 0 means no target.',
+    )
+
+    # Groups a line belongs to in the margins tab, stored so reports can
+    # aggregate by section without walking the lines of every order
+    margin_section_id = fields.Many2one(
+        'sale.order.line',
+        string='Margin Section',
+        compute='_compute_margin_groups',
+        store=True,
+        help='Section (level 1) the line belongs to in the margins tab.',
+    )
+
+    margin_subsection_id = fields.Many2one(
+        'sale.order.line',
+        string='Margin Subsection',
+        compute='_compute_margin_groups',
+        store=True,
+        help='Innermost nested group the line belongs to in the margins tab, '
+             'empty when the line sits directly under its section.',
+    )
+
+    @api.depends('display_type')
+    def _compute_margin_depth(self):
+        for line in self:
+            line.margin_depth = MARGIN_GROUP_DEPTHS.get(line.display_type, 0)
+
+    margin_target_line_id = fields.Many2one(
+        'sale.order.line',
+        string='Margin Target Section',
+        compute='_compute_margin_groups',
+        store=True,
+        help='Innermost section above the line that has a target margin: the one '
+             'its price follows when targets are enforced.',
+    )
+
+    @api.depends('order_id.order_line.sequence', 'order_id.order_line.display_type',
+                 'order_id.order_line.margin_depth', 'order_id.order_line.margin_target_percent')
+    def _compute_margin_groups(self):
+        """
+        Walk the lines of each order once, in display order.
+
+        A level 1 group starts a new section; a deeper group is the innermost
+        open one until the next group line, and only counts after a section.
+        Targets follow the open groups the way _enforce_margin_targets does.
+        """
+        no_line = self.env['sale.order.line']
+        groups = {}
+        for order in self.order_id:
+            section = subsection = no_line
+            # Open groups: [(level, innermost group line with a target)]
+            stack = []
+            for line in order.order_line.sorted(lambda l: (l.sequence, l._origin.id or 0)):
+                if line.display_type in MARGIN_GROUP_DEPTHS:
+                    if line.margin_depth <= 1:
+                        section, subsection = line, no_line
+                    elif section:
+                        subsection = line
+                    while stack and stack[-1][0] >= line.margin_depth:
+                        stack.pop()
+                    parent_target = stack[-1][1] if stack else no_line
+                    stack.append((line.margin_depth, line if line.margin_target_percent else parent_target))
+                groups[line.id] = (section, subsection, stack[-1][1] if stack else no_line)
+        for line in self:
+            (line.margin_section_id, line.margin_subsection_id,
+             line.margin_target_line_id) = groups.get(line.id, (no_line, no_line, no_line))
+
+    @api.constrains('display_type', 'margin_depth')
+    def _check_margin_depth(self):
+        for line in self:
+            if line.display_type in MARGIN_GROUP_DEPTHS and line.margin_depth < 1:
+                raise ValidationError('The margin level of a section must be 1 or more.')
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        lines = super().create(vals_list)
+        lines.order_id._unfreeze_section_margins()
+        if self.env.context.get('defer_section_margins'):
+            lines.order_id._mark_margin_targets()
+        else:
+            lines.order_id._mark_margin_targets(lines)
+        return lines
+
+    def unlink(self):
+        orders = self.order_id
+        result = super().unlink()
+        orders._unfreeze_section_margins()
+        orders._mark_margin_targets()
+        return result
+
+    def write(self, vals):
+        if not MARGIN_COST_FIELDS.isdisjoint(vals):
+            self.env['sale.order.margin.cost']._invalidate_unit_costs(self)
+        if not MARGIN_TREE_FIELDS.isdisjoint(vals):
+            self.order_id._unfreeze_section_margins()
+        deferred = self.env.context.get('defer_section_margins')
+        if not MARGIN_TARGET_STRUCTURE_FIELDS.isdisjoint(vals):
+            self.order_id._mark_margin_targets()
+        elif not MARGIN_TARGET_FIELDS.isdisjoint(vals):
+            self.order_id._mark_margin_targets(None if deferred else self)
+        if (len(self) != 1 or not set(vals) <= MARGIN_DELTA_FIELDS
+                # Bulk repricing drops the cached tree once when it is done
+                or self.env.context.get('skip_margin_deltas') or deferred
+                # Deltas are taken from the stored line margin
+                or not self.env['sale.order.margin.cost']._uses_line_margin()):
+            # Structural changes (sequence, display_type, name, product...) are
+            # picked up by the version token and trigger a full rebuild
+            return super().write(vals)
+
+        # Single line edited from the form: patch the cached tree of its order
+        order = self.order_id
+        entry = order._get_margin_tree_to_patch()
+        if not entry:
+            return super().write(vals)
+        old_margin = float(self.margin or 0.0)
+        old_subtotal = float(self.price_subtotal or 0.0)
+        old_hash = order._get_margin_row_hash(self)
+        result = super().write(vals)
+        order._apply_margin_delta(entry, self, old_margin, old_subtotal, old_hash)
+        return result
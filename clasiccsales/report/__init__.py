@@ -0,0 +1,5 @@
+# -*- coding: utf-8 -*-
+
+from . import section_margin_report
+from . import section_margin_snapshot
+from . import section_margin_kpi
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api
+from dateutil.relativedelta import relativedelta
+
+# KPI dimension -> field grouped on, in the snapshot and the history
+KPI_GROUPS = {'user': 'user_id', 'team': 'team_id'}
+KPI_PERIODS = ('day', 'week', 'month', 'quarter', 'year')
+
+
+class SectionMarginKpi(models.AbstractModel):
+    _name = 'sale.order.margin.kpi'
+    _description = 'Section Margin KPIs'
+
+    # Margin KPIs per salesperson or team and period. Every figure comes
+    # from one grouped query on stored data: the section margin snapshot
+    # for margins and targets, the margin history for adjustment counts.
+
+    @api.model
+    def get_kpis(self, group_by='user', period='month', date_from=None, date_to=None):
+        """
+        Return the margin KPIs grouped by salesperson or team and period.
+
+        :param group_by: 'user' or 'team'
+        :param period: 'day', 'week', 'month', 'quarter' or 'year'
+        :param date_from: first date included (default: twelve months ago)
+        :param date_to: last date included (default: today)
+        :return: dict with one row per group and period, most recent first
+        """
+        if group_by not in KPI_GROUPS:
+            return {
+                'success': False,
+                'message': f'Unknown grouping "{group_by}"'
+            }
+        if period not in KPI_PERIODS:
+            return {
+                'success': False,
+                'message': f'Unknown period "{period}"'
+            }
+        date_to = fields.Date.to_date(date_to) or fields.Date.context_today(self)
+        date_from = fields.Date.to_date(date_from) or date_to - relativedelta(months=12)
+        # Datetime bounds: the whole last day is included
+        start = fields.Datetime.to_datetime(date_from)
+        end = fields.Datetime.to_datetime(date_to) + relativedelta(days=1)
+        group_field = KPI_GROUPS[group_by]
+
+        rows = {}
+
+        def row(group, period_start):
+            key = (group.id, period_start)
+            if key not in rows:
+                rows[key] = {
+                    'group_id': group.id or False,
+                    'group_name': group.display_name if group else 'Undefined',
+                    'period': fields.Date.to_string(period_start) if period_start else False,
+                    'price_subtotal': 0.0,
+                    'margin': 0.0,
+                    'margin_percent': 0.0,
+                    'avg_section_margin_percent': 0.0,
+                    'section_count': 0,
+                    'target_count': 0,
+                    'target_hit_count': 0,
+                    'target_hit_rate': 0.0,
+                    'adjustment_count': 0,
+                }
+            return rows[key]
+
+        snapshot_groups = self.env['sale.order.section.margin.snapshot']._read_group(
+            [('date_order', '>=', start), ('date_order', '<', end), ('state', '!=', 'cancel')],
+            groupby=[group_field, f'date_order:{period}'],
+            aggregates=['price_subtotal:sum', 'margin:sum', 'section_count:sum', 'section_margin_percent:sum',
+                        'target_count:sum', 'target_hit_count:sum'],
+        )
+        for group, period_start, subtotal, margin, sections, section_percents, targets, hits in snapshot_groups:
+            data = row(group, period_start)
+            data.update({
+                'price_subtotal': subtotal or 0.0,
+                'margin': margin or 0.0,
+                # Overall margin, weighted by amount
+                'margin_percent': margin / subtotal * 100 if subtotal else 0.0,
+                # Mean of the section margins, each section weighing the same
+                'avg_section_margin_percent': section_percents / sections if sections else 0.0,
+                'section_count': sections or 0,
+                'target_count': targets or 0,
+                'target_hit_count': hits or 0,
+                'target_hit_rate': hits / targets * 100 if targets else 0.0,
+            })
+
+        history_groups = self.env['sale.order.margin.history']._read_group(
+            [('create_date', '>=', start), ('create_date', '<', end)],
+            groupby=[group_field, f'create_date:{period}'],
+            aggregates=['__count'],
+        )
+        for group, period_start, count in history_groups:
+            row(group, period_start)['adjustment_count'] = count
+
+        return {
+            'success': True,
+            'group_by': group_by,
+            'period': period,
+            'date_from': fields.Date.to_string(date_from),
+            'date_to': fields.Date.to_string(date_to),
+            'refreshed_at': self.env['ir.config_parameter'].sudo().get_param(
+                'clasiccsales.section_margin_snapshot_refreshed_at', False),
+            # Most recent period first, groups by name within a period
+            'rows': sorted(sorted(rows.values(), key=lambda r: r['group_name']),
+                           key=lambda r: r['period'] or '', reverse=True),
+        }
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api, tools
+from odoo.tools import SQL
+
+
+class SectionMarginReport(models.Model):
+    _name = 'sale.order.section.margin.report'
+    _description = 'Section Margin Analysis'
+    _auto = False
+    _rec_name = 'section_name'
+    _order = 'date_order desc'
+
+    # Every product line of every order, attributed to the section and
+    # subsection it belongs to with the same rules as the margins tab (see
+    # the stored margin_section_id / margin_subsection_id of the lines):
+    # only product lines with a positive subtotal, a subsection only counts
+    # when it follows a section. With deeper margin levels, the subsection
+    # is the innermost group the line belongs to.
+
+    order_id = fields.Many2one('sale.order', string='Order', readonly=True)
+    line_id = fields.Many2one('sale.order.line', string='Order Line', readonly=True)
+    line_name = fields.Char(string='Description', readonly=True)
+    line_sequence = fields.Integer(string='Sequence', readonly=True)
+    product_id = fields.Many2one('product.product', string='Product', readonly=True)
+    section_line_id = fields.Many2one('sale.order.line', string='Section Line', readonly=True)
+    subsection_line_id = fields.Many2one('sale.order.line', string='Subsection Line', readonly=True)
+    # Section line whose target margin the line follows, see margin_target_line_id
+    target_line_id = fields.Many2one('sale.order.line', string='Target Section Line', readonly=True)
+    section_name = fields.Char(string='Section', readonly=True)
+    subsection_name = fields.Char(string='Subsection', readonly=True)
+
+    date_order = fields.Datetime(string='Order Date', readonly=True)
+    state = fields.Selection([
+        ('draft', 'Quotation'),
+        ('sent', 'Quotation Sent'),
+        ('sale', 'Sales Order'),
+        ('cancel', 'Cancelled'),
+    ], string='Status', readonly=True)
+    user_id = fields.Many2one('res.users', string='Salesperson', readonly=True)
+    team_id = fields.Many2one('crm.team', string='Sales Team', readonly=True)
+    partner_id = fields.Many2one('res.partner', string='Customer', readonly=True)
+    company_id = fields.Many2one('res.company', string='Company', readonly=True)
+
+    # Amounts converted to the company currency
+    price_subtotal = fields.Float(string='Untaxed Amount', readonly=True)
+    cost = fields.Float(string='Cost', readonly=True)
+    margin = fields.Float(string='Margin', readonly=True)
+    margin_percent = fields.Float(string='Margin (%)', readonly=True, aggregator='avg')
+
+    def _query(self, order_ids=None):
+        """
+        Line-level section attribution query.
+
+        A plain join on the stored groups of each line, so filters on the
+        order or line columns are applied before any line is read.
+
+        :param order_ids: restrict the query to these orders
+        """
+        order_filter = SQL("AND l.order_id = ANY(%s)", list(order_ids)) if order_ids is not None else SQL()
+        return SQL("""
+            SELECT l.id AS id,
+                   l.order_id AS order_id,
+                   l.id AS line_id,
+                   l.name AS line_name,
+                   l.sequence AS line_sequence,
+                   l.product_id AS product_id,
+                   sec.id AS section_line_id,
+                   sub.id AS subsection_line_id,
+                   l.margin_target_line_id AS target_line_id,
+                   COALESCE(NULLIF(sec.name, ''), CASE WHEN sec.id IS NOT NULL THEN 'Unnamed' END) AS section_name,
+                   COALESCE(NULLIF(sub.name, ''), CASE WHEN sub.id IS NOT NULL THEN 'Unnamed' END) AS subsection_name,
+                   so.date_order AS date_order,
+                   so.state AS state,
+                   so.user_id AS user_id,
+                   so.team_id AS team_id,
+                   so.partner_id AS partner_id,
+                   so.company_id AS company_id,
+                   l.price_subtotal / COALESCE(NULLIF(so.currency_rate, 0), 1.0) AS price_subtotal,
+                   (l.price_subtotal - COALESCE(l.margin, 0)) / COALESCE(NULLIF(so.currency_rate, 0), 1.0) AS cost,
+                   COALESCE(l.margin, 0) / COALESCE(NULLIF(so.currency_rate, 0), 1.0) AS margin,
+                   COALESCE(l.margin, 0) / l.price_subtotal * 100 AS margin_percent
+              FROM sale_order_line l
+              JOIN sale_order so ON so.id = l.order_id
+         LEFT JOIN sale_order_line sec ON sec.id = l.margin_section_id
+         LEFT JOIN sale_order_line sub ON sub.id = l.margin_subsection_id
+             WHERE l.display_type IS NULL
+               AND l.product_id IS NOT NULL
+               AND l.price_subtotal > 0
+               %s
+        """, order_filter)
+
+    def init(self):
+        tools.drop_view_if_exists(self.env.cr, self._table)
+        self.env.cr.execute(SQL("CREATE OR REPLACE VIEW %s AS (%s)", SQL.identifier(self._table), self._query()))
+
+    def _read_group_select(self, aggregate_spec, query):
+        # Margin % of a group is its total margin over its total amount,
+        # not the average of the line percentages
+        if aggregate_spec == 'margin_percent:avg':
+            return SQL(
+                'SUM(%s) / NULLIF(SUM(%s), 0) * 100',
+                self._field_to_sql(self._table, 'margin', query),
+                self._field_to_sql(self._table, 'price_subtotal', query),
+            )
+        return super()._read_group_select(aggregate_spec, query)
+
+    # ------------------------------------------------------------------
+    # Export
+    # ------------------------------------------------------------------
+
+    @api.model
+    def _iter_export_rows(self, order_ids, chunk_size=200):
+        """
+        Yield the section/subsection/product margin breakdown of many orders.
+
+        Orders are processed in chunks straight from SQL; section and
+        subsection totals are accumulated while walking the ordered product
+        lines and emitted as soon as the section changes, so memory use does
+        not depend on the number of orders or lines.
+
+        :param order_ids: IDs of the orders to export (record rules apply)
+        :return: generator of tuples matching EXPORT_HEADER
+        """
+        for start in range(0, len(order_ids), chunk_size):
+            orders = self.env['sale.order'].search([('id', 'in', order_ids[start:start + chunk_size])])
+            if not orders:
+                continue
+            self.env.cr.execute(SQL("""
+                SELECT so.id, so.name, p.complete_name
+                  FROM sale_order so
+                  JOIN res_partner p ON p.id = so.partner_id
+                 WHERE so.id = ANY(%s)
+            """, orders.ids))
+            headers = {order_id: (name, partner) for order_id, name, partner in self.env.cr.fetchall()}
+
+            self.env.cr.execute(SQL("""
+                SELECT r.order_id, r.section_line_id, r.section_name, r.subsection_line_id,
+                       r.subsection_name, r.line_name, r.price_subtotal, r.cost, r.margin
+                  FROM (%s) r
+              ORDER BY r.order_id, r.line_sequence, r.line_id
+            """, self._query(orders.ids)))
+
+            current_order = None
+            current_section = None
+            current_subsection = None
+            totals = {}
+            while True:
+                rows = self.env.cr.fetchmany(1000)
+                for order_id, section_id, section, subsection_id, subsection, line_name, subtotal, cost, margin in rows:
+                    if order_id != current_order:
+                        yield from self._flush_export_totals(totals, ('subsection', 'section', 'order'))
+                        current_order, current_section, current_subsection = order_id, None, None
+                    elif section_id != current_section:
+                        yield from self._flush_export_totals(totals, ('subsection', 'section'))
+                        current_subsection = None
+                    elif subsection_id != current_subsection:
+                        yield from self._flush_export_totals(totals, ('subsection',))
+                    current_section, current_subsection = section_id, subsection_id
+
+                    order_name, partner_name = headers[order_id]
+                    base = (order_name, partner_name, section or '', subsection or '')
+                    yield base + ('Product', line_name or '', subtotal, cost, margin, _percent(margin, subtotal))
+                    for level, key in (('subsection', subsection_id), ('section', section_id), ('order', order_id)):
+                        if key is None:
+                            continue
+                        total = totals.setdefault(level, [base[:2] + (
+                            section or '' if level != 'order' else '',
+                            subsection or '' if level == 'subsection' else '',
+                        ), 0.0, 0.0, 0.0])
+                        total[1] += subtotal
+                        total[2] += cost
+                        total[3] += margin
+                if not rows:
+                    break
+            yield from self._flush_export_totals(totals, ('subsection', 'section', 'order'))
+            self.env.invalidate_all()
+
+    @api.model
+    def _flush_export_totals(self, totals, levels):
+        """Emit and reset the running totals of the given levels"""
+        labels = {'subsection': 'Subsection Total', 'section': 'Section Total', 'order': 'Order Total'}
+        for level in levels:
+            total = totals.pop(level, None)
+            if total:
+                base, subtotal, cost, margin = total
+                yield base + (labels[level], '', subtotal, cost, margin, _percent(margin, subtotal))
+
+
+EXPORT_HEADER = (
+    'Order', 'Customer', 'Section', 'Subsection', 'Level', 'Description',
+    'Untaxed Amount', 'Cost', 'Margin', 'Margin (%)',
+)
+
+
+def _percent(margin, subtotal):
+    return round(margin / subtotal * 100, 2) if subtotal else 0.0
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+from odoo import models, fields, api
+from odoo.tools import SQL
+from datetime import timedelta
+import logging
+
+_logger = logging.getLogger(__name__)
+
+WATERMARK_PARAM = 'clasiccsales.section_margin_snapshot_watermark'
+REFRESHED_AT_PARAM = 'clasiccsales.section_margin_snapshot_refreshed_at'
+
+# Lines committed by transactions still running when a refresh starts can
+# carry a write_date slightly older than the watermark: re-read this window
+WATERMARK_OVERLAP = timedelta(minutes=5)
+
+
+class SectionMarginSnapshot(models.Model):
+    _name = 'sale.order.section.margin.snapshot'
+    _description = 'Section Margin Snapshot'
+    _log_access = False
+    _rec_name = 'section_name'
+    _order = 'date_order desc'
+
+    # One row per order, section, subsection and target section, aggregated
+    # from sale.order.section.margin.report and refreshed incrementally by
+    # cron for the orders whose lines changed since the last run.
+    #
+    # Section and target figures are carried by a single row of their
+    # section or target (the others hold 0), so summing them over any
+    # grouping counts each section and each target once.
+
+    order_id = fields.Many2one('sale.order', string='Order', readonly=True, index=True, ondelete='cascade')
+    section_line_id = fields.Many2one('sale.order.line', string='Section Line', readonly=True)
+    subsection_line_id = fields.Many2one('sale.order.line', string='Subsection Line', readonly=True)
+    target_line_id = fields.Many2one('sale.order.line', string='Target Section Line', readonly=True)
+    section_name = fields.Char(string='Section', readonly=True)
+    subsection_name = fields.Char(string='Subsection', readonly=True)
+
+    date_order = fields.Datetime(string='Order Date', readonly=True, index=True)
+    state = fields.Selection([
+        ('draft', 'Quotation'),
+        ('sent', 'Quotation Sent'),
+        ('sale', 'Sales Order'),
+        ('cancel', 'Cancelled'),
+    ], string='Status', readonly=True)
+    user_id = fields.Many2one('res.users', string='Salesperson', readonly=True, index=True)
+    team_id = fields.Many2one('crm.team', string='Sales Team', readonly=True, index=True)
+    partner_id = fields.Many2one('res.partner', string='Customer', readonly=True)
+    company_id = fields.Many2one('res.company', string='Company', readonly=True)
+
+    line_count = fields.Integer(string='# Lines', readonly=True)
+    price_subtotal = fields.Float(string='Untaxed Amount', readonly=True)
+    cost = fields.Float(string='Cost', readonly=True)
+    margin = fields.Float(string='Margin', readonly=True)
+    margin_percent = fields.Float(string='Margin (%)', readonly=True, aggregator='avg')
+    section_count = fields.Integer(string='# Sections', readonly=True)
+    # Margin % of the whole section; over section_count it gives the mean
+    # section margin, each section weighing the same whatever its amount
+    section_margin_percent = fields.Float(string='Section Margin (%)', readonly=True)
+    # Target the lines follow when targets are enforced, checked on all the
+    # lines of the order that follow the same target section
+    target_margin_percent = fields.Float(string='Target Margin (%)', readonly=True, aggregator='avg')
+    target_count = fields.Integer(string='# With Target', readonly=True)
+    target_hit_count = fields.Integer(string='# Target Hit', readonly=True)
+    refreshed_at = fields.Datetime(string='Refreshed At', readonly=True)
+
+    def _read_group_select(self, aggregate_spec, query):
+        # Same weighting as the live report: total margin over total amount
+        if aggregate_spec == 'margin_percent:avg':
+            return SQL(
+                'SUM(%s) / NULLIF(SUM(%s), 0) * 100',
+                self._field_to_sql(self._table, 'margin', query),
+                self._field_to_sql(self._table, 'price_subtotal', query),
+            )
+        return super()._read_group_select(aggregate_spec, query)
+
+    # ------------------------------------------------------------------
+    # Refresh
+    # ------------------------------------------------------------------
+
+    @api.model
+    def _get_changed_order_ids(self, since):
+        """Orders whose header or lines were written since the given datetime"""
+        if not since:
+            self.env.cr.execute("SELECT id FROM sale_order ORDER BY id")
+            return [row[0] for row in self.env.cr.fetchall()]
+        since = since - WATERMARK_OVERLAP
+        self.env.cr.execute("""
+            SELECT order_id FROM sale_order_line WHERE write_date > %s
+             UNION
+            SELECT id FROM sale_order WHERE write_date > %s
+             ORDER BY 1
+        """, [since, since])
+        return [row[0] for row in self.env.cr.fetchall()]
+
+    @api.model
+    def _refresh_orders(self, order_ids, refreshed_at):
+        """Replace the snapshot rows of the given orders"""
+        report_query = self.env['sale.order.section.margin.report']._query(order_ids)
+        self.env.cr.execute(SQL(
+            "DELETE FROM sale_order_section_margin_snapshot WHERE order_id = ANY(%s)",
+            list(order_ids),
+        ))
+        self.env.cr.execute(SQL("""
+            INSERT INTO sale_order_section_margin_snapshot (
+                order_id, section_line_id, subsection_line_id, target_line_id, section_name, subsection_name,
+                date_order, state, user_id, team_id, partner_id, company_id,
+                line_count, price_subtotal, cost, margin, margin_percent,
+                section_count, section_margin_percent,
+                target_margin_percent, target_count, target_hit_count, refreshed_at)
+            SELECT g.order_id, g.section_line_id, g.subsection_line_id, g.target_line_id,
+                   g.section_name, g.subsection_name,
+                   g.date_order, g.state, g.user_id, g.team_id, g.partner_id, g.company_id,
+                   g.line_count, g.price_subtotal, g.cost, g.margin, g.margin_percent,
+                   CASE WHEN g.section_line_id IS NOT NULL AND g.section_row = 1 THEN 1 ELSE 0 END,
+                   CASE WHEN g.section_line_id IS NOT NULL AND g.section_row = 1 AND g.section_subtotal > 0
+                        THEN g.section_margin / g.section_subtotal * 100 ELSE 0 END,
+                   g.target,
+                   CASE WHEN g.target IS NOT NULL AND g.target_row = 1 THEN 1 ELSE 0 END,
+                   CASE WHEN g.target IS NOT NULL AND g.target_row = 1 AND g.target_subtotal > 0
+                             AND g.target_margin / g.target_subtotal * 100 >= g.target - 0.005
+                        THEN 1 ELSE 0 END,
+                   %s
+              FROM (
+                SELECT r.order_id, r.section_line_id, r.subsection_line_id, r.target_line_id,
+                       r.section_name, r.subsection_name,
+                       r.date_order, r.state, r.user_id, r.team_id, r.partner_id, r.company_id,
+                       count(*) AS line_count,
+                       sum(r.price_subtotal) AS price_subtotal,
+                       sum(r.cost) AS cost,
+                       sum(r.margin) AS margin,
+                       CASE WHEN sum(r.price_subtotal) > 0
+                            THEN sum(r.margin) / sum(r.price_subtotal) * 100
+                            ELSE 0 END AS margin_percent,
+                       NULLIF(t.margin_target_percent, 0) AS target,
+                       -- Totals of the whole section and of all the lines following the target
+                       row_number() OVER section_rows AS section_row,
+                       sum(sum(r.price_subtotal)) OVER section_all AS section_subtotal,
+                       sum(sum(r.margin)) OVER section_all AS section_margin,
+                       row_number() OVER target_rows AS target_row,
+                       sum(sum(r.price_subtotal)) OVER target_all AS target_subtotal,
+                       sum(sum(r.margin)) OVER target_all AS target_margin
+                  FROM (%s) r
+             LEFT JOIN sale_order_line t ON t.id = r.target_line_id
+              GROUP BY r.order_id, r.section_line_id, r.subsection_line_id, r.target_line_id,
+                       r.section_name, r.subsection_name,
+                       r.date_order, r.state, r.user_id, r.team_id, r.partner_id, r.company_id,
+                       t.margin_target_percent
+                WINDOW section_all AS (PARTITION BY r.order_id, r.section_line_id),
+                       section_rows AS (section_all ORDER BY min(r.line_sequence), r.subsection_line_id, r.target_line_id),
+                       target_all AS (PARTITION BY r.order_id, r.target_line_id),
+                       target_rows AS (target_all ORDER BY min(r.line_sequence), r.subsection_line_id, r.section_line_id)
+              ) g
+        """, refreshed_at, report_query))
+
+    @api.model
+    def refresh_snapshot(self, full=False, chunk_size=500, commit=False):
+        """
+        Bring the snapshot up to date.
+
+        :param full: rebuild every order instead of the changed ones only
+        :param chunk_size: number of orders refreshed per statement
+        :param commit: commit after each chunk (cron), so an interrupted run
+            keeps its progress; the watermark only moves once all chunks are done
+        :return: number of refreshed orders
+        """
+        params = self.env['ir.config_parameter'].sudo()
+        self.env.flush_all()
+        self.env.cr.execute("SELECT now() AT TIME ZONE 'UTC'")
+        started_at = self.env.cr.fetchone()[0]
+
+        watermark = None if full else fields.Datetime.to_datetime(params.get_param(WATERMARK_PARAM))
+        if full:
+            self.env.cr.execute("TRUNCATE sale_order_section_margin_snapshot")
+        order_ids = self._get_changed_order_ids(watermark)
+
+        for start in range(0, len(order_ids), chunk_size):
+            self._refresh_orders(order_ids[start:start + chunk_size], started_at)
+            if commit:
+                self.env.cr.commit()
+
+        params.set_param(WATERMARK_PARAM, fields.Datetime.to_string(started_at))
+        params.set_param(REFRESHED_AT_PARAM, fields.Datetime.to_string(started_at))
+        self.invalidate_model()
+        _logger.info('Section margin snapshot refreshed for %s orders (full=%s)', len(order_ids), full)
+        return len(order_ids)
+
+    @api.model
+    def _cron_refresh_snapshot(self):
+        self.refresh_snapshot(commit=True)
+
+    @api.model
+    def action_rebuild_snapshot(self):
+        """Recovery: rebuild the whole snapshot from the order lines"""
+        count = self.refresh_snapshot(full=True)
+        return {
+            'type': 'ir.actions.client',
+            'tag': 'display_notification',
+            'params': {
+                'type': 'success',
+                'message': f'Section margin snapshot rebuilt ({count} orders).',
+                'next': {'type': 'ir.actions.client', 'tag': 'reload'},
+            },
+        }
+
+    @api.model
+    def get_staleness(self):
+        """
+        Describe how far the snapshot lags behind the order lines.
+
+        :return: dict with the last refresh date, its age in seconds and the
+            number of orders changed since then
+        """
+        params = self.env['ir.config_parameter'].sudo()
+        refreshed_at = fields.Datetime.to_datetime(params.get_param(REFRESHED_AT_PARAM))
+        watermark = fields.Datetime.to_datetime(params.get_param(WATERMARK_PARAM))
+        if not refreshed_at:
+            return {
+                'refreshed_at': False,
+                'age_seconds': None,
+                'pending_orders': self.env['sale.order'].search_count([]),
+            }
+        self.env.cr.execute("""
+            SELECT count(*) FROM (
+                SELECT order_id FROM sale_order_line WHERE write_date > %s
+                 UNION
+                SELECT id FROM sale_order WHERE write_date > %s
+            ) changed
+        """, [watermark, watermark])
+        return {
+            'refreshed_at': fields.Datetime.to_string(refreshed_at),
+            'age_seconds': (fields.Datetime.now() - refreshed_at).total_seconds(),
+            'pending_orders': self.env.cr.fetchone()[0],
+        }
@@ -1,29 +1,53 @@
 /** @odoo-module **/
 
-// Simple RPC function using fetch, returns a Promise
-async function odooRPC(route, params) {
-    const response = await fetch(route, {
-        method: 'POST',
-        headers: {
-            'Content-Type': 'application/json',
-        },
-        body: JSON.stringify({
-            jsonrpc: '2.0',
-            method: 'call',
-            params: params,
-            id: new Date().getTime(),
-        }),
-    });
-
-    const data = await response.json();
-
-    if (data.error) {
-        throw new Error(data.error.data?.message || data.error.message || 'RPC Error');
+import { registry } from "@web/core/registry";
+import { escape } from "@web/core/utils/strings";
+import { marginRpc, RpcAbortError } from "./margin_rpc";
+
+// Message shown when an RPC fails or is aborted
+function rpcErrorMessage(error) {
+    if (error instanceof RpcAbortError && error.reason === 'timeout') {
+        return 'The server is taking too long to respond. Reload the page to check the result.';
     }
+    return 'Error communicating with server';
+}
 
-    return data.result;
+// Longest time the client waits for a background margin job
+const MARGIN_JOB_MAX_WAIT = 15 * 60 * 1000;
+
+/**
+ * Poll a background margin job until it finishes, returns the final status.
+ * Gives up after MARGIN_JOB_MAX_WAIT, and rejects with a superseded
+ * RpcAbortError once `signal` is aborted (the margins tab went away).
+ */
+async function waitForMarginJob(jobId, signal, interval = 2000, maxWait = MARGIN_JOB_MAX_WAIT) {
+    const deadline = Date.now() + maxWait;
+    while (Date.now() < deadline) {
+        await new Promise((resolve) => setTimeout(resolve, interval));
+        if (signal.aborted) {
+            throw new RpcAbortError('superseded');
+        }
+        const status = await marginRpc.call('/sale_order/margin_job_status', {
+            job_id: jobId,
+        }, { channel: `margin_job:${jobId}` });
+        if (signal.aborted) {
+            throw new RpcAbortError('superseded');
+        }
+        if (!status.success || status.state === 'done' || status.state === 'failed') {
+            return status;
+        }
+    }
+    return {
+        success: false,
+        message: 'The adjustment is still running in the background. Reload the page later to see the result.',
+    };
 }
 
+// Version token of the margins currently displayed around an element
+function getMarginVersion(element) {
+    const container = element.closest('[data-margin-version]');
+    return container ? container.getAttribute('data-margin-version') || null : null;
+}
 
 // Show a temporary notification
 function showNotification(message, type = 'success') {
@@ -42,7 +66,8 @@ function showNotification(message, type = 'success') {
         max-width: 400px;
         animation: slideIn 0.3s ease-out;
     `;
-    notification.innerHTML = `<i class="fa fa-${type === 'success' ? 'check' : 'exclamation'}-circle"></i> ${message}`;
+    // Messages can contain section and product names
+    notification.innerHTML = `<i class="fa fa-${type === 'success' ? 'check' : 'exclamation'}-circle"></i> ${escape(message)}`;
 
     document.body.appendChild(notification);
 
@@ -149,14 +174,16 @@ function showConfirmDialog(title, message, confirmText = 'Confirm', cancelText =
     });
 }
 
-// Wait for DOM to be ready
-document.addEventListener('DOMContentLoaded', function() {
-    initMarginAdjuster();
-});
+/**
+ * Attach the margin adjustment handlers to the margins tab container.
+ * Listeners are scoped to the container; returns a function detaching them.
+ */
+export function attachMarginAdjuster(container) {
+    // Aborted on detach: stops polling background jobs
+    const polling = new AbortController();
 
-function initMarginAdjuster() {
     // Listen for input changes to show/hide apply button
-    document.body.addEventListener('input', function(e) {
+    const onInput = function(e) {
         // Handle section inputs
         let input = e.target.closest('.section_margin_input');
         let btnClass = '.apply_margin_btn';
@@ -167,6 +194,12 @@ function initMarginAdjuster() {
             btnClass = '.apply_subsection_margin_btn';
         }
         
+        // Handle the order total input
+        if (!input) {
+            input = e.target.closest('.order_margin_input');
+            btnClass = '.apply_order_margin_btn';
+        }
+        
         // Handle product inputs (COMMENTED - NOT USED CURRENTLY)
         // if (!input) {
         //     input = e.target.closest('.product_margin_input');
@@ -188,10 +221,10 @@ function initMarginAdjuster() {
                 applyBtn.style.display = 'none';
             }
         }
-    });
+    };
     
-    // Use event delegation to handle dynamically loaded content
-    document.body.addEventListener('click', async function(e) {
+    // Use event delegation to handle re-rendered content
+    const onApplyClick = async function(e) {
         // Check if clicked element or its parent is one of the apply buttons
         let btn = e.target.closest('.apply_margin_btn');
         let adjustType = 'section';
@@ -201,6 +234,11 @@ function initMarginAdjuster() {
             adjustType = 'subsection';
         }
         
+        if (!btn) {
+            btn = e.target.closest('.apply_order_margin_btn');
+            adjustType = 'order';
+        }
+        
         // Product margin adjustment (COMMENTED - NOT USED CURRENTLY)
         // if (!btn) {
         //     btn = e.target.closest('.apply_product_margin_btn');
@@ -223,27 +261,46 @@ function initMarginAdjuster() {
         }
 
         // Prepare parameters based on adjustment type
+        // Sections and subsections are addressed by line id when available,
+        // names are only sent for markup rendered before ids were exposed
         if (adjustType === 'section') {
-            const sectionName = btn.getAttribute('data-section-name');
+            const sectionId = parseInt(btn.getAttribute('data-section-id'));
             input = inputContainer.querySelector('.section_margin_input');
             targetMargin = parseFloat(input.value);
-            route = '/sale_order/adjust_section_margin';
-            params = {
-                order_id: parseInt(orderId),
-                section_name: sectionName,
-                target_margin_percent: targetMargin
-            };
+            if (sectionId) {
+                route = '/sale_order/adjust_section_margin_by_id';
+                params = { order_id: parseInt(orderId), section_line_id: sectionId };
+            } else {
+                route = '/sale_order/adjust_section_margin';
+                params = { order_id: parseInt(orderId), section_name: btn.getAttribute('data-section-name') };
+            }
+            params.target_margin_percent = targetMargin;
+            params.margin_version = getMarginVersion(btn);
         } else if (adjustType === 'subsection') {
-            const sectionName = btn.getAttribute('data-section-name');
-            const subsectionName = btn.getAttribute('data-subsection-name');
+            const subsectionId = parseInt(btn.getAttribute('data-subsection-id'));
             input = inputContainer.querySelector('.subsection_margin_input');
             targetMargin = parseFloat(input.value);
-            route = '/sale_order/adjust_subsection_margin';
+            if (subsectionId) {
+                route = '/sale_order/adjust_subsection_margin_by_id';
+                params = { order_id: parseInt(orderId), subsection_line_id: subsectionId };
+            } else {
+                route = '/sale_order/adjust_subsection_margin';
+                params = {
+                    order_id: parseInt(orderId),
+                    section_name: btn.getAttribute('data-section-name'),
+                    subsection_name: btn.getAttribute('data-subsection-name'),
+                };
+            }
+            params.target_margin_percent = targetMargin;
+            params.margin_version = getMarginVersion(btn);
+        } else if (adjustType === 'order') {
+            input = inputContainer.querySelector('.order_margin_input');
+            targetMargin = parseFloat(input.value);
+            route = '/sale_order/adjust_order_margin';
             params = {
                 order_id: parseInt(orderId),
-                section_name: sectionName,
-                subsection_name: subsectionName,
-                target_margin_percent: targetMargin
+                target_margin_percent: targetMargin,
+                margin_version: getMarginVersion(btn)
             };
         }
         // Product margin adjustment (COMMENTED - NOT USED CURRENTLY)
@@ -271,31 +328,53 @@ function initMarginAdjuster() {
         btn.innerHTML = '<i class="fa fa-spinner fa-spin"></i>';
 
         try {
-            const result = await odooRPC(route, params);
+            // Debounced per target: rapid retries on the same row send a single request
+            const target = params.section_line_id || params.subsection_line_id
+                || (adjustType === 'order' ? 'all' : `${params.section_name}:${params.subsection_name || ''}`);
+            const channel = `adjust:${orderId}:${adjustType}:${target}`;
+            let result = await marginRpc.debouncedCall(route, params, { channel });
+
+            if (result.success && result.async) {
+                // Large adjustment: wait for the background job to finish
+                showNotification(result.message, 'success');
+                const status = await waitForMarginJob(result.job_id, polling.signal);
+                result = status.state === 'done' ? status.result : {
+                    success: false,
+                    message: status.message || 'Error adjusting margin',
+                };
+            }
 
             if (result.success) {
                 // Show success notification
-                const itemType = adjustType === 'section' ? 'Section' : 'Product';
+                const itemType = { section: 'Section', subsection: 'Subsection', order: 'Order' }[adjustType] || 'Product';
                 showNotification(`${itemType} margin adjusted to ${result.new_margin_percent.toFixed(2)}%`, 'success');
                 
                 // Reload the page to show all updated values
                 setTimeout(() => {
                     window.location.reload();
                 }, 1000);
+            } else if (result.stale) {
+                // Margins changed in another tab or session: refresh instead of retrying
+                showNotification(result.message, 'error');
+                setTimeout(() => {
+                    window.location.reload();
+                }, 1500);
             } else {
                 showNotification(result.message || 'Error adjusting margin', 'error');
                 btn.disabled = false;
                 btn.innerHTML = originalHtml;
             }
         } catch (error) {
-            showNotification('Error communicating with server', 'error');
+            if (!(error instanceof RpcAbortError && error.reason === 'superseded')) {
+                showNotification(rpcErrorMessage(error), 'error');
+            }
             btn.disabled = false;
             btn.innerHTML = originalHtml;
         }
-    });
+    };
     
     // Handle rollback buttons
-    document.body.addEventListener('click', async function(e) {
+    const onRollbackClick = async function(e) {
         const btn = e.target.closest('.rollback_margin_btn');
         if (!btn) return;
 
@@ -320,7 +399,7 @@ function initMarginAdjuster() {
             `<div style="display: flex; flex-direction: column; gap: 12px;">
                 <div style="text-align: center; padding: 8px 12px; background: linear-gradient(135deg, #f5f7fa 0%, #c3cfe2 100%); border-radius: 5px;">
                     <span style="font-size: 11px; color: #6c757d; text-transform: uppercase; letter-spacing: 0.3px; font-weight: 600;">Item: </span>
-                    <span style="font-size: 13px; font-weight: 700; color: #2d3748;">${itemName}</span>
+                    <span style="font-size: 13px; font-weight: 700; color: #2d3748;">${escape(itemName)}</span>
                 </div>
                 <div style="display: flex; gap: 10px; justify-content: space-between; align-items: center;">
                     <div style="flex: 1; text-align: center; padding: 12px 15px; background-color: #fff3cd; border: 2px solid #ffc107; border-radius: 5px;">
@@ -350,10 +429,20 @@ function initMarginAdjuster() {
         btn.innerHTML = '<i class="fa fa-spinner fa-spin"></i>';
 
         try {
-            const result = await odooRPC('/sale_order/rollback_margin', {
+            let result = await marginRpc.call('/sale_order/rollback_margin', {
                 order_id: parseInt(orderId),
-                history_id: parseInt(historyId)
-            });
+                history_id: parseInt(historyId),
+                margin_version: getMarginVersion(btn)
+            }, { channel: `rollback:${orderId}` });
+
+            if (result.success && result.async) {
+                showNotification(result.message, 'success');
+                const status = await waitForMarginJob(result.job_id, polling.signal);
+                result = status.state === 'done' ? status.result : {
+                    success: false,
+                    message: status.message || 'Error restoring margin',
+                };
+            }
 
             if (result.success) {
                 showNotification(result.message || 'Margin restored successfully', 'success');
@@ -362,62 +451,121 @@ function initMarginAdjuster() {
                 setTimeout(() => {
                     window.location.reload();
                 }, 1000);
+            } else if (result.stale) {
+                showNotification(result.message, 'error');
+                setTimeout(() => {
+                    window.location.reload();
+                }, 1500);
             } else {
                 showNotification(result.message || 'Error restoring margin', 'error');
                 btn.disabled = false;
                 btn.innerHTML = originalHtml;
             }
         } catch (error) {
-            showNotification('Error communicating with server', 'error');
+            if (!(error instanceof RpcAbortError && error.reason === 'superseded')) {
+                showNotification(rpcErrorMessage(error), 'error');
+            }
             btn.disabled = false;
             btn.innerHTML = originalHtml;
         }
-    });
-}
+    };
 
-// Try to initialize immediately in case DOM is already ready
-if (document.readyState !== 'loading') {
-    initMarginAdjuster();
-}
+    // Handle the restore-to-date button of the history
+    const onRestoreToClick = async function(e) {
+        const btn = e.target.closest('.restore_margins_to_btn');
+        if (!btn) return;
 
-// Add CSS animations
-const style = document.createElement('style');
-style.textContent = `
-    @keyframes slideIn {
-        from { transform: translateX(400px); opacity: 0; }
-        to { transform: translateX(0); opacity: 1; }
-    }
-    @keyframes slideOut {
-        from { transform: translateX(0); opacity: 1; }
-        to { transform: translateX(400px); opacity: 0; }
-    }
-    @keyframes fadeIn {
-        from { opacity: 0; }
-        to { opacity: 1; }
-    }
-    @keyframes fadeOut {
-        from { opacity: 1; }
-        to { opacity: 0; }
-    }
-    @keyframes zoomIn {
-        from { 
-            transform: scale(0.7);
-            opacity: 0;
+        e.preventDefault();
+        e.stopPropagation();
+
+        const orderId = btn.getAttribute('data-order-id');
+        const input = btn.closest('.history-restore-to').querySelector('.restore_margins_to_input');
+        const localValue = input ? input.value : '';
+
+        if (!orderId || orderId.toString().startsWith('NewId_')) {
+            showNotification('⚠️ Please save the sales order first', 'error');
+            return;
         }
-        to { 
-            transform: scale(1);
-            opacity: 1;
+        if (!localValue) {
+            showNotification('⚠️ Please choose the date to restore the prices to', 'error');
+            return;
         }
-    }
-    @keyframes zoomOut {
-        from { 
-            transform: scale(1);
-            opacity: 1;
+
+        // The input is in the browser timezone, the history is stored in UTC
+        const timestamp = new Date(localValue).toISOString().slice(0, 19).replace('T', ' ');
+
+        const confirmed = await showConfirmDialog(
+            'Restore Prices?',
+            `<div style="text-align: center; padding: 8px 12px;">
+                Every margin change made after
+                <strong>${new Date(localValue).toLocaleString()}</strong>
+                will be undone in a single update.
+            </div>`,
+            'Restore',
+            'Cancel'
+        );
+
+        if (!confirmed) {
+            return;
         }
-        to { 
-            transform: scale(0.7);
-            opacity: 0;
+
+        btn.disabled = true;
+        const originalHtml = btn.innerHTML;
+        btn.innerHTML = '<i class="fa fa-spinner fa-spin"></i>';
+
+        try {
+            let result = await marginRpc.call('/sale_order/restore_margins_to', {
+                order_id: parseInt(orderId),
+                timestamp: timestamp,
+                margin_version: getMarginVersion(btn)
+            }, { channel: `rollback:${orderId}` });
+
+            if (result.success && result.async) {
+                showNotification(result.message, 'success');
+                const status = await waitForMarginJob(result.job_id, polling.signal);
+                result = status.state === 'done' ? status.result : {
+                    success: false,
+                    message: status.message || 'Error restoring prices',
+                };
+            }
+
+            if (result.success) {
+                showNotification(result.message || 'Prices restored successfully', 'success');
+                setTimeout(() => {
+                    window.location.reload();
+                }, 1000);
+            } else if (result.stale) {
+                showNotification(result.message, 'error');
+                setTimeout(() => {
+                    window.location.reload();
+                }, 1500);
+            } else {
+                showNotification(result.message || 'Error restoring prices', 'error');
+                btn.disabled = false;
+                btn.innerHTML = originalHtml;
+            }
+        } catch (error) {
+            if (!(error instanceof RpcAbortError && error.reason === 'superseded')) {
+                showNotification(rpcErrorMessage(error), 'error');
+            }
+            btn.disabled = false;
+            btn.innerHTML = originalHtml;
         }
-    }
-`;
-document.head.appendChild(style);
+    };
+
+    container.addEventListener('input', onInput);
+    container.addEventListener('click', onApplyClick);
+    container.addEventListener('click', onRollbackClick);
+    container.addEventListener('click', onRestoreToClick);
+
+    return () => {
+        polling.abort();
+        container.removeEventListener('input', onInput);
+        container.removeEventListener('click', onApplyClick);
+        container.removeEventListener('click', onRollbackClick);
+        container.removeEventListener('click', onRestoreToClick);
+    };
+}
+
+// Available once the lazy bundle is loaded, see SectionMarginsHtmlField
+registry.category("clasiccsales.margin_tools").add("margin_adjuster", attachMarginAdjuster);
@@ -0,0 +1,56 @@
+/** @odoo-module **/
+
+import { onWillUnmount, useEffect } from "@odoo/owl";
+import { useService } from "@web/core/utils/hooks";
+
+/**
+ * Receive the margin updates published for an order after each adjustment
+ * or rollback made in another session.
+ *
+ * The order is read again on every render: the form pager shows another
+ * order in the same component, which then listens on that order's channel.
+ *
+ * @param {Function} getOrderId returns the id of the displayed order
+ * @param {Function} callback called with the compact margin delta
+ */
+export function useMarginDeltas(getOrderId, callback) {
+    const busService = useService("bus_service");
+    const onDelta = (delta) => {
+        // The subscription type is shared by all open margin tabs
+        if (!delta.order_id || delta.order_id !== getOrderId()) {
+            return;
+        }
+        callback(delta);
+    };
+
+    busService.subscribe("clasiccsales/margin_delta", onDelta);
+    onWillUnmount(() => {
+        busService.unsubscribe("clasiccsales/margin_delta", onDelta);
+    });
+
+    useEffect(
+        (orderId) => {
+            if (!orderId) {
+                return;
+            }
+            const channel = `clasiccsales_margins_${orderId}`;
+            busService.addChannel(channel);
+            return () => busService.deleteChannel(channel);
+        },
+        () => [getOrderId()]
+    );
+}
+
+/**
+ * Index a margin delta by section line id, at every level.
+ */
+export function indexMarginDelta(delta) {
+    const nodes = new Map();
+    const stack = [...delta.sections];
+    while (stack.length) {
+        const node = stack.pop();
+        nodes.set(node.line_id, node);
+        stack.push(...(node.subsections || []));
+    }
+    return nodes;
+}
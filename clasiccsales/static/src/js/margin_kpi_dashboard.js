@@ -0,0 +1,72 @@
+/** @odoo-module **/
+
+import { Component, onWillStart, useState } from "@odoo/owl";
+import { registry } from "@web/core/registry";
+import { formatFloat } from "@web/views/fields/formatters";
+import { marginRpc, RpcAbortError } from "./margin_rpc";
+
+/**
+ * Margin KPIs by salesperson or team and period.
+ *
+ * Every figure is computed server-side by grouped queries on the section
+ * margin snapshot and the margin history (/sale_order/margin_kpis).
+ */
+export class MarginKpiDashboard extends Component {
+    static template = "clasiccsales.MarginKpiDashboard";
+    static props = ["*"];
+
+    setup() {
+        this.state = useState({
+            groupBy: "user",
+            period: "month",
+            rows: [],
+            refreshedAt: false,
+            error: null,
+            loading: true,
+        });
+        onWillStart(() => this.load());
+    }
+
+    async load() {
+        this.state.loading = true;
+        try {
+            const result = await marginRpc.call("/sale_order/margin_kpis", {
+                group_by: this.state.groupBy,
+                period: this.state.period,
+            }, { channel: "margin_kpis" });
+            if (result.success) {
+                this.state.rows = result.rows;
+                this.state.refreshedAt = result.refreshed_at;
+                this.state.error = null;
+            } else {
+                this.state.error = result.message;
+            }
+        } catch (error) {
+            if (error instanceof RpcAbortError && error.reason === "superseded") {
+                return;
+            }
+            this.state.error = error.message;
+        }
+        this.state.loading = false;
+    }
+
+    onGroupByChange(ev) {
+        this.state.groupBy = ev.target.value;
+        this.load();
+    }
+
+    onPeriodChange(ev) {
+        this.state.period = ev.target.value;
+        this.load();
+    }
+
+    formatAmount(value) {
+        return formatFloat(value || 0, { digits: [16, 2] });
+    }
+
+    formatPercent(value) {
+        return `${Number(value || 0).toFixed(2)} %`;
+    }
+}
+
+registry.category("actions").add("clasiccsales.margin_kpi_dashboard", MarginKpiDashboard);
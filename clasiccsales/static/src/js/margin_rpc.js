@@ -0,0 +1,128 @@
+/** @odoo-module **/
+
+// Monotonic JSON-RPC request id (timestamps collide on quick retries)
+let nextRequestId = 1;
+
+/**
+ * Raised when a request is aborted, either because it was superseded by a
+ * newer request on the same channel or because it timed out.
+ */
+export class RpcAbortError extends Error {
+    constructor(reason) {
+        super(reason === "timeout" ? "The server did not respond in time" : "Request superseded");
+        this.name = "RpcAbortError";
+        this.reason = reason;
+    }
+}
+
+/**
+ * Small JSON-RPC client for the margin routes.
+ *
+ * - identical calls (same route and params) in flight are coalesced into one
+ * - a call on a `channel` aborts the previous in-flight call on that channel
+ * - every call is aborted after `timeout` milliseconds
+ * - debouncedCall() waits for input to settle before sending anything
+ */
+export class MarginRpcClient {
+    constructor({ timeout = 30000, debounceDelay = 300 } = {}) {
+        this.timeout = timeout;
+        this.debounceDelay = debounceDelay;
+        this.inFlight = new Map();
+        this.channels = new Map();
+        this.pendingDebounces = new Map();
+    }
+
+    /**
+     * Send a JSON-RPC call, returns a Promise with the result.
+     *
+     * @param {string} route
+     * @param {Object} params
+     * @param {Object} [options] { channel, timeout }
+     */
+    call(route, params, options = {}) {
+        const key = `${route}:${JSON.stringify(params)}`;
+        if (this.inFlight.has(key)) {
+            return this.inFlight.get(key);
+        }
+
+        const controller = new AbortController();
+        const channel = options.channel;
+        if (channel) {
+            const previous = this.channels.get(channel);
+            if (previous) {
+                previous.abort();
+            }
+            this.channels.set(channel, controller);
+        }
+
+        let timedOut = false;
+        const timer = setTimeout(() => {
+            timedOut = true;
+            controller.abort();
+        }, options.timeout || this.timeout);
+
+        const promise = (async () => {
+            try {
+                const response = await fetch(route, {
+                    method: 'POST',
+                    headers: {
+                        'Content-Type': 'application/json',
+                    },
+                    body: JSON.stringify({
+                        jsonrpc: '2.0',
+                        method: 'call',
+                        params: params,
+                        id: nextRequestId++,
+                    }),
+                    signal: controller.signal,
+                });
+
+                const data = await response.json();
+
+                if (data.error) {
+                    throw new Error(data.error.data?.message || data.error.message || 'RPC Error');
+                }
+
+                return data.result;
+            } catch (error) {
+                if (error.name === 'AbortError') {
+                    throw new RpcAbortError(timedOut ? "timeout" : "superseded");
+                }
+                throw error;
+            } finally {
+                clearTimeout(timer);
+                this.inFlight.delete(key);
+                if (channel && this.channels.get(channel) === controller) {
+                    this.channels.delete(channel);
+                }
+            }
+        })();
+
+        this.inFlight.set(key, promise);
+        return promise;
+    }
+
+    /**
+     * Same as call(), but only sent once no other call was made on the same
+     * channel for `delay` milliseconds. Earlier calls are rejected with a
+     * "superseded" RpcAbortError.
+     */
+    debouncedCall(route, params, options = {}) {
+        const channel = options.channel || route;
+        const pending = this.pendingDebounces.get(channel);
+        if (pending) {
+            clearTimeout(pending.timer);
+            pending.reject(new RpcAbortError("superseded"));
+        }
+
+        return new Promise((resolve, reject) => {
+            const timer = setTimeout(() => {
+                this.pendingDebounces.delete(channel);
+                this.call(route, params, { ...options, channel }).then(resolve, reject);
+            }, options.delay || this.debounceDelay);
+            this.pendingDebounces.set(channel, { timer, reject });
+        });
+    }
+}
+
+export const marginRpc = new MarginRpcClient();
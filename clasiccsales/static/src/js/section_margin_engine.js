@@ -0,0 +1,157 @@
+/** @odoo-module **/
+
+/**
+ * Client-side port of build_margin_tree (tools/margin_tree.py).
+ *
+ * Computes the margin tree straight from order line values, so the form can
+ * show margins of unsaved orders and refresh them on every line edit without
+ * any server roundtrip. Any change to the grouping or aggregation rules must
+ * be made in both engines, and in the vectors both are tested against
+ * (static/tests/margin_tree_vectors.js).
+ */
+
+/**
+ * Margin percentage as displayed in the margins tab.
+ */
+export function marginPercent(margin, priceSubtotal) {
+    if (priceSubtotal > 0 && margin !== 0) {
+        return (margin / priceSubtotal) * 100;
+    }
+    return 0.0;
+}
+
+/**
+ * Margin of a product line: the line margin when available, otherwise the
+ * subtotal minus the line (or product) cost.
+ */
+function lineMargin(line, priceSubtotal) {
+    if (line.margin !== undefined && line.margin !== null && line.margin !== false) {
+        return Number(line.margin) || 0.0;
+    }
+    if (priceSubtotal > 0) {
+        const qty = Number(line.product_uom_qty) || 0.0;
+        const unitCost = Number(line.purchase_price) || Number(line.standard_price) || 0.0;
+        return priceSubtotal - unitCost * qty;
+    }
+    return 0.0;
+}
+
+// Default nesting level of section lines, see MARGIN_GROUP_DEPTHS
+const GROUP_DEPTHS = {
+    line_section: 1,
+    line_subsection: 2,
+};
+
+/**
+ * Build the margin tree from a list of order line values.
+ *
+ * Single pass with a stack of open groups: a section line closes every
+ * open group of the same or a deeper level, products are added to the
+ * innermost open group and totals are rolled up when a group is closed.
+ *
+ * @param {Object[]} lines order lines in display order, each with
+ *      id, display_type, name, product_id, price_subtotal, margin
+ *      (and optionally margin_depth / product_uom_qty / purchase_price)
+ * @returns {Object} same structure as the server-side margin tree
+ */
+export function computeSectionMargins(lines) {
+    const sections = [];
+    // Open groups, outermost first; node is null for groups placed before
+    // the first section, which are not part of the tree
+    const stack = [];
+    let totalMargin = 0.0;
+    let totalPriceSubtotal = 0.0;
+
+    const closeGroup = () => {
+        const { node } = stack.pop();
+        if (!node) {
+            return;
+        }
+        node.margin_percent = marginPercent(node.margin, node.price_subtotal);
+        const parent = stack.length ? stack[stack.length - 1].node : null;
+        if (parent) {
+            parent.margin += node.margin;
+            parent.price_subtotal += node.price_subtotal;
+        }
+    };
+
+    for (const line of lines) {
+        if (line.display_type in GROUP_DEPTHS) {
+            const depth = line.margin_depth || GROUP_DEPTHS[line.display_type];
+            while (stack.length && stack[stack.length - 1].depth >= depth) {
+                closeGroup();
+            }
+            const parent = stack.length ? stack[stack.length - 1].node : null;
+            let node = null;
+            if (parent || (!stack.length && depth === 1)) {
+                node = {
+                    line_id: line.id,
+                    name: line.name || "Unnamed",
+                    margin: 0.0,
+                    margin_percent: 0.0,
+                    price_subtotal: 0.0,
+                    subsections: [],
+                    products: [],
+                };
+                (parent ? parent.subsections : sections).push(node);
+            }
+            stack.push({ depth, node });
+        } else if (!line.display_type && line.product_id) {
+            const priceSubtotal = Number(line.price_subtotal) || 0.0;
+            // Only lines with a price are part of the tree
+            if (priceSubtotal <= 0) {
+                continue;
+            }
+            const margin = lineMargin(line, priceSubtotal);
+            const group = stack.length ? stack[stack.length - 1].node : null;
+            if (group) {
+                group.margin += margin;
+                group.price_subtotal += priceSubtotal;
+                group.products.push({
+                    line_id: line.id,
+                    name: line.name || line.product_id?.display_name || "Unnamed",
+                    margin: margin,
+                    margin_percent: (margin / priceSubtotal) * 100,
+                    price_subtotal: priceSubtotal,
+                });
+            }
+            totalMargin += margin;
+            totalPriceSubtotal += priceSubtotal;
+        }
+    }
+
+    while (stack.length) {
+        closeGroup();
+    }
+
+    return {
+        sections: sections,
+        total_margin: totalMargin,
+        total_margin_percent: marginPercent(totalMargin, totalPriceSubtotal),
+        total_price_subtotal: totalPriceSubtotal,
+    };
+}
+
+/**
+ * Extract engine input from the order_line x2many of a form record.
+ */
+export function linesFromRecord(record) {
+    const orderLines = record?.data?.order_line;
+    if (!orderLines || !Array.isArray(orderLines.records)) {
+        return null;
+    }
+    return orderLines.records.map((lineRecord) => {
+        const data = lineRecord.data;
+        return {
+            id: lineRecord.resId || lineRecord.id,
+            display_type: data.display_type,
+            margin_depth: data.margin_depth,
+            name: data.name,
+            product_id: data.product_id,
+            price_subtotal: data.price_subtotal,
+            margin: data.margin,
+            product_uom_qty: data.product_uom_qty,
+            purchase_price: data.purchase_price,
+        };
+    });
+}
@@ -0,0 +1,234 @@
+/** @odoo-module **/
+
+import { Component, onWillStart, onWillUpdateProps, useRef, useState } from "@odoo/owl";
+import { formatFloat } from "@web/views/fields/formatters";
+import { marginRpc } from "./margin_rpc";
+import { indexMarginDelta, useMarginDeltas } from "./margin_bus";
+
+// Every row has the same height so the visible slice can be computed
+// from the scroll position without measuring the DOM
+const ROW_HEIGHT = 36;
+const VIEWPORT_HEIGHT = 600;
+const OVERSCAN = 10;
+
+// Summaries already loaded in this browser tab: orderId -> { etag, summary }
+const summaryCache = new Map();
+
+/**
+ * Margin table for very large orders.
+ *
+ * Group totals, at every level, come from the summary tree; product rows are
+ * fetched per section or nested group when it is expanded. Only the rows in
+ * the visible part of the scroll viewport are rendered.
+ */
+export class SectionMarginVirtualTable extends Component {
+    static template = "clasiccsales.SectionMarginVirtualTable";
+    static props = {
+        orderId: Number,
+    };
+
+    setup() {
+        this.viewportRef = useRef("viewport");
+        this.rowHeight = ROW_HEIGHT;
+        this.viewportHeight = VIEWPORT_HEIGHT;
+        this.state = useState({
+            summary: null,
+            error: null,
+            expanded: {},
+            products: {},
+            loading: {},
+            scrollTop: 0,
+        });
+        this.scrollFrame = null;
+
+        onWillStart(() => this.loadSummary());
+        // The form pager shows another order in the same component
+        onWillUpdateProps((nextProps) => {
+            if (nextProps.orderId !== this.props.orderId) {
+                Object.assign(this.state, {
+                    summary: null,
+                    error: null,
+                    expanded: {},
+                    products: {},
+                    loading: {},
+                    scrollTop: 0,
+                });
+                return this.loadSummary(nextProps.orderId);
+            }
+        });
+        useMarginDeltas(() => this.props.orderId, (delta) => this.applyDelta(delta));
+    }
+
+    /**
+     * Apply a margin update pushed by another session: totals are patched in
+     * place and product rows of the changed nodes are fetched again.
+     */
+    applyDelta(delta) {
+        const summary = this.state.summary;
+        if (!summary) {
+            return;
+        }
+        const nodes = indexMarginDelta(delta);
+        const refresh = (node, key, sectionId, subsectionId) => {
+            const update = nodes.get(node.line_id);
+            if (!update || (update.margin === node.margin && update.margin_percent === node.margin_percent)) {
+                return;
+            }
+            node.margin = update.margin;
+            node.margin_percent = update.margin_percent;
+            delete this.state.products[key];
+            if (this.state.expanded[key]) {
+                this.loadProducts(key, sectionId, subsectionId);
+            }
+        };
+        const visit = (node, section) => {
+            for (const subsection of node.subsections || []) {
+                visit(subsection, section);
+            }
+            if (node === section) {
+                refresh(node, `section:${node.line_id}`, section.line_id, null);
+            } else {
+                refresh(node, `subsection:${node.line_id}`, section.line_id, node.line_id);
+            }
+        };
+        for (const section of summary.sections) {
+            visit(section, section);
+        }
+        summary.total_margin = delta.total_margin;
+        summary.total_margin_percent = delta.total_margin_percent;
+        summary.version = delta.version;
+        summaryCache.delete(this.props.orderId);
+    }
+
+    async loadSummary(orderId = this.props.orderId) {
+        const cached = summaryCache.get(orderId);
+        const result = await marginRpc.call("/sale_order/section_margin_summary", {
+            order_id: orderId,
+            etag: cached ? cached.etag : null,
+        }, { channel: `margin_summary:${orderId}` });
+        if (result.success) {
+            if (result.unchanged && cached) {
+                // Server confirmed our copy is current: nothing was rebuilt
+                this.state.summary = cached.summary;
+            } else {
+                summaryCache.set(orderId, { etag: result.etag, summary: result.summary });
+                this.state.summary = result.summary;
+            }
+            this.state.error = null;
+        } else {
+            this.state.error = result.message;
+        }
+    }
+
+    async loadProducts(key, sectionId, subsectionId) {
+        if (this.state.products[key] || this.state.loading[key]) {
+            return;
+        }
+        this.state.loading[key] = true;
+        try {
+            const result = await marginRpc.call("/sale_order/section_margin_products", {
+                order_id: this.props.orderId,
+                section_line_id: sectionId,
+                subsection_line_id: subsectionId || null,
+            });
+            this.state.products[key] = result.success ? result.products : [];
+        } finally {
+            delete this.state.loading[key];
+        }
+    }
+
+    toggle(row) {
+        if (!row.expandable) {
+            return;
+        }
+        const expanded = !this.state.expanded[row.key];
+        this.state.expanded[row.key] = expanded;
+        if (expanded && row.productCount) {
+            this.loadProducts(row.key, row.sectionId, row.subsectionId);
+        }
+    }
+
+    onScroll(ev) {
+        // Re-render at most once per animation frame while scrolling
+        const scrollTop = ev.target.scrollTop;
+        if (this.scrollFrame) {
+            return;
+        }
+        this.scrollFrame = requestAnimationFrame(() => {
+            this.scrollFrame = null;
+            this.state.scrollTop = scrollTop;
+        });
+    }
+
+    _pushProducts(rows, key, level) {
+        if (this.state.loading[key]) {
+            rows.push({ key: `${key}:loading`, type: "loading", level });
+            return;
+        }
+        for (const product of this.state.products[key] || []) {
+            rows.push({ key: `product:${product.line_id}`, type: "product", level, node: product });
+        }
+    }
+
+    /**
+     * Push the row of a section or nested group, then, when it is expanded,
+     * the rows of its nested groups and of its own products.
+     */
+    _pushGroup(rows, node, section, level) {
+        const isSection = node === section;
+        const key = `${isSection ? "section" : "subsection"}:${node.line_id}`;
+        const subsections = node.subsections || [];
+        rows.push({
+            key,
+            type: isSection ? "section" : "subsection",
+            level,
+            node,
+            section,
+            expandable: node.product_count > 0 || subsections.length > 0,
+            productCount: node.product_count,
+            sectionId: section.line_id,
+            subsectionId: isSection ? null : node.line_id,
+        });
+        if (!this.state.expanded[key]) {
+            return;
+        }
+        for (const subsection of subsections) {
+            this._pushGroup(rows, subsection, section, level + 1);
+        }
+        this._pushProducts(rows, key, level + 1);
+    }
+
+    /**
+     * Flat list of the rows currently visible in the tree (expanded nodes only).
+     */
+    get rows() {
+        const rows = [];
+        const summary = this.state.summary;
+        if (!summary) {
+            return rows;
+        }
+        for (const section of summary.sections) {
+            this._pushGroup(rows, section, section, 0);
+        }
+        return rows;
+    }
+
+    get visibleSlice() {
+        const rows = this.rows;
+        const start = Math.max(0, Math.floor(this.state.scrollTop / ROW_HEIGHT) - OVERSCAN);
+        const end = Math.min(rows.length, start + Math.ceil(VIEWPORT_HEIGHT / ROW_HEIGHT) + 2 * OVERSCAN);
+        return {
+            rows: rows.slice(start, end),
+            offset: start * ROW_HEIGHT,
+            totalHeight: rows.length * ROW_HEIGHT,
+        };
+    }
+
+    formatAmount(value) {
+        return formatFloat(Math.abs(value || 0), { digits: [16, 2] });
+    }
+
+    formatPercent(value) {
+        return `${Number(value || 0).toFixed(2)}`;
+    }
+}
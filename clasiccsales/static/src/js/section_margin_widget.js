@@ -1,13 +1,18 @@
 /** @odoo-module **/
 
 import { registry } from "@web/core/registry";
-import { Component, useState, onWillUpdateProps } from "@odoo/owl";
-import { standardFieldProps } from "@web/views/fields/standard_field_props";
+import { Component, useState } from "@odoo/owl";
+import { standardWidgetProps } from "@web/views/widgets/standard_widget_props";
 import { formatFloat } from "@web/views/fields/formatters";
+import { useRecordObserver } from "@web/model/relational_model/utils";
+import { computeSectionMargins, linesFromRecord } from "./section_margin_engine";
 
 /**
  * SectionMarginWidget shows margin data by section for a sales order.
  * All comments and messages are in English.
+ *
+ * View widget for unsaved orders: margins are computed from the order lines
+ * loaded in the form, section_margins_json is never read.
  */
 export class SectionMarginWidget extends Component {
     setup() {
@@ -18,11 +23,11 @@ export class SectionMarginWidget extends Component {
         });
 
         try {
-            this._updateData();
-
-            onWillUpdateProps(() => {
+            // Called on setup and again on every change of the record,
+            // including edits of its order lines
+            useRecordObserver((record) => {
                 try {
-                    this._updateData();
+                    this._updateData(record);
                 } catch (error) {
                     console.error("Error updating section margins:", error);
                 }
@@ -33,46 +38,21 @@ export class SectionMarginWidget extends Component {
     }
 
     /**
-     * Updates the component state with parsed data from the record.
+     * Updates the component state with margins computed from the record lines.
      */
-    _updateData() {
+    _updateData(record = this.props.record) {
         try {
-            if (!this.props || !this.props.record || !this.props.record.data) {
+            if (!record || !record.data) {
                 // If no data found, reset state.
                 return;
             }
 
-            const jsonData = this.props.record.data[this.props.name];
-            if (!jsonData) {
-                this.state.sections = [];
-                this.state.totalMargin = 0;
-                this.state.totalMarginPercent = 0;
-                return;
-            }
-
-            let data;
-            if (typeof jsonData === "string") {
-                try {
-                    data = JSON.parse(jsonData);
-                } catch (parseError) {
-                    console.error("Error parsing JSON string:", parseError);
-                    this.state.sections = [];
-                    this.state.totalMargin = 0;
-                    this.state.totalMarginPercent = 0;
-                    return;
-                }
-            } else if (typeof jsonData === 'object') {
-                data = jsonData;
-            } else {
-                this.state.sections = [];
-                this.state.totalMargin = 0;
-                this.state.totalMarginPercent = 0;
-                return;
-            }
-
-            this.state.sections = Array.isArray(data.sections) ? data.sections : [];
-            this.state.totalMargin = Number(data.total_margin) || 0;
-            this.state.totalMarginPercent = Number(data.total_margin_percent) || 0;
+            // Compute margins client-side from the loaded order lines: no RPC
+            const lines = linesFromRecord(record);
+            const tree = lines ? computeSectionMargins(lines) : null;
+            this.state.sections = tree ? tree.sections : [];
+            this.state.totalMargin = tree ? tree.total_margin : 0;
+            this.state.totalMarginPercent = tree ? tree.total_margin_percent : 0;
         } catch (error) {
             console.error("Error in _updateData:", error);
             this.state.sections = [];
@@ -132,12 +112,12 @@ export class SectionMarginWidget extends Component {
 
 SectionMarginWidget.template = "clasiccsales.SectionMarginWidget";
 SectionMarginWidget.props = {
-    ...standardFieldProps,
+    ...standardWidgetProps,
 };
 
-// Register the custom widget in the Odoo fields registry.
+// Register the custom widget in the Odoo view widgets registry.
 try {
-    registry.category("fields").add("section_margin_widget", {
+    registry.category("view_widgets").add("section_margin_widget", {
         component: SectionMarginWidget,
     });
 } catch (error) {
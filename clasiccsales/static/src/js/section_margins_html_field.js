@@ -0,0 +1,128 @@
+/** @odoo-module **/
+
+import { registry } from "@web/core/registry";
+import { loadBundle } from "@web/core/assets";
+import { Component, markup, onMounted, onWillStart, onWillUnmount, useRef } from "@odoo/owl";
+import { standardFieldProps } from "@web/views/fields/standard_field_props";
+import { SectionMarginVirtualTable } from "./section_margin_virtual_table";
+import { indexMarginDelta, useMarginDeltas } from "./margin_bus";
+
+// Same format as the server rendering ({:,.2f})
+function formatAmount(value) {
+    return Math.abs(value || 0).toLocaleString("en-US", {
+        minimumFractionDigits: 2,
+        maximumFractionDigits: 2,
+    });
+}
+
+/**
+ * Renders the server-generated margins tab and wires the margin adjuster.
+ *
+ * The adjuster lives in its own bundle, loaded only when this field is
+ * displayed, and its listeners are attached to this field's container only
+ * while it is mounted. Margin updates made in other sessions are received
+ * through the bus and patched into the rendered rows in place.
+ */
+export class SectionMarginsHtmlField extends Component {
+    setup() {
+        this.rootRef = useRef("root");
+        this.detachAdjuster = null;
+
+        onWillStart(async () => {
+            await loadBundle("clasiccsales.assets_margin_adjuster");
+        });
+
+        onMounted(() => {
+            const attach = registry.category("clasiccsales.margin_tools").get("margin_adjuster", null);
+            if (attach) {
+                this.detachAdjuster = attach(this.rootRef.el);
+            }
+        });
+
+        onWillUnmount(() => {
+            if (this.detachAdjuster) {
+                this.detachAdjuster();
+                this.detachAdjuster = null;
+            }
+        });
+
+        useMarginDeltas(() => this.props.record.resId, (delta) => this.applyDelta(delta));
+    }
+
+    /**
+     * Patch group, product and grand total rows with a bus delta.
+     * Large orders are handled by SectionMarginVirtualTable itself.
+     */
+    applyDelta(delta) {
+        const root = this.rootRef.el;
+        if (!root || this.props.record.data.section_margins_large) {
+            return;
+        }
+        const nodes = indexMarginDelta(delta);
+        for (const row of root.querySelectorAll("tr[data-margin-node]")) {
+            const node = nodes.get(parseInt(row.dataset.marginNode));
+            if (!node) {
+                continue;
+            }
+            const value = row.querySelector(".margin-value");
+            if (value) {
+                (value.querySelector("strong") || value).textContent = formatAmount(node.margin);
+            }
+            const input = row.querySelector("input[data-current-margin]");
+            if (input) {
+                const percent = node.margin_percent.toFixed(2);
+                // Do not overwrite a value the user is typing
+                if (input.value === input.getAttribute("data-current-margin")) {
+                    input.value = percent;
+                }
+                input.setAttribute("data-current-margin", percent);
+            }
+            row.classList.add("o_margin_updated");
+        }
+        const products = new Map((delta.products || []).map((product) => [product.line_id, product]));
+        for (const row of root.querySelectorAll("tr[data-margin-product]")) {
+            const product = products.get(parseInt(row.dataset.marginProduct));
+            if (!product) {
+                continue;
+            }
+            const value = row.querySelector(".margin-value");
+            if (value) {
+                value.textContent = formatAmount(product.margin);
+            }
+            const badge = row.querySelector(".margin-badge");
+            if (badge) {
+                badge.textContent = `${product.margin_percent.toFixed(2)}%`;
+            }
+            row.classList.add("o_margin_updated");
+        }
+        const totalValue = root.querySelector(".margin-total-value .total-value");
+        if (totalValue) {
+            totalValue.textContent = formatAmount(delta.total_margin);
+        }
+        const totalInput = root.querySelector(".order_margin_input");
+        if (totalInput) {
+            const percent = delta.total_margin_percent.toFixed(2);
+            if (totalInput.value === totalInput.getAttribute("data-current-margin")) {
+                totalInput.value = percent;
+            }
+            totalInput.setAttribute("data-current-margin", percent);
+        }
+        for (const container of root.querySelectorAll("[data-margin-version]")) {
+            container.setAttribute("data-margin-version", delta.version);
+        }
+    }
+
+    get html() {
+        return markup(this.props.record.data[this.props.name] || "");
+    }
+}
+
+SectionMarginsHtmlField.template = "clasiccsales.SectionMarginsHtmlField";
+SectionMarginsHtmlField.components = { SectionMarginVirtualTable };
+SectionMarginsHtmlField.props = {
+    ...standardFieldProps,
+};
+
+registry.category("fields").add("section_margins_html", {
+    component: SectionMarginsHtmlField,
+});
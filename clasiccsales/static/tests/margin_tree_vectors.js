@@ -0,0 +1,433 @@
+/** @odoo-module **/
+
+// Margin tree test vectors shared by the server and client engines: read by
+// tests/test_margin_tree.py and static/tests/section_margin_engine.test.js.
+// Everything after "export const marginTreeVectors =" is parsed as JSON by
+// the Python test, keep it strict JSON.
+//
+// Each vector lists order line values in display order and the expected
+// tree, amounts rounded to 2 digits, products as [line_id, name, margin,
+// price_subtotal].
+export const marginTreeVectors = [
+    {
+        "name": "sections and subsections",
+        "lines": [
+            {
+                "id": 1,
+                "display_type": "line_section",
+                "name": "Hardware"
+            },
+            {
+                "id": 2,
+                "display_type": false,
+                "name": "Server",
+                "product_id": 1,
+                "price_subtotal": 200,
+                "margin": 80
+            },
+            {
+                "id": 3,
+                "display_type": "line_subsection",
+                "name": "Cables"
+            },
+            {
+                "id": 4,
+                "display_type": false,
+                "name": "Cable",
+                "product_id": 1,
+                "price_subtotal": 50,
+                "margin": 30
+            },
+            {
+                "id": 5,
+                "display_type": "line_section",
+                "name": "Services"
+            },
+            {
+                "id": 6,
+                "display_type": false,
+                "name": "Install",
+                "product_id": 1,
+                "price_subtotal": 240,
+                "margin": 120
+            }
+        ],
+        "expected": {
+            "total_margin": 230,
+            "total_price_subtotal": 490,
+            "total_margin_percent": 46.94,
+            "sections": [
+                {
+                    "line_id": 1,
+                    "name": "Hardware",
+                    "margin": 110,
+                    "price_subtotal": 250,
+                    "margin_percent": 44,
+                    "products": [
+                        [
+                            2,
+                            "Server",
+                            80,
+                            200
+                        ]
+                    ],
+                    "subsections": [
+                        {
+                            "line_id": 3,
+                            "name": "Cables",
+                            "margin": 30,
+                            "price_subtotal": 50,
+                            "margin_percent": 60,
+                            "products": [
+                                [
+                                    4,
+                                    "Cable",
+                                    30,
+                                    50
+                                ]
+                            ],
+                            "subsections": []
+                        }
+                    ]
+                },
+                {
+                    "line_id": 5,
+                    "name": "Services",
+                    "margin": 120,
+                    "price_subtotal": 240,
+                    "margin_percent": 50,
+                    "products": [
+                        [
+                            6,
+                            "Install",
+                            120,
+                            240
+                        ]
+                    ],
+                    "subsections": []
+                }
+            ]
+        }
+    },
+    {
+        "name": "levels set by margin_depth",
+        "lines": [
+            {
+                "id": 1,
+                "display_type": "line_section",
+                "name": "Building"
+            },
+            {
+                "id": 2,
+                "display_type": "line_subsection",
+                "name": "Floor 1"
+            },
+            {
+                "id": 3,
+                "display_type": "line_subsection",
+                "name": "Room A",
+                "margin_depth": 3
+            },
+            {
+                "id": 4,
+                "display_type": false,
+                "name": "Desk",
+                "product_id": 1,
+                "price_subtotal": 100,
+                "margin": 25
+            },
+            {
+                "id": 5,
+                "display_type": "line_subsection",
+                "name": "Room B",
+                "margin_depth": 3
+            },
+            {
+                "id": 6,
+                "display_type": false,
+                "name": "Chair",
+                "product_id": 1,
+                "price_subtotal": 40,
+                "margin": 10
+            },
+            {
+                "id": 7,
+                "display_type": "line_subsection",
+                "name": "Floor 2"
+            },
+            {
+                "id": 8,
+                "display_type": false,
+                "name": "Lamp",
+                "product_id": 1,
+                "price_subtotal": 60,
+                "margin": 30
+            },
+            {
+                "id": 9,
+                "display_type": "line_section",
+                "name": "Extras",
+                "margin_depth": 1
+            },
+            {
+                "id": 10,
+                "display_type": false,
+                "name": "Adapter",
+                "product_id": 1,
+                "price_subtotal": 20,
+                "margin": -5
+            }
+        ],
+        "expected": {
+            "total_margin": 60,
+            "total_price_subtotal": 220,
+            "total_margin_percent": 27.27,
+            "sections": [
+                {
+                    "line_id": 1,
+                    "name": "Building",
+                    "margin": 65,
+                    "price_subtotal": 200,
+                    "margin_percent": 32.5,
+                    "products": [],
+                    "subsections": [
+                        {
+                            "line_id": 2,
+                            "name": "Floor 1",
+                            "margin": 35,
+                            "price_subtotal": 140,
+                            "margin_percent": 25,
+                            "products": [],
+                            "subsections": [
+                                {
+                                    "line_id": 3,
+                                    "name": "Room A",
+                                    "margin": 25,
+                                    "price_subtotal": 100,
+                                    "margin_percent": 25,
+                                    "products": [
+                                        [
+                                            4,
+                                            "Desk",
+                                            25,
+                                            100
+                                        ]
+                                    ],
+                                    "subsections": []
+                                },
+                                {
+                                    "line_id": 5,
+                                    "name": "Room B",
+                                    "margin": 10,
+                                    "price_subtotal": 40,
+                                    "margin_percent": 25,
+                                    "products": [
+                                        [
+                                            6,
+                                            "Chair",
+                                            10,
+                                            40
+                                        ]
+                                    ],
+                                    "subsections": []
+                                }
+                            ]
+                        },
+                        {
+                            "line_id": 7,
+                            "name": "Floor 2",
+                            "margin": 30,
+                            "price_subtotal": 60,
+                            "margin_percent": 50,
+                            "products": [
+                                [
+                                    8,
+                                    "Lamp",
+                                    30,
+                                    60
+                                ]
+                            ],
+                            "subsections": []
+                        }
+                    ]
+                },
+                {
+                    "line_id": 9,
+                    "name": "Extras",
+                    "margin": -5,
+                    "price_subtotal": 20,
+                    "margin_percent": -25,
+                    "products": [
+                        [
+                            10,
+                            "Adapter",
+                            -5,
+                            20
+                        ]
+                    ],
+                    "subsections": []
+                }
+            ]
+        }
+    },
+    {
+        "name": "orphan groups and lines left out",
+        "lines": [
+            {
+                "id": 1,
+                "display_type": "line_subsection",
+                "name": "Loose"
+            },
+            {
+                "id": 2,
+                "display_type": false,
+                "name": "Before",
+                "product_id": 1,
+                "price_subtotal": 30,
+                "margin": 10
+            },
+            {
+                "id": 3,
+                "display_type": "line_note",
+                "name": "Note"
+            },
+            {
+                "id": 4,
+                "display_type": "line_section",
+                "name": "Main"
+            },
+            {
+                "id": 5,
+                "display_type": false,
+                "name": "Free",
+                "product_id": 1,
+                "price_subtotal": 0,
+                "margin": 0
+            },
+            {
+                "id": 6,
+                "display_type": false,
+                "name": "Down payment",
+                "product_id": false,
+                "price_subtotal": 10,
+                "margin": 10
+            },
+            {
+                "id": 7,
+                "display_type": false,
+                "name": "Paid",
+                "product_id": 1,
+                "price_subtotal": 50,
+                "margin": 0
+            },
+            {
+                "id": 8,
+                "display_type": "line_section",
+                "name": "Empty"
+            },
+            {
+                "id": 9,
+                "display_type": "line_subsection",
+                "name": "Deep start",
+                "margin_depth": 3
+            }
+        ],
+        "expected": {
+            "total_margin": 10,
+            "total_price_subtotal": 80,
+            "total_margin_percent": 12.5,
+            "sections": [
+                {
+                    "line_id": 4,
+                    "name": "Main",
+                    "margin": 0,
+                    "price_subtotal": 50,
+                    "margin_percent": 0,
+                    "products": [
+                        [
+                            7,
+                            "Paid",
+                            0,
+                            50
+                        ]
+                    ],
+                    "subsections": []
+                },
+                {
+                    "line_id": 8,
+                    "name": "Empty",
+                    "margin": 0,
+                    "price_subtotal": 0,
+                    "margin_percent": 0,
+                    "products": [],
+                    "subsections": [
+                        {
+                            "line_id": 9,
+                            "name": "Deep start",
+                            "margin": 0,
+                            "price_subtotal": 0,
+                            "margin_percent": 0,
+                            "products": [],
+                            "subsections": []
+                        }
+                    ]
+                }
+            ]
+        }
+    },
+    {
+        "name": "deeper section first is left out",
+        "lines": [
+            {
+                "id": 1,
+                "display_type": "line_section",
+                "name": "Nested start",
+                "margin_depth": 2
+            },
+            {
+                "id": 2,
+                "display_type": false,
+                "name": "Orphan",
+                "product_id": 1,
+                "price_subtotal": 40,
+                "margin": 20
+            },
+            {
+                "id": 3,
+                "display_type": "line_section",
+                "name": "Top"
+            },
+            {
+                "id": 4,
+                "display_type": false,
+                "name": "Item",
+                "product_id": 1,
+                "price_subtotal": 80,
+                "margin": 20
+            }
+        ],
+        "expected": {
+            "total_margin": 40,
+            "total_price_subtotal": 120,
+            "total_margin_percent": 33.33,
+            "sections": [
+                {
+                    "line_id": 3,
+                    "name": "Top",
+                    "margin": 20,
+                    "price_subtotal": 80,
+                    "margin_percent": 25,
+                    "products": [
+                        [
+                            4,
+                            "Item",
+                            20,
+                            80
+                        ]
+                    ],
+                    "subsections": []
+                }
+            ]
+        }
+    }
+];
@@ -0,0 +1,38 @@
+import { describe, expect, test } from "@odoo/hoot";
+import { computeSectionMargins } from "@clasiccsales/js/section_margin_engine";
+import { marginTreeVectors } from "./margin_tree_vectors";
+
+const round = (value) => Math.round(value * 100) / 100;
+
+function normalizeGroup(group) {
+    return {
+        line_id: group.line_id,
+        name: group.name,
+        margin: round(group.margin),
+        price_subtotal: round(group.price_subtotal),
+        margin_percent: round(group.margin_percent),
+        products: group.products.map((product) => [
+            product.line_id,
+            product.name,
+            round(product.margin),
+            round(product.price_subtotal),
+        ]),
+        subsections: (group.subsections || []).map(normalizeGroup),
+    };
+}
+
+describe.current.tags("headless");
+
+describe("computeSectionMargins", () => {
+    for (const vector of marginTreeVectors) {
+        test(`shared vector: ${vector.name}`, () => {
+            const tree = computeSectionMargins(vector.lines);
+            expect({
+                total_margin: round(tree.total_margin),
+                total_price_subtotal: round(tree.total_price_subtotal),
+                total_margin_percent: round(tree.total_margin_percent),
+                sections: tree.sections.map(normalizeGroup),
+            }).toEqual(vector.expected);
+        });
+    }
+});
@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+
+from . import test_margin_adjust
+from . import test_margin_alert
+from . import test_margin_cost
+from . import test_margin_freeze
+from . import test_margin_job
+from . import test_margin_snapshot
+from . import test_margin_solver
+from . import test_margin_targets
+from . import test_margin_tree
+from . import test_margin_tree_cache
+from . import test_section_margin_report
+from . import test_section_margin_recompute
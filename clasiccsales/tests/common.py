@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+from contextlib import contextmanager
+from unittest.mock import patch
+
+from odoo import Command
+from odoo.tests import TransactionCase
+
+from ..models.sale_order import _MARGIN_HTML_CACHE, _MARGIN_TREE_CACHE
+
+
+class SectionMarginCase(TransactionCase):
+    """
+    Quotation with two sections, the first one with a subsection:
+
+        Hardware                    margin 110 / 250
+            Server      2 x 100, cost 60
+            Cables                  margin 30 / 50
+                Cable   1 x 50, cost 20
+        Services                    margin 120 / 240
+            Install     3 x 80, cost 40
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.partner = cls.env['res.partner'].create({'name': 'Margin Customer'})
+        cls.product_server = cls._create_product('Server', 60.0)
+        cls.product_cable = cls._create_product('Cable', 20.0)
+        cls.product_install = cls._create_product('Install', 40.0, 'service')
+        cls.order = cls.env['sale.order'].create({
+            'partner_id': cls.partner.id,
+            'order_line': [
+                Command.create({'display_type': 'line_section', 'name': 'Hardware'}),
+                cls._line_vals(cls.product_server, 2, 100.0),
+                Command.create({'display_type': 'line_subsection', 'name': 'Cables'}),
+                cls._line_vals(cls.product_cable, 1, 50.0),
+                Command.create({'display_type': 'line_section', 'name': 'Services'}),
+                cls._line_vals(cls.product_install, 3, 80.0),
+            ],
+        })
+        (cls.section_hardware, cls.line_server, cls.subsection_cables,
+         cls.line_cable, cls.section_services, cls.line_install) = cls.order.order_line
+
+    @classmethod
+    def _create_product(cls, name, cost, product_type='consu'):
+        return cls.env['product.product'].create({
+            'name': name,
+            'type': product_type,
+            'standard_price': cost,
+            'taxes_id': [Command.clear()],
+        })
+
+    @classmethod
+    def _line_vals(cls, product, quantity, price_unit):
+        return Command.create({
+            'product_id': product.id,
+            'product_uom_qty': quantity,
+            'price_unit': price_unit,
+        })
+
+    def setUp(self):
+        super().setUp()
+        # Trees cached by other tests must not answer the lookups of this one
+        _MARGIN_TREE_CACHE.clear()
+        _MARGIN_HTML_CACHE.clear()
+
+    @contextmanager
+    def count_margin_tree_builds(self):
+        """Count the margin trees built from the order lines in the block"""
+        SaleOrder = self.registry['sale.order']
+        with patch.object(SaleOrder, '_build_margin_tree', autospec=True,
+                          side_effect=SaleOrder._build_margin_tree) as build:
+            yield build
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+from odoo.tests import tagged
+
+from .common import SectionMarginCase
+
+
+@tagged('post_install', '-at_install')
+class TestMarginAdjust(SectionMarginCase):
+
+    def test_group_path_by_id(self):
+        with self.count_margin_tree_builds() as build:
+            line, path = self.order._get_margin_group_path(self.subsection_cables.id)
+            _line, section_path = self.order._get_margin_group_path(str(self.section_services.id))
+        self.assertEqual(build.call_count, 0)
+        self.assertEqual(line, self.subsection_cables)
+        self.assertEqual(path, self.section_hardware + self.subsection_cables)
+        self.assertEqual(section_path, self.section_services)
+
+        # Product lines, other orders and groups before the first section
+        orphan = self.env['sale.order.line'].create({
+            'order_id': self.order.id,
+            'display_type': 'line_subsection',
+            'name': 'Loose',
+            'sequence': 0,
+        })
+        other_order = self.order.copy()
+        for line_id in (self.line_cable.id, other_order.order_line[0].id, orphan.id, 'abc'):
+            with self.subTest(line_id=line_id):
+                self.assertIsNone(self.order._get_margin_group_path(line_id)[1])
+
+    def test_adjust_group_by_id(self):
+        result = self.order.adjust_group_margin_by_id(self.subsection_cables.id, 50.0)
+        self.assertTrue(result['success'], result.get('message'))
+        self.assertAlmostEqual(result['old_margin_percent'], 60.0)
+        self.assertAlmostEqual(result['new_margin_percent'], 50.0, places=1)
+        self.assertEqual(result['section_line_id'], self.section_hardware.id)
+        self.assertEqual(result['subsection_name'], 'Cables')
+
+    def test_history_names_escaped(self):
+        self.section_services.name = '<img src=x onerror=alert(1)>'
+        result = self.order.adjust_section_margin_by_id(self.section_services.id, 40.0)
+        self.assertTrue(result['success'], result.get('message'))
+
+        html = self.order._generate_margin_history_html()
+        self.assertNotIn('<img', html)
+        self.assertIn('&lt;img src=x onerror=alert(1)&gt;', html)
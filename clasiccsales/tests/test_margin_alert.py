@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+from unittest.mock import patch
+
+from odoo.tests import tagged
+
+from .common import SectionMarginCase
+
+
+@tagged('post_install', '-at_install')
+class TestMarginAlert(SectionMarginCase):
+
+    def setUp(self):
+        super().setUp()
+        # Hardware is at 44%, Services at 50%
+        self.env['ir.config_parameter'].sudo().set_param('clasiccsales.margin_alert_threshold', '45')
+        self.activity_type = self.env.ref('clasiccsales.mail_activity_type_margin_alert')
+
+    def _alert(self):
+        return self.env['mail.activity'].search([
+            ('res_model', '=', 'sale.order'),
+            ('res_id', '=', self.order.id),
+            ('activity_type_id', '=', self.activity_type.id),
+        ])
+
+    def test_sweep_keeps_unchanged_alerts(self):
+        self.env['sale.order.margin.alert'].sweep()
+        alert = self._alert()
+        self.assertEqual(len(alert), 1)
+        self.assertIn('Hardware', alert.note)
+        self.assertNotIn('Services', alert.note)
+
+        MailActivity = self.registry['mail.activity']
+        with patch.object(MailActivity, 'write', autospec=True, side_effect=MailActivity.write) as write:
+            self.env['sale.order.margin.alert'].sweep()
+        self.assertEqual(write.call_count, 0)
+        self.assertEqual(self._alert(), alert)
+
+        # Services drops below the threshold: the alert is rewritten
+        self.line_install.price_unit = 70.0
+        self.env['sale.order.margin.alert'].sweep()
+        self.assertIn('Services', alert.note)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+
+from unittest.mock import patch
+
+from odoo.tests import tagged
+
+from ..models.margin_cost import COST_CACHE_KEY
+from ..models.sale_order import _MARGIN_HTML_CACHE
+from .common import SectionMarginCase
+
+
+@tagged('post_install', '-at_install')
+class TestMarginCost(SectionMarginCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.env['ir.config_parameter'].sudo().set_param('clasiccsales.margin_cost_source', 'vendor')
+        cls.vendor = cls.env['res.partner'].create({'name': 'Cable Vendor'})
+        cls.supplier_info = cls.env['product.supplierinfo'].create({
+            'partner_id': cls.vendor.id,
+            'product_tmpl_id': cls.product_cable.product_tmpl_id.id,
+            'price': 25.0,
+        })
+
+    def test_costs_cached_within_scope(self):
+        cost_provider = self.env['sale.order.margin.cost']
+        CostProvider = self.registry['sale.order.margin.cost']
+        with patch.object(CostProvider, '_get_unit_costs_vendor', autospec=True,
+                          side_effect=CostProvider._get_unit_costs_vendor) as resolve:
+            with cost_provider._unit_cost_scope():
+                cost_provider.get_unit_costs(self.line_cable)
+                with cost_provider._unit_cost_scope():
+                    costs = cost_provider.get_unit_costs(self.line_cable)
+            self.assertEqual(resolve.call_count, 1)
+            self.assertEqual(costs, {self.line_cable.id: 25.0})
+            self.assertNotIn(COST_CACHE_KEY, self.env.cr.cache)
+
+            # Outside a scope every lookup is resolved again
+            cost_provider.get_unit_costs(self.line_cable)
+            cost_provider.get_unit_costs(self.line_cable)
+            self.assertEqual(resolve.call_count, 3)
+
+    def test_cost_change_between_adjustments(self):
+        result = self.order.adjust_group_margin_by_id(self.subsection_cables.id, 50.0)
+        self.assertTrue(result['success'], result.get('message'))
+        self.assertAlmostEqual(result['old_margin_percent'], 50.0)
+        self.assertNotIn(COST_CACHE_KEY, self.env.cr.cache)
+
+        # Same cursor, as in the job cron: the new vendor price is used
+        self.supplier_info.price = 30.0
+        result = self.order.adjust_group_margin_by_id(self.subsection_cables.id, 50.0)
+        self.assertTrue(result['success'], result.get('message'))
+        self.assertAlmostEqual(result['old_margin_percent'], 40.0)
+        self.assertAlmostEqual(self.line_cable.price_unit, 60.0)
+
+    def test_margins_tab_not_cached(self):
+        # Vendor prices change without touching the lines: no ETag to match
+        self.assertEqual(self.order._get_margin_etag(), '')
+        self.assertIn('Hardware', self.order.section_margins_html)
+        self.assertNotIn(self.order.id, _MARGIN_HTML_CACHE)
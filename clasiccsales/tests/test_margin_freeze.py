@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+
+from unittest.mock import patch
+
+from odoo.tests import tagged
+
+from .common import SectionMarginCase
+
+
+@tagged('post_install', '-at_install')
+class TestMarginFreeze(SectionMarginCase):
+
+    def test_frozen_costs_written_per_cost(self):
+        # Second line at the cost of the server
+        line_server_2 = self.env['sale.order.line'].create({
+            'order_id': self.order.id,
+            'product_id': self.product_server.id,
+            'product_uom_qty': 1,
+            'price_unit': 100.0,
+            'sequence': self.line_server.sequence,
+        })
+
+        SaleOrderLine = self.registry['sale.order.line']
+        with patch.object(SaleOrderLine, 'write', autospec=True, side_effect=SaleOrderLine.write) as write:
+            self.order.action_confirm()
+        frozen_writes = [call for call in write.call_args_list if 'frozen_unit_cost' in call.args[1]]
+        self.assertEqual(len(frozen_writes), 3)
+
+        lines = self.line_server + line_server_2 + self.line_cable + self.line_install
+        self.assertEqual(lines.mapped('frozen_unit_cost'), [60.0, 60.0, 20.0, 40.0])
+        self.assertTrue(self.order.section_margins_frozen)
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+from odoo.tests import new_test_user, tagged
+
+from .common import SectionMarginCase
+
+
+@tagged('post_install', '-at_install')
+class TestMarginJob(SectionMarginCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.salesman = new_test_user(cls.env, 'margin_salesman', groups='sales_team.group_sale_salesman')
+        cls.other_salesman = new_test_user(cls.env, 'margin_other', groups='sales_team.group_sale_salesman')
+        cls.sales_manager = new_test_user(cls.env, 'margin_manager', groups='sales_team.group_sale_manager')
+        cls.order.user_id = cls.salesman
+
+    def test_jobs_visible_to_requester(self):
+        job = self.env['sale.order.margin.job'].with_user(self.salesman).create({
+            'order_id': self.order.id,
+            'job_type': 'product',
+            'params': '{}',
+        })
+        domain = [('id', '=', job.id)]
+        Job = self.env['sale.order.margin.job']
+        self.assertEqual(Job.with_user(self.salesman).search(domain), job)
+        self.assertFalse(Job.with_user(self.other_salesman).search(domain))
+        self.assertEqual(Job.with_user(self.sales_manager).search(domain), job)
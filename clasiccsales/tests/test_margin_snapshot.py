@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+from odoo import fields
+from odoo.tests import tagged
+
+from .common import SectionMarginCase
+
+
+@tagged('post_install', '-at_install')
+class TestMarginSnapshot(SectionMarginCase):
+
+    def _snapshot_totals(self):
+        self.env.flush_all()
+        Snapshot = self.env['sale.order.section.margin.snapshot']
+        Snapshot._refresh_orders([self.order.id], fields.Datetime.now())
+        [totals] = Snapshot._read_group(
+            [('order_id', '=', self.order.id)],
+            aggregates=['section_count:sum', 'section_margin_percent:sum',
+                        'target_count:sum', 'target_hit_count:sum'],
+        )
+        return totals
+
+    def test_targets_counted_per_target_section(self):
+        # Hardware (two snapshot rows, with Cables) is at its target,
+        # Services (50%) is below its target
+        self.section_hardware.margin_target_percent = 44.0
+        self.section_services.margin_target_percent = 60.0
+        sections, section_percents, targets, hits = self._snapshot_totals()
+        self.assertEqual((targets, hits), (2, 1))
+
+        # Mean of the section margins, not the margin of the whole order
+        self.assertEqual(sections, 2)
+        self.assertAlmostEqual(section_percents / sections, (44.0 + 50.0) / 2)
+
+        # Cables follows its own target, Hardware keeps the server only
+        self.subsection_cables.margin_target_percent = 60.0
+        self.assertEqual(self.line_cable.margin_target_line_id, self.subsection_cables)
+        self.assertEqual(self.line_server.margin_target_line_id, self.section_hardware)
+        sections, section_percents, targets, hits = self._snapshot_totals()
+        # Server alone is at 40%, below 44%
+        self.assertEqual((targets, hits), (3, 1))
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+from odoo.tests import BaseCase
+
+from ..tools.margin_solver import distribute_within_bounds
+
+
+class TestMarginSolver(BaseCase):
+
+    def test_spread_within_bounds(self):
+        result = distribute_within_bounds(
+            [100.0, 100.0], [1.0, 1.0], [0.0, 90.0], [float('inf'), 110.0], 300.0)
+        self.assertTrue(result['success'])
+        self.assertEqual(result['amounts'], [190.0, 110.0])
+
+    def test_locked_line_outside_bounds(self):
+        # The locked line sits below its floor and must not be moved to it
+        result = distribute_within_bounds(
+            [50.0, 100.0], [0.0, 1.0], [80.0, 0.0], [120.0, float('inf')], 200.0)
+        self.assertTrue(result['success'])
+        self.assertEqual(result['amounts'], [50.0, 150.0])
+
+        # Nor above its ceiling, even with inverted bounds
+        result = distribute_within_bounds(
+            [150.0, 100.0], [0.0, 1.0], [130.0, 0.0], [120.0, float('inf')], 300.0)
+        self.assertTrue(result['success'])
+        self.assertEqual(result['amounts'], [150.0, 150.0])
+
+    def test_unreachable_target(self):
+        result = distribute_within_bounds(
+            [50.0, 100.0], [0.0, 1.0], [0.0, 90.0], [100.0, 110.0], 200.0)
+        self.assertFalse(result['success'])
+        self.assertEqual((result['lowest'], result['highest']), (140.0, 160.0))
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+from odoo.tests import tagged
+
+from .common import SectionMarginCase
+
+
+@tagged('post_install', '-at_install')
+class TestMarginTargets(SectionMarginCase):
+
+    def setUp(self):
+        super().setUp()
+        self.env['ir.config_parameter'].sudo().set_param('clasiccsales.margin_target_mode', 'save')
+        # Hardware is already at 110 / 250
+        self.section_hardware.margin_target_percent = 44.0
+        self._commit_margin_targets()
+
+    def _commit_margin_targets(self):
+        """Run the target enforcement the way the commit of the request does"""
+        self.env.flush_all()
+        self.env.cr.precommit.run()
+
+    def _hardware_margin_percent(self):
+        lines = self.line_server + self.line_cable
+        subtotal = sum(lines.mapped('price_subtotal'))
+        return (subtotal - 2 * 60.0 - 20.0) / subtotal * 100
+
+    def test_line_edit_repriced_to_target(self):
+        self.line_server.price_unit = 120.0
+        self._commit_margin_targets()
+        self.assertAlmostEqual(self._hardware_margin_percent(), 44.0, places=1)
+
+    def test_product_adjustment_kept(self):
+        result = self.order.adjust_product_margin(self.line_server.id, 50.0)
+        self.assertTrue(result['success'], result.get('message'))
+        self._commit_margin_targets()
+        self.assertAlmostEqual(self.line_server.price_unit, 120.0)
+        self.assertAlmostEqual(self.line_cable.price_unit, 50.0)
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from odoo.tests import BaseCase, tagged
+from odoo.tools import file_open
+
+from ..tools.margin_tree import build_margin_tree
+
+VECTORS_PATH = 'clasiccsales/static/tests/margin_tree_vectors.js'
+VECTORS_START = '\nexport const marginTreeVectors ='
+
+
+def load_vectors():
+    """Vectors shared with the client engine test, JSON inside a JS module"""
+    with file_open(VECTORS_PATH) as vectors_file:
+        source = vectors_file.read()
+    return json.loads(source.split(VECTORS_START, 1)[1].strip().rstrip(';'))
+
+
+def normalize_group(group):
+    return {
+        'line_id': group.line_id,
+        'name': group.name,
+        'margin': round(group.margin, 2),
+        'price_subtotal': round(group.price_subtotal, 2),
+        'margin_percent': round(group.margin_percent, 2),
+        'products': [
+            [product.line_id, product.name, round(product.margin, 2), round(product.price_subtotal, 2)]
+            for product in group.products
+        ],
+        'subsections': [normalize_group(subsection) for subsection in group.subsections],
+    }
+
+
+@tagged('post_install', '-at_install')
+class TestMarginTree(BaseCase):
+
+    def test_shared_vectors(self):
+        for vector in load_vectors():
+            with self.subTest(vector['name']):
+                tree = build_margin_tree(vector['lines'])
+                self.assertEqual({
+                    'total_margin': round(tree.total_margin, 2),
+                    'total_price_subtotal': round(tree.total_price_subtotal, 2),
+                    'total_margin_percent': round(tree.total_margin_percent, 2),
+                    'sections': [normalize_group(section) for section in tree.sections],
+                }, vector['expected'])
+
+    def test_json_round_trip(self):
+        for vector in load_vectors():
+            with self.subTest(vector['name']):
+                tree = build_margin_tree(vector['lines'], 'v1')
+                self.assertEqual(json.loads(tree.to_json()), tree.to_dict())
+                copy = tree.copy()
+                self.assertEqual(copy.to_dict(), tree.to_dict())
+                self.assertIsNot(copy.sections[0], tree.sections[0])
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import json
+from unittest.mock import patch
+
+from odoo.tests import tagged
+
+from ..models.sale_order import _MARGIN_TREE_CACHE
+from .common import SectionMarginCase
+
+
+@tagged('post_install', '-at_install')
+class TestMarginTreeCache(SectionMarginCase):
+
+    def test_single_line_edit_patches_tree(self):
+        self.order._get_margin_tree()
+        shared_tree = _MARGIN_TREE_CACHE[self.order.id]['tree']
+
+        SaleOrder = self.registry['sale.order']
+        with self.count_margin_tree_builds() as build, \
+                patch.object(SaleOrder, '_get_margin_version', autospec=True,
+                             side_effect=SaleOrder._get_margin_version) as version:
+            self.line_cable.price_unit = 70.0
+        self.assertEqual(build.call_count, 0)
+        # The token is moved by the edited row only, the order is not rehashed
+        self.assertEqual(version.call_count, 0)
+
+        with self.count_margin_tree_builds() as build:
+            margins = json.loads(self.order.section_margins_json)
+        self.assertEqual(build.call_count, 0)
+        hardware = margins['sections'][0]
+        self.assertAlmostEqual(hardware['subsections'][0]['margin'], 50.0)
+        self.assertAlmostEqual(hardware['margin'], 130.0)
+        self.assertAlmostEqual(margins['total_margin'], 250.0)
+        self.assertEqual(margins['version'], self.order._get_margin_version())
+
+        # Other transactions keep the committed amounts until this one commits
+        self.assertIs(_MARGIN_TREE_CACHE[self.order.id]['tree'], shared_tree)
+        self.assertAlmostEqual(shared_tree.total_margin, 230.0)
+
+    def test_consecutive_line_edits(self):
+        self.order._get_margin_tree()
+        lines = self.line_server + self.line_cable + self.line_install
+        with self.count_margin_tree_builds() as build:
+            for line in lines:
+                line.price_unit += 10.0
+            tree = self.order._get_margin_tree()
+        self.assertEqual(build.call_count, 0)
+        self.assertEqual(tree.version, self.order._get_margin_version())
+        self.assertAlmostEqual(tree.total_margin, 230.0 + 2 * 10.0 + 10.0 + 3 * 10.0)
+
+    def test_outdated_tree_is_rebuilt(self):
+        self.order._get_margin_tree()
+        # Changed behind the cache: the tree no longer matches the lines
+        self.env.cr.execute("UPDATE sale_order_line SET sequence = sequence + 1 WHERE id = %s",
+                            [self.line_install.id])
+        self.line_cable.price_unit = 70.0
+
+        with self.count_margin_tree_builds() as build:
+            tree = self.order._get_margin_tree()
+        self.assertEqual(build.call_count, 1)
+        self.assertAlmostEqual(tree.total_margin, 250.0)
+
+    def test_bulk_repricing_skips_deltas(self):
+        self.order._get_margin_tree()
+        lines = self.line_server | self.line_cable | self.line_install
+        with self.count_margin_tree_builds() as build, \
+                patch.object(self.registry['sale.order'], '_apply_margin_delta', autospec=True) as delta:
+            self.order._apply_line_prices(lines, [110.0, 60.0, 90.0])
+        self.assertEqual(delta.call_count, 0)
+        # Dropped once, rebuilt once by the margin refresh
+        self.assertEqual(build.call_count, 1)
+
+        with self.count_margin_tree_builds() as build:
+            tree = self.order._get_margin_tree()
+        self.assertEqual(build.call_count, 0)
+        self.assertAlmostEqual(tree.total_margin, 100.0 + 40.0 + 150.0)
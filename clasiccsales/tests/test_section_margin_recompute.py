@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import json
+from unittest.mock import patch
+
+from odoo.tests import tagged
+
+from .common import SectionMarginCase
+
+
+@tagged('post_install', '-at_install')
+class TestSectionMarginRecompute(SectionMarginCase):
+    """Bulk operations build no margin tree, the first read builds an up-to-date one"""
+
+    def test_copy(self):
+        with self.count_margin_tree_builds() as build:
+            order_copy = self.order.copy()
+        self.assertEqual(build.call_count, 0)
+
+        with self.count_margin_tree_builds() as build:
+            margins = json.loads(order_copy.section_margins_json)
+            self.assertIn('Hardware', order_copy.section_margins_html)
+        self.assertEqual(build.call_count, 1)
+        self.assertEqual([section['name'] for section in margins['sections']], ['Hardware', 'Services'])
+        self.assertAlmostEqual(margins['total_margin'], 230.0)
+
+    def test_line_import(self):
+        json.loads(self.order.section_margins_json)
+
+        with self.count_margin_tree_builds() as build:
+            result = self.env['sale.order.line'].load(
+                ['order_id/.id', 'product_id/.id', 'product_uom_qty', 'price_unit'],
+                [[str(self.order.id), str(self.product_install.id), '1', '100']] * 3,
+            )
+        self.assertFalse([message for message in result['messages'] if message['type'] == 'error'])
+        self.assertEqual(build.call_count, 0)
+
+        with self.count_margin_tree_builds() as build:
+            margins = json.loads(self.order.section_margins_json)
+        self.assertEqual(build.call_count, 1)
+        services = margins['sections'][1]
+        self.assertEqual(len(services['products']), 4)
+        self.assertAlmostEqual(services['margin'], 120.0 + 3 * 60.0)
+        self.assertAlmostEqual(margins['total_margin'], 230.0 + 3 * 60.0)
+
+    def test_deferred_line_writes(self):
+        self.env['ir.config_parameter'].sudo().set_param('clasiccsales.margin_target_mode', 'save')
+        self.section_services.margin_target_percent = 50.0
+        json.loads(self.order.section_margins_json)
+
+        SaleOrder = self.registry['sale.order']
+        lines = self.line_server + self.line_cable + self.line_install
+        with self.count_margin_tree_builds() as build, \
+                patch.object(SaleOrder, '_apply_margin_delta', autospec=True) as delta, \
+                patch.object(SaleOrder, '_enforce_margin_targets', autospec=True,
+                             side_effect=SaleOrder._enforce_margin_targets) as enforce:
+            for line in lines.with_context(defer_section_margins=True):
+                line.price_unit += 10.0
+            self.assertEqual(build.call_count, 0)
+            self.env.flush_all()
+            self.env.cr.precommit.run()
+        self.assertEqual(delta.call_count, 0)
+        self.assertEqual(enforce.call_count, 1)
+
+        # Install was brought back to the Services target: 3 x 80
+        self.assertAlmostEqual(self.line_install.price_unit, 80.0)
+        margins = json.loads(self.order.section_margins_json)
+        self.assertAlmostEqual(margins['total_margin'], 230.0 + 2 * 10.0 + 10.0)
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+from odoo.tests import tagged
+
+from .common import SectionMarginCase
+
+
+@tagged('post_install', '-at_install')
+class TestSectionMarginReport(SectionMarginCase):
+
+    def _report_groups(self):
+        self.env.flush_all()
+        rows = self.env['sale.order.section.margin.report'].search([('order_id', '=', self.order.id)])
+        return {row.line_id: (row.section_line_id, row.subsection_line_id) for row in rows}
+
+    def test_section_attribution(self):
+        no_line = self.env['sale.order.line']
+        self.assertEqual(self._report_groups(), {
+            self.line_server: (self.section_hardware, no_line),
+            self.line_cable: (self.section_hardware, self.subsection_cables),
+            self.line_install: (self.section_services, no_line),
+        })
+
+        # Moved below Services: the line leaves both Hardware groups
+        self.line_cable.sequence = self.line_install.sequence + 1
+        self.assertEqual(self._report_groups()[self.line_cable], (self.section_services, no_line))
+
+        # A nested group opened before the first section has no section
+        self.subsection_cables.sequence = self.section_hardware.sequence - 2
+        self.line_server.sequence = self.section_hardware.sequence - 1
+        self.assertEqual(self.line_server.margin_section_id, no_line)
+        self.assertEqual(self.line_server.margin_subsection_id, no_line)
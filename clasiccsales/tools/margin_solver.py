@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+"""
+Bounded redistribution of a price change over order lines.
+
+Pure functions working on plain lists, independent from the ORM.
+"""
+
+# Passes of the constrained solve: each pass pins at least one line to a
+# bound, so orders needing more passes than this are reported as unsolved
+MAX_PASSES = 50
+
+# Amounts closer than this to the target are considered on target
+TOLERANCE = 1e-6
+
+
+def distribute_within_bounds(amounts, weights, floors, ceilings, target, max_passes=MAX_PASSES):
+    """
+    Move amounts so that they sum to target while each stays in its bounds.
+
+    Lines with a weight of 0 (locked or excluded) keep their amount as is,
+    even outside their bounds. The other lines start from their current
+    value brought inside [floor, ceiling]. The remaining gap is spread in
+    proportion to the weights over the lines that are not pinned to a bound;
+    lines crossing a bound are pinned to it and their excess is spread over
+    the others on the next pass.
+
+    :param amounts: current amount of each line
+    :param weights: share of the gap taken by each line (0 = never moved)
+    :param floors: lowest allowed amount of each line
+    :param ceilings: highest allowed amount of each line (float('inf') if none)
+    :param target: total the amounts must reach
+    :return: dict with success and either amounts or message
+    """
+    result = []
+    free = []
+    for amount, weight, floor, ceiling in zip(amounts, weights, floors, ceilings):
+        if weight <= 0:
+            result.append(amount)
+            free.append(False)
+            continue
+        if floor > ceiling + TOLERANCE:
+            return {
+                'success': False,
+                'message': 'Some lines have a minimum price above their maximum price',
+            }
+        result.append(min(max(amount, floor), ceiling))
+        free.append(True)
+
+    # Reachable range with the pinned lines at their value and the free ones anywhere in their bounds
+    fixed_total = sum(amount for amount, is_free in zip(result, free) if not is_free)
+    lowest = fixed_total + sum(floor for floor, is_free in zip(floors, free) if is_free)
+    highest = fixed_total + sum(ceiling for ceiling, is_free in zip(ceilings, free) if is_free)
+    if not lowest - TOLERANCE <= target <= highest + TOLERANCE:
+        return {
+            'success': False,
+            'lowest': lowest,
+            'highest': highest,
+            'message': 'The target cannot be reached within the price limits of the lines',
+        }
+
+    for _pass in range(max_passes):
+        gap = target - sum(result)
+        if abs(gap) <= TOLERANCE:
+            return {'success': True, 'amounts': result}
+        total_weight = sum(weight for weight, is_free in zip(weights, free) if is_free)
+        if total_weight <= 0:
+            break
+        pinned = False
+        for index, is_free in enumerate(free):
+            if not is_free:
+                continue
+            amount = result[index] + gap * weights[index] / total_weight
+            if amount > ceilings[index]:
+                amount = ceilings[index]
+                free[index] = False
+                pinned = True
+            elif amount < floors[index]:
+                amount = floors[index]
+                free[index] = False
+                pinned = True
+            result[index] = amount
+        if not pinned:
+            return {'success': True, 'amounts': result}
+
+    return {
+        'success': False,
+        'message': 'The price limits could not be satisfied within the allowed number of passes',
+    }
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Compact in-memory representation of the section margin tree.
+
+Nodes use __slots__ instead of dicts, so a product costs one small object
+instead of a dict with four repeated string keys, and percentages are
+derived from the running totals when read. The dict/JSON structure consumed
+by the views and the client is only produced on demand by to_dict() and
+to_json(), the latter writing JSON straight from the nodes.
+
+build_margin_tree() holds the grouping rules shared with the client engine
+(static/src/js/section_margin_engine.js); both are checked against the same
+vectors in static/tests/margin_tree_vectors.js.
+"""
+
+from json.encoder import encode_basestring_ascii
+
+# Default nesting level of section lines in the margin tree
+MARGIN_GROUP_DEPTHS = {'line_section': 1, 'line_subsection': 2}
+
+
+def _number(value):
+    # Same output as json.dumps for ints, floats and None (unsaved lines)
+    if value is None:
+        return 'null'
+    return float.__repr__(value) if isinstance(value, float) else str(value)
+
+
+def margin_percent(margin, price_subtotal):
+    """Margin percentage as displayed in the margins tab"""
+    if price_subtotal > 0 and margin != 0:
+        return (margin / price_subtotal) * 100
+    return 0.0
+
+
+class ProductNode:
+    __slots__ = ('line_id', 'name', 'margin', 'price_subtotal')
+
+    def __init__(self, line_id, name, margin, price_subtotal):
+        self.line_id = line_id
+        self.name = name
+        self.margin = margin
+        self.price_subtotal = price_subtotal
+
+    @property
+    def margin_percent(self):
+        return (self.margin / self.price_subtotal) * 100 if self.price_subtotal else 0.0
+
+    def to_dict(self):
+        return {
+            'line_id': self.line_id,
+            'name': self.name,
+            'margin': self.margin,
+            'margin_percent': self.margin_percent,
+            'price_subtotal': self.price_subtotal,
+        }
+
+    def to_json(self):
+        margin, subtotal = float(self.margin), float(self.price_subtotal)
+        return '{"line_id": %s, "name": %s, "margin": %r, "margin_percent": %r, "price_subtotal": %r}' % (
+            _number(self.line_id), encode_basestring_ascii(self.name), margin,
+            (margin / subtotal) * 100 if subtotal else 0.0, subtotal)
+
+
+class GroupNode:
+    """
+    A section or any nested group below it: running totals plus its children.
+
+    Totals include the products of every nested group. Sections always carry
+    their `subsections` list; nested groups only when they have groups of
+    their own, so two-level trees keep their original structure.
+    """
+    __slots__ = ('line_id', 'name', 'margin', 'price_subtotal', 'subsections', 'products')
+
+    def __init__(self, line_id, name, margin=0.0, price_subtotal=0.0):
+        self.line_id = line_id
+        self.name = name
+        self.margin = margin
+        self.price_subtotal = price_subtotal
+        self.subsections = []
+        self.products = []
+
+    @property
+    def margin_percent(self):
+        return margin_percent(self.margin, self.price_subtotal)
+
+    def to_dict(self, with_subsections=True):
+        data = {
+            'line_id': self.line_id,
+            'name': self.name,
+            'margin': self.margin,
+            'margin_percent': self.margin_percent,
+            'price_subtotal': self.price_subtotal,
+        }
+        if with_subsections or self.subsections:
+            data['subsections'] = [subsection.to_dict(False) for subsection in self.subsections]
+        data['products'] = [product.to_dict() for product in self.products]
+        return data
+
+    def to_json(self, with_subsections=True):
+        parts = ['{"line_id": %s, "name": %s, "margin": %s, "margin_percent": %s, "price_subtotal": %s' % (
+            _number(self.line_id), encode_basestring_ascii(self.name), _number(self.margin),
+            _number(self.margin_percent), _number(self.price_subtotal))]
+        if with_subsections or self.subsections:
+            parts.append(', "subsections": [%s]' % ', '.join(sub.to_json(False) for sub in self.subsections))
+        parts.append(', "products": [%s]}' % ', '.join(product.to_json() for product in self.products))
+        return ''.join(parts)
+
+    def copy(self):
+        node = GroupNode(self.line_id, self.name, self.margin, self.price_subtotal)
+        node.subsections = [subsection.copy() for subsection in self.subsections]
+        node.products = [ProductNode(product.line_id, product.name, product.margin, product.price_subtotal)
+                         for product in self.products]
+        return node
+
+    @classmethod
+    def from_dict(cls, data):
+        node = cls(data.get('line_id'), data.get('name', 'Unnamed'),
+                   data.get('margin', 0.0), data.get('price_subtotal', 0.0))
+        node.subsections = [cls.from_dict(subsection) for subsection in data.get('subsections', [])]
+        for product in data.get('products', []):
+            node.products.append(ProductNode(product.get('line_id'), product.get('name', 'Unnamed'),
+                                             product.get('margin', 0.0), product.get('price_subtotal', 0.0)))
+        return node
+
+
+class MarginTree:
+    __slots__ = ('sections', 'total_margin', 'total_price_subtotal', 'version')
+
+    def __init__(self, sections=None, total_margin=0.0, total_price_subtotal=0.0, version=''):
+        self.sections = sections if sections is not None else []
+        self.total_margin = total_margin
+        self.total_price_subtotal = total_price_subtotal
+        self.version = version
+
+    @property
+    def total_margin_percent(self):
+        return margin_percent(self.total_margin, self.total_price_subtotal)
+
+    def to_dict(self):
+        return {
+            'sections': [section.to_dict() for section in self.sections],
+            'total_margin': self.total_margin,
+            'total_margin_percent': self.total_margin_percent,
+            'total_price_subtotal': self.total_price_subtotal,
+            'version': self.version,
+        }
+
+    def to_json(self):
+        """Serialize straight from the nodes, same output as json.dumps(self.to_dict())"""
+        return '{"sections": [%s], "total_margin": %s, "total_margin_percent": %s, "total_price_subtotal": %s, "version": %s}' % (
+            ', '.join(section.to_json() for section in self.sections), _number(self.total_margin),
+            _number(self.total_margin_percent), _number(self.total_price_subtotal),
+            encode_basestring_ascii(self.version or ''))
+
+    def copy(self):
+        """Copy of the whole tree, to be patched while readers keep the original"""
+        return MarginTree([section.copy() for section in self.sections],
+                          self.total_margin, self.total_price_subtotal, self.version)
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(
+            [GroupNode.from_dict(section) for section in data.get('sections', [])],
+            data.get('total_margin', 0.0),
+            data.get('total_price_subtotal', 0.0),
+            data.get('version', ''),
+        )
+
+    def walk(self):
+        """Yield the path (section, ..., group) of every group, depth first"""
+        stack = [(section,) for section in reversed(self.sections)]
+        while stack:
+            path = stack.pop()
+            yield path
+            stack.extend(path + (subsection,) for subsection in reversed(path[-1].subsections))
+
+    def index(self):
+        """Map each product line id to (product, groups from its section down to its own)"""
+        index = {}
+        for path in self.walk():
+            for product in path[-1].products:
+                index[product.line_id] = (product, path)
+        return index
+
+    def find_path(self, line_id):
+        """Return the path (section, ..., group) of the group with this line id"""
+        for path in self.walk():
+            if path[-1].line_id == line_id:
+                return path
+        return None
+
+    def find_group(self, section_line_id, subsection_line_id=None):
+        """Return the section, or a group nested at any level in it, with these line ids"""
+        path = self.find_path(subsection_line_id or section_line_id)
+        if path and path[0].line_id == section_line_id:
+            return path[-1]
+        return None
+
+
+def build_margin_tree(lines, version=''):
+    """
+    Build the margin tree in a single pass over order line values.
+
+    A section line opens a group at its margin level and closes every open
+    group of the same or a deeper level, so one stack handles any nesting
+    depth. Products are only added to the innermost open group, which
+    passes its totals on to its parent when it is closed. Groups placed
+    before the first section are not part of the tree; their products only
+    count in the grand total.
+
+    :param lines: dicts in display order with id, display_type, margin_depth,
+        name, product_id, price_subtotal and margin
+    :param version: version token stored on the tree
+    :return: MarginTree
+    """
+    tree = MarginTree(version=version)
+    # Open groups, outermost first: [(level, node)]. The node is None for
+    # groups placed before the first section
+    stack = []
+
+    def close_group():
+        node = stack.pop()[1]
+        parent = stack[-1][1] if stack else None
+        if node and parent:
+            parent.margin += node.margin
+            parent.price_subtotal += node.price_subtotal
+
+    for line in lines:
+        display_type = line.get('display_type')
+        # Section or subsection, at any level
+        if display_type in MARGIN_GROUP_DEPTHS:
+            depth = line.get('margin_depth') or MARGIN_GROUP_DEPTHS[display_type]
+            while stack and stack[-1][0] >= depth:
+                close_group()
+            node = None
+            parent = stack[-1][1] if stack else None
+            if parent or (not stack and depth == 1):
+                node = GroupNode(line.get('id'), line.get('name') or 'Unnamed')
+                (parent.subsections if parent else tree.sections).append(node)
+            stack.append((depth, node))
+
+        # Product line, only part of the tree when it has a price
+        elif not display_type and line.get('product_id'):
+            price_subtotal = line.get('price_subtotal') or 0.0
+            if price_subtotal <= 0:
+                continue
+            margin = line.get('margin') or 0.0
+            group = stack[-1][1] if stack else None
+            if group:
+                group.margin += margin
+                group.price_subtotal += price_subtotal
+                group.products.append(ProductNode(line.get('id'), line.get('name') or 'Unnamed',
+                                                  margin, price_subtotal))
+            tree.total_margin += margin
+            tree.total_price_subtotal += price_subtotal
+
+    while stack:
+        close_group()
+    return tree